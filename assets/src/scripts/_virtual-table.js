@@ -0,0 +1,134 @@
+// Large tables in reports are replaced by the renderer with a <virtual-table> element,
+// which holds a preview of the table's first rows and the URL of all of its data (see
+// TableCapture in reports/rendering.py). Once one is scrolled near to, we load the data
+// and show it in a scrolling table that only has elements for the rows in view.
+
+const ROW_HEIGHT = 32;
+const VISIBLE_ROWS = 20;
+// rows to render either side of the ones in view, so that scrolling doesn't show gaps
+const OVERSCAN = 10;
+
+function row(cells, tagName) {
+  const tr = document.createElement("tr");
+  cells.forEach((text, i) => {
+    const cell = document.createElement(tagName || (i === 0 ? "th" : "td"));
+    cell.textContent = text;
+    tr.appendChild(cell);
+  });
+  return tr;
+}
+
+function spacer(columns) {
+  const tr = document.createElement("tr");
+  const td = document.createElement("td");
+  td.colSpan = columns;
+  td.className = "virtual-table__spacer";
+  tr.appendChild(td);
+  return tr;
+}
+
+class VirtualTable extends HTMLElement {
+  connectedCallback() {
+    this.observer = new IntersectionObserver(
+      (entries) => {
+        if (entries.some((entry) => entry.isIntersecting)) {
+          this.observer.disconnect();
+          this.load();
+        }
+      },
+      { rootMargin: "400px" }
+    );
+    this.observer.observe(this);
+  }
+
+  disconnectedCallback() {
+    this.observer.disconnect();
+  }
+
+  async load() {
+    let data;
+    try {
+      const response = await fetch(this.dataset.src);
+      if (!response.ok) return;
+      data = await response.json();
+    } catch (error) {
+      // leave the preview in place
+      return;
+    }
+    this.rows = data.rows;
+    this.columns = Math.max(
+      ...data.header.map((cells) => cells.length),
+      ...data.rows.slice(0, 1).map((cells) => cells.length)
+    );
+    this.build(data.header);
+  }
+
+  build(header) {
+    const preview = this.querySelector("table");
+
+    const table = document.createElement("table");
+    table.className = preview.className;
+    const thead = document.createElement("thead");
+    header.forEach((cells) => thead.appendChild(row(cells, "th")));
+    this.tbody = document.createElement("tbody");
+    this.topSpacer = spacer(this.columns);
+    this.bottomSpacer = spacer(this.columns);
+    table.append(thead, this.tbody);
+
+    this.scroller = document.createElement("div");
+    this.scroller.className = "virtual-table__scroller";
+    this.scroller.style.maxHeight = `${
+      ROW_HEIGHT * (VISIBLE_ROWS + header.length)
+    }px`;
+    this.scroller.appendChild(table);
+    this.scroller.addEventListener("scroll", () => this.scheduleUpdate(), {
+      passive: true,
+    });
+
+    preview.closest(".overflow-wrapper").replaceWith(this.scroller);
+    const summary = this.querySelector(".virtual-table__summary");
+    if (summary) {
+      summary.firstChild.textContent = `${this.rows.length.toLocaleString()} rows. `;
+    }
+    this.first = null;
+    this.update();
+  }
+
+  scheduleUpdate() {
+    if (this.pending) return;
+    this.pending = true;
+    window.requestAnimationFrame(() => {
+      this.pending = false;
+      this.update();
+    });
+  }
+
+  update() {
+    const first = Math.max(
+      0,
+      Math.floor(this.scroller.scrollTop / ROW_HEIGHT) - OVERSCAN
+    );
+    if (first === this.first) return;
+    this.first = first;
+    const last = Math.min(
+      this.rows.length,
+      first + VISIBLE_ROWS + OVERSCAN * 2
+    );
+
+    const fragment = document.createDocumentFragment();
+    this.topSpacer.firstChild.style.height = `${first * ROW_HEIGHT}px`;
+    this.bottomSpacer.firstChild.style.height = `${
+      (this.rows.length - last) * ROW_HEIGHT
+    }px`;
+    fragment.appendChild(this.topSpacer);
+    this.rows
+      .slice(first, last)
+      .forEach((cells) => fragment.appendChild(row(cells)));
+    fragment.appendChild(this.bottomSpacer);
+    this.tbody.replaceChildren(fragment);
+  }
+}
+
+if ("customElements" in window && "IntersectionObserver" in window) {
+  customElements.define("virtual-table", VirtualTable);
+}
@@ -1,9 +1,45 @@
+// With LAZY_SIDEBAR on, a category's reports aren't in the page (unless it's the current
+// report's category); its data-src is the URL of them, which we fetch the first time it's
+// expanded. The browser keeps them, and asks whether they've changed with their ETag.
+function reportLink(report) {
+  const template = document.getElementById("sidebar-report");
+  const li = template.content.firstElementChild.cloneNode(true);
+  const a = li.querySelector("a");
+  a.href = report.url;
+  a.textContent = report.is_draft
+    ? `${report.menu_name} (Draft)`
+    : report.menu_name;
+  return li;
+}
+
 function subnav() {
   return {
     isSubmenuVisible: !!this.$el.dataset.active,
+    src: this.$el.dataset.src,
+    isLoaded: !this.$el.dataset.src || !!this.$el.dataset.active,
 
     toggleSubnav() {
       this.isSubmenuVisible = !this.isSubmenuVisible;
+      if (this.isSubmenuVisible && !this.isLoaded) {
+        this.loadReports();
+      }
+    },
+
+    async loadReports() {
+      this.isLoaded = true;
+      let data;
+      try {
+        const response = await fetch(this.src, {
+          headers: { Accept: "application/json" },
+        });
+        if (!response.ok) throw new Error(response.statusText);
+        data = await response.json();
+      } catch (error) {
+        // try again when it's next expanded
+        this.isLoaded = false;
+        return;
+      }
+      this.$refs.reports.replaceChildren(...data.reports.map(reportLink));
     },
 
     subnavAriaExpanded: {
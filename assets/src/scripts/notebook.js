@@ -1,3 +1,4 @@
 import "../styles/notebook.scss";
 
 import "./_custom-elements";
+import "./_virtual-table";
@@ -1,10 +1,43 @@
+import subprocess
+import sys
+
+from environs import Env
+
 from services.logging import logging_config_dict
 
 
+env = Env()
+
+
 # Where to log to (stdout and stderr)
 accesslog = "-"
 errorlog = "-"
 
+# Kill a worker that's taken longer than this to handle a request. Reports are rendered
+# within RENDER_TIMEOUT, which has to be less than this (see reports/checks.py), so that
+# we can say that a report is too large before the worker is killed.
+timeout = env.int("WORKER_TIMEOUT", default=60)
+
 # Configure log structure
 # http://docs.gunicorn.org/en/stable/settings.html#logconfig-dict
 logconfig_dict = logging_config_dict
+
+
+# Run the worker that refreshes out-of-date report content in the background (see
+# reports/refresh.py) alongside the web workers, unless REFRESH_WORKER is off
+_refresh_worker = None
+
+
+def when_ready(server):
+    global _refresh_worker
+    if env.bool("REFRESH_WORKER", default=True):
+        _refresh_worker = subprocess.Popen(
+            [sys.executable, "manage.py", "refresh_reports"]
+        )
+        server.log.info(f"Started refresh worker (pid: {_refresh_worker.pid})")
+
+
+def on_exit(server):
+    if _refresh_worker is not None:
+        _refresh_worker.terminate()
+        _refresh_worker.wait()
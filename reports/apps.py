@@ -8,3 +8,8 @@ env = Env()
 class ReportsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "reports"
+
+    def ready(self):
+        # connect the signals that keep the sidebar's navigation up to date, and register
+        # our system checks
+        from . import checks, navigation  # noqa: F401
@@ -0,0 +1,35 @@
+"""
+System checks of our settings
+
+A web worker that takes longer than WORKER_TIMEOUT to handle a request is killed by
+gunicorn, so the time we allow for rendering a report, and for waiting for another worker
+to render it, has to fit within it, along with the time it takes to fetch the report.
+Otherwise the worker is killed before it can tell the user what went wrong.
+"""
+from django.conf import settings
+from django.core.checks import Error, register
+
+
+@register()
+def check_render_budget(app_configs, **kwargs):
+    if settings.RENDER_TIMEOUT >= settings.WORKER_TIMEOUT:
+        return [
+            Error(
+                f"RENDER_TIMEOUT ({settings.RENDER_TIMEOUT}s) must be less than "
+                f"WORKER_TIMEOUT ({settings.WORKER_TIMEOUT}s)",
+                hint="Lower RENDER_TIMEOUT, or raise WORKER_TIMEOUT, leaving time to "
+                "fetch the report.",
+                id="reports.E001",
+            )
+        ]
+    if settings.LOCK_WAIT + settings.RENDER_TIMEOUT >= settings.WORKER_TIMEOUT:
+        return [
+            Error(
+                f"LOCK_WAIT ({settings.LOCK_WAIT}s) and RENDER_TIMEOUT "
+                f"({settings.RENDER_TIMEOUT}s) together must be less than "
+                f"WORKER_TIMEOUT ({settings.WORKER_TIMEOUT}s)",
+                hint="Lower LOCK_WAIT to a few seconds.",
+                id="reports.E002",
+            )
+        ]
+    return []
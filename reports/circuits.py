@@ -0,0 +1,119 @@
+"""
+Circuit breakers for the upstreams we fetch reports from (GitHub and job-server)
+
+During an outage, every request for a report that isn't cached would otherwise wait on
+the failing upstream, and tie up a worker while it did.  Instead, once an upstream has
+failed CIRCUIT_FAILURE_THRESHOLD times without succeeding (within CIRCUIT_FAILURE_WINDOW
+seconds), its circuit opens, and requests to it fail straight away with CircuitOpen.
+After CIRCUIT_RESET_TIMEOUT seconds, one request at a time is let through to probe it:
+if that succeeds the circuit closes again, and if not it stays open for another
+CIRCUIT_RESET_TIMEOUT.  While a report's upstream is failing, the report is served as we
+last rendered it (see views.report_view).
+
+Each upstream (a host) has a circuit shared by all of our workers, kept in the default
+cache.  The circuits are enforced by the adapter of our HTTP sessions (see http.py), so
+every request to GitHub and job-server is covered, and responses from the requests cache
+are still served.
+"""
+from urllib.parse import urlsplit
+
+import structlog
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+
+logger = structlog.getLogger()
+
+
+class CircuitOpen(ConnectionError):
+    """A request wasn't made, as its upstream is failing"""
+
+
+class CircuitBreaker:
+    """The circuit for the upstream `name`"""
+
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+
+    def is_open(self):
+        """Are requests to the upstream failing without being made?"""
+        return bool(cache.get_many([self._key("open"), self._key("probe")]))
+
+    def allow(self):
+        """Can we make a request to the upstream?"""
+        state = cache.get_many([self._key("open"), self._key("failures")])
+        if self._key("open") in state:
+            return False
+        self.failures = state.get(self._key("failures"), 0)
+        if self.failures < settings.CIRCUIT_FAILURE_THRESHOLD:
+            return True
+        # the circuit has been open for long enough; let one request through to see
+        # whether the upstream has recovered
+        return cache.add(self._key("probe"), True, settings.CIRCUIT_RESET_TIMEOUT)
+
+    def record_success(self):
+        if not self.failures:
+            return
+        if self.failures >= settings.CIRCUIT_FAILURE_THRESHOLD:
+            logger.info("Circuit closed", upstream=self.name)
+        cache.delete_many([self._key("failures"), self._key("probe")])
+        self.failures = 0
+
+    def record_failure(self):
+        # Not atomic, so failures at the same moment may be undercounted, but that only
+        # means that the circuit takes a little longer to open. A cache's incr() doesn't
+        # keep the key's timeout anyway.
+        key = self._key("failures")
+        self.failures = cache.get(key, 0) + 1
+        if self.failures < settings.CIRCUIT_FAILURE_THRESHOLD:
+            cache.set(key, self.failures, settings.CIRCUIT_FAILURE_WINDOW)
+            return
+        logger.warning("Circuit opened", upstream=self.name, failures=self.failures)
+        cache.set(self._key("open"), True, settings.CIRCUIT_RESET_TIMEOUT)
+        # stay half-open, rather than closing when the failure window ends, until a
+        # request succeeds
+        cache.set(key, self.failures, None)
+        cache.delete(self._key("probe"))
+
+    def _key(self, name):
+        return f"circuit:{self.name}:{name}"
+
+
+def is_failure(response):
+    """
+    Does a response mean that its upstream is failing, rather than the request?
+
+    GitHub says that we've gone over its rate limit with a 403, with no requests remaining
+    or a Retry-After header.  Until the limit resets it's as good as down to us, so that
+    counts too, but any other 403 doesn't.
+    """
+    if response.status_code >= 500 or response.status_code == 429:
+        return True
+    return response.status_code == 403 and (
+        response.headers.get("X-RateLimit-Remaining") == "0"
+        or "Retry-After" in response.headers
+    )
+
+
+class CircuitBreakerAdapter(HTTPAdapter):
+    """An HTTPAdapter that only makes requests to upstreams whose circuits are closed"""
+
+    def send(self, request, **kwargs):
+        breaker = CircuitBreaker(urlsplit(request.url).hostname)
+        if not breaker.allow():
+            raise CircuitOpen(f"{breaker.name} is failing", request=request)
+
+        try:
+            response = super().send(request, **kwargs)
+        except (ConnectionError, Timeout):
+            breaker.record_failure()
+            raise
+
+        if is_failure(response):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
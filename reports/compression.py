@@ -0,0 +1,206 @@
+"""
+Compress rendered reports once, when they're rendered, rather than on every request
+
+A report page is mostly the report's body, but the rest of the page (the sidebar, the
+header) varies between users, so we can't compress whole pages in advance.  Instead we
+gzip the body when it's rendered, and splice its compressed data into a gzip stream that
+we compress the rest of the page into as it's served.
+
+This works because a gzip file's compressed data is a series of deflate blocks, and as
+long as a block ends on a byte boundary and doesn't refer back to data before it, it can
+be copied into another stream.  Brotli streams can't be spliced like this (how a brotli
+block is decoded depends on the data before it), so brotli is only used for files that
+are served whole (see `compress_file`).
+"""
+import os
+import struct
+import tempfile
+import zlib
+from pathlib import Path
+
+import brotli
+
+
+# zlib's default level, and a brotli quality which compresses about as fast: beyond these
+# we'd spend several times as long compressing for a few percent smaller output
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# A gzip header with no file name or timestamp, and the empty final deflate block which
+# ends a stream
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+FINAL_BLOCK = b"\x03\x00"
+GZIP_TRAILER = struct.Struct("<II")
+
+# The CRC-32 polynomial, bit-reversed as zlib uses it
+CRC32_POLYNOMIAL = 0xEDB88320
+
+# The encodings of the files written by `compress_file`, and their file extensions
+FILE_ENCODINGS = {"br": "br", "gzip": "gz"}
+
+
+class GzipWriter:
+    """
+    Write gzip data to `file`, in a form that `GzipSplicer` can splice into another stream
+
+    The data is flushed to a byte boundary before the final block, so everything between
+    the header and the final block can be copied as it is.  It's still a valid gzip file.
+
+    Nothing is written to `file` until the first call to `write` or `finish`, so it's
+    safe to create a GzipWriter in one process and write with it in another.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self._compressor = _deflater()
+        self._crc = 0
+        self._size = 0
+        self._started = False
+
+    def write(self, data):
+        self._start()
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self.file.write(self._compressor.compress(data))
+
+    def finish(self):
+        self._start()
+        self.file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.file.write(FINAL_BLOCK)
+        self.file.write(GZIP_TRAILER.pack(self._crc, self._size & 0xFFFFFFFF))
+        self.file.flush()
+
+    def _start(self):
+        if not self._started:
+            self._started = True
+            self.file.write(GZIP_HEADER)
+
+
+class GzipSplicer:
+    """
+    Build a gzip stream from text, compressed as we go, and files written by `GzipWriter`
+
+    Each method returns (or yields) the next part of the stream; `finish` must be called
+    last to end it.
+    """
+
+    def __init__(self):
+        self._crc = 0
+        self._size = 0
+        self._started = False
+
+    def compress(self, data):
+        # Each part gets a compressor of its own, so that nothing refers back past a
+        # spliced file
+        compressor = _deflater()
+        output = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._add(zlib.crc32(data), len(data))
+        return self._header() + output
+
+    def splice(self, file, chunk_size=64 * 1024):
+        """Yield the compressed data from the gzip `file`, ready to add to the stream"""
+        file.seek(-GZIP_TRAILER.size, os.SEEK_END)
+        crc, size = GZIP_TRAILER.unpack(file.read(GZIP_TRAILER.size))
+        end = file.tell() - GZIP_TRAILER.size - len(FINAL_BLOCK)
+
+        file.seek(len(GZIP_HEADER))
+        self._add(crc, size)
+
+        yield self._header()
+        remaining = end - file.tell()
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            remaining -= len(chunk)
+            yield chunk
+
+    def finish(self):
+        return (
+            self._header()
+            + FINAL_BLOCK
+            + GZIP_TRAILER.pack(self._crc, self._size & 0xFFFFFFFF)
+        )
+
+    def _header(self):
+        if self._started:
+            return b""
+        self._started = True
+        return GZIP_HEADER
+
+    def _add(self, crc, size):
+        self._crc = crc32_combine(self._crc, crc, size)
+        self._size += size
+
+
+def _deflater():
+    # negative window bits give us raw deflate data, without a zlib header
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+
+def crc32_combine(crc1, crc2, length2):
+    """
+    Return the CRC-32 of two pieces of data joined together, from the CRC-32 of each and
+    the length of the second
+
+    This is zlib's crc32_combine(), which Python's zlib module doesn't expose: appending
+    `length2` bytes multiplies the first CRC by x^(8 * length2) modulo the polynomial.
+    """
+    return _multiply(_x_to_power(8 * length2), crc1) ^ crc2
+
+
+def _multiply(a, b):
+    """Multiply the polynomials `a` and `b` modulo the CRC-32 polynomial"""
+    product = 0
+    mask = 1 << 31
+    while a:
+        if a & mask:
+            product ^= b
+            a ^= mask
+        mask >>= 1
+        b = (b >> 1) ^ CRC32_POLYNOMIAL if b & 1 else b >> 1
+    return product
+
+
+def _x_to_power(n):
+    """Return x^n modulo the CRC-32 polynomial"""
+    result = 1 << 31  # x^0
+    square = 1 << 30  # x^1
+    while n:
+        if n & 1:
+            result = _multiply(square, result)
+        square = _multiply(square, square)
+        n >>= 1
+    return result
+
+
+def compress_file(source, path):
+    """
+    Write brotli and gzip compressed copies of the file `source`, to be stored alongside
+    it at `path`
+
+    The copies are named with the encoding's file extension added (`data.json.br`).
+    """
+    path = Path(path)
+    compressors = {"br": _compress_brotli, "gzip": _compress_gzip}
+    for encoding, extension in FILE_ENCODINGS.items():
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with open(source, "rb") as f, open(fd, "wb") as destination:
+                compressors[encoding](f, destination)
+            os.replace(tmp_path, f"{path}.{extension}")
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def _compress_brotli(source, destination, chunk_size=64 * 1024):
+    compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+    for chunk in iter(lambda: source.read(chunk_size), b""):
+        destination.write(compressor.process(chunk))
+    destination.write(compressor.finish())
+
+
+def _compress_gzip(source, destination, chunk_size=64 * 1024):
+    writer = GzipWriter(destination)
+    for chunk in iter(lambda: source.read(chunk_size), b""):
+        writer.write(chunk)
+    writer.finish()
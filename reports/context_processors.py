@@ -1,7 +1,10 @@
-from .models import Category
+from django.conf import settings
+
+from . import navigation
 
 
 def reports(request):
     return {
-        "categories": Category.populated.for_user(request.user),
+        "categories": navigation.categories_for_user(request.user),
+        "lazy_sidebar": settings.LAZY_SIDEBAR,
     }
@@ -0,0 +1,78 @@
+"""
+Counts of what our caches and stores have done, totalled across all of our workers
+
+The totals are kept in the default cache, which is the database, so counting each hit or
+miss there as it happened took two queries for every lookup.  Instead, each process
+counts in memory, and adds its counts to the totals every `interval` seconds, and
+whenever the totals are read.
+"""
+import threading
+import time
+
+from django.core.cache import caches
+
+
+# Each process has one Counter for each prefix, however many instances of a cache or a
+# store it makes
+_counters = {}
+_lock = threading.Lock()
+
+
+def get_counter(prefix, names, interval):
+    """
+    This process's Counter of `names`, kept in the default cache under `prefix`, which
+    adds to the totals every `interval` seconds as given by the first to ask for it
+    """
+    with _lock:
+        counter = _counters.get(prefix)
+        if counter is None:
+            counter = _counters[prefix] = Counter(prefix, names, interval)
+        return counter
+
+
+def reset():
+    """Forget the counts that this process hasn't added to the totals yet"""
+    with _lock:
+        _counters.clear()
+
+
+class Counter:
+    """
+    Counts of `names` in this process, which are added to the totals in the default cache
+    every `interval` seconds
+    """
+
+    def __init__(self, prefix, names, interval):
+        self.prefix = prefix
+        self.names = tuple(names)
+        self.interval = interval
+        self.counts = dict.fromkeys(self.names, 0)
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+        if time.monotonic() - self.flushed_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts = {name: count for name, count in self.counts.items() if count}
+            self.counts = dict.fromkeys(self.names, 0)
+            self.flushed_at = time.monotonic()
+        cache = caches["default"]
+        for name, count in counts.items():
+            key = self._key(name)
+            cache.add(key, 0, timeout=None)
+            cache.incr(key, count)
+
+    def totals(self):
+        """The totals across all processes, including this one's counts so far"""
+        self.flush()
+        cache = caches["default"]
+        totals = cache.get_many([self._key(name) for name in self.names])
+        return {name: totals.get(self._key(name), 0) for name in self.names}
+
+    def _key(self, name):
+        return f"{self.prefix}:{name}"
@@ -0,0 +1,717 @@
+"""
+Content-addressed stores for rendered report fragments and the files extracted from them
+
+Rendering a report is expensive, but most of the time that a report's cache token is
+refreshed (a front-matter or Link edit, a forced cache update) the HTML file it's
+rendered from hasn't changed.  We store the rendered output on disk under a hash of the
+upstream HTML (and the renderer version), so that we only need to re-render when the
+content itself changes.  Each fragment is also stored gzipped, so that it can be served
+compressed without compressing it for every request (see compression.py).
+
+The output of each notebook cell is stored too, so that when a report is re-released with
+only a few cells changed, only those cells are rendered again.
+
+Images and table data are stored under a hash of their own content, so a figure that is
+unchanged between releases of a report is only stored once and can be cached by browsers
+forever.  Each fragment records the names of the images and tables it refers to, and
+once fragments have been evicted, those that no stored fragment refers to any more are
+removed (see `collect_content`).
+"""
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+
+import structlog
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from . import counters, locks
+from .compression import FILE_ENCODINGS, GzipWriter, compress_file
+from .rendering import RENDERER_VERSION, stream_html
+from .workers import run_render
+
+
+logger = structlog.getLogger()
+
+FRAGMENT_PLACEHOLDER = "<!-- report-fragment:{} -->"
+
+# The fields of a Report that record what we last rendered it from
+SOURCE_FIELDS = [
+    "fragment_key",
+    "source_checked_at",
+    "source_etag",
+    "source_last_modified",
+    "source_sha",
+]
+
+_fragment_placeholders = re.compile(r"<!-- report-fragment:([0-9a-f]{64}) -->")
+
+# The names of files in a ContentStore, as they appear in the URLs that rendered HTML
+# refers to them by, and how much of the end of one piece of HTML we look at again with the
+# next, in case a name is split between them
+_content_names = re.compile(r"\b[0-9a-f]{64}\.[a-z]+\b")
+_CONTENT_NAME_OVERLAP = 80
+
+
+class FragmentStore:
+    """
+    Rendered fragments, stored as files named by their key
+
+    Attributes:
+        location (Path): directory to store fragments in
+        max_size (int): total size in bytes of stored fragments, above which the least
+        recently used fragments are evicted
+    """
+
+    counters = ("hits", "misses", "evictions")
+
+    def __init__(self, location, max_size):
+        self.location = Path(location)
+        self.max_size = max_size
+        # counted by each process, and added to the totals every STATS_INTERVAL seconds
+        self.counts = counters.get_counter(
+            "fragment_store", self.counters, settings.STATS_INTERVAL
+        )
+
+    def path(self, key):
+        return self.location / key[:2] / f"{key}.html"
+
+    def compressed_path(self, key):
+        return self.location / key[:2] / f"{key}.html.gz"
+
+    def references_path(self, key):
+        return self.location / key[:2] / f"{key}.html.refs"
+
+    def get(self, key):
+        """Return the stored fragment for `key`, or None if we don't have it"""
+        file = self.open_fragment(key)
+        if file is None:
+            return None
+        with file:
+            return file.read().decode("utf-8")
+
+    def open_fragment(self, key, compressed=False):
+        """
+        Open the stored fragment for `key` (or its gzipped copy, if `compressed`) as a
+        binary file, or return None if we don't have it
+        """
+        path = self.path(key)
+        try:
+            file = (self.compressed_path(key) if compressed else path).open("rb")
+        except FileNotFoundError:
+            self.counts.count("misses")
+            return None
+
+        try:
+            # mark as recently used, for eviction
+            os.utime(path)
+        except FileNotFoundError:  # pragma: no cover
+            # evicted by another process since we opened it, which is fine, as we have it
+            # open
+            pass
+        self.counts.count("hits")
+        return file
+
+    @contextmanager
+    def writer(self, key):
+        """
+        Open a fragment for writing, along with a gzipped copy of it and a list of the
+        stored files it refers to (see `FragmentWriter`)
+
+        The fragment is written to temporary files, which are moved into place once they
+        are complete, so other processes never see a partially written fragment.
+        """
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        compressed_fd, compressed_tmp_path = tempfile.mkstemp(
+            dir=path.parent, suffix=".tmp"
+        )
+        references_fd, references_tmp_path = tempfile.mkstemp(
+            dir=path.parent, suffix=".tmp"
+        )
+        try:
+            with open(fd, "wb") as f, open(compressed_fd, "wb") as compressed_f, open(
+                references_fd, "w", encoding="utf-8"
+            ) as references_f:
+                yield FragmentWriter(f, compressed_f, references_f)
+            # the fragment goes last, so that the others are there whenever it is
+            os.replace(references_tmp_path, self.references_path(key))
+            os.replace(compressed_tmp_path, self.compressed_path(key))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            os.unlink(compressed_tmp_path)
+            os.unlink(references_tmp_path)
+            raise
+
+    def evict(self):
+        """Remove the least recently used fragments until we're within max_size"""
+        fragments = []
+        for path in self.location.glob("*/*.html"):
+            try:
+                stat = path.stat()
+                size = stat.st_size + self.compressed_path(path.stem).stat().st_size
+            except FileNotFoundError:  # pragma: no cover
+                # evicted by another process
+                continue
+            fragments.append((stat.st_mtime, size, path))
+
+        evicted = 0
+        for path in least_recently_used(fragments, self.max_size):
+            path.unlink(missing_ok=True)
+            self.compressed_path(path.stem).unlink(missing_ok=True)
+            self.references_path(path.stem).unlink(missing_ok=True)
+            self.counts.count("evictions")
+            evicted += 1
+            logger.info("Evicted rendered fragment", key=path.stem)
+        return evicted
+
+    def references(self):
+        """The names of the stored files (see `ContentStore`) that stored fragments refer to"""
+        names = set()
+        for path in self.location.glob("*/*.html"):
+            names.update(self._references(path.stem))
+        return names
+
+    def _references(self, key):
+        try:
+            return self.references_path(key).read_text(encoding="utf-8").split()
+        except FileNotFoundError:
+            pass
+        # stored before we recorded what fragments refer to, so we find out, and record it
+        # for next time
+        references = ContentReferences()
+        try:
+            with self.path(key).open(encoding="utf-8") as f:
+                for chunk in iter(partial(f.read, settings.RENDER_BUFFER_SIZE), ""):
+                    references.write(chunk)
+        except FileNotFoundError:  # pragma: no cover
+            # evicted by another process
+            return []
+        fd, tmp_path = tempfile.mkstemp(dir=self.path(key).parent, suffix=".tmp")
+        with open(fd, "w", encoding="utf-8") as f:
+            references.save(f)
+        os.replace(tmp_path, self.references_path(key))
+        if not self.path(key).exists():  # pragma: no cover
+            # evicted by another process while we were reading it
+            self.references_path(key).unlink(missing_ok=True)
+        return references.names
+
+    def stats(self):
+        paths = list(self.location.glob("*/*.html"))
+        sizes = [path.stat().st_size for path in self.location.glob("*/*.html*")]
+        return {
+            **self.counts.totals(),
+            "count": len(paths),
+            "size": sum(sizes),
+        }
+
+
+class FragmentWriter:
+    """
+    Writes a rendered fragment, a gzipped copy of it for serving to clients that accept
+    gzip (see compression.py), and the names of the stored files it refers to
+
+    `finish` must be called once everything has been written, by the same process that
+    wrote it.
+    """
+
+    def __init__(self, file, compressed_file, references_file):
+        self.file = file
+        self.gzip = GzipWriter(compressed_file)
+        self.references_file = references_file
+        self.references = ContentReferences()
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.file.write(data)
+        self.gzip.write(data)
+        self.references.write(text)
+
+    def finish(self):
+        self.file.flush()
+        self.gzip.finish()
+        self.references.save(self.references_file)
+        self.references_file.flush()
+
+
+class ContentReferences:
+    """The names of the stored files (see `ContentStore`) that HTML written to it refers to"""
+
+    def __init__(self):
+        self.names = set()
+        self._tail = ""
+
+    def write(self, text):
+        text = self._tail + text
+        self.names.update(_content_names.findall(text))
+        self._tail = text[-_CONTENT_NAME_OVERLAP:]
+
+    def save(self, file):
+        file.write("".join(f"{name}\n" for name in sorted(self.names)))
+
+
+class CellStore:
+    """
+    The rendered output of notebook cells, stored as files named by their key, so that
+    cells which are unchanged when a report is re-released aren't rendered again (see
+    `rendering.CellFeed`)
+
+    Cells are stored from the render's child process, so unlike FragmentStore we don't
+    keep counts in the cache.
+
+    Files that a cell refers to may have been removed since it was stored (see
+    `collect_content`), in which case it's rendered again, which stores them again.
+
+    Attributes:
+        location (Path): directory to store cells in
+        max_size (int): total size in bytes of stored cells, above which the least
+        recently used cells are evicted
+        content_stores (list): the ContentStores of files that cells may refer to
+    """
+
+    def __init__(self, location, max_size, content_stores=()):
+        self.location = Path(location)
+        self.max_size = max_size
+        self.content_stores = content_stores
+
+    def path(self, key):
+        return self.location / key[:2] / f"{key}.html"
+
+    def get(self, key):
+        """Return the stored (html, image count, cell count) for `key`, or None"""
+        path = self.path(key)
+        try:
+            counts, html = path.read_text(encoding="utf-8").split("\n", 1)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        if not self._has_content(html):
+            return None
+        image_count, cell_count = counts.split()
+        return html, int(image_count), int(cell_count)
+
+    def _has_content(self, html):
+        # marking what it refers to as recently used, so that it isn't removed before the
+        # fragment that we're rendering it into is stored
+        for name in set(_content_names.findall(html)):
+            extension = name.rsplit(".", 1)[-1]
+            for store in self.content_stores:
+                if extension in store.content_types and not store.touch(name):
+                    return False
+        return True
+
+    def save(self, key, html, image_count, cell_count):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with open(fd, "w", encoding="utf-8") as f:
+            f.write(f"{image_count} {cell_count}\n{html}")
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Remove the least recently used cells until we're within max_size"""
+        cells = []
+        for path in self.location.glob("*/*.html"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # pragma: no cover
+                # evicted by another process
+                continue
+            cells.append((stat.st_mtime, stat.st_size, path))
+
+        evicted = 0
+        for path in least_recently_used(cells, self.max_size):
+            path.unlink(missing_ok=True)
+            evicted += 1
+        if evicted:
+            logger.info("Evicted rendered cells", count=evicted)
+
+
+def least_recently_used(files, max_size):
+    """
+    Yield the paths of the least recently used of `files`, a list of (mtime, size, path),
+    until what's left is within `max_size` bytes
+    """
+    total_size = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total_size <= max_size:
+            break
+        total_size -= size
+        yield path
+
+
+class DiskUsage:
+    """
+    An estimate of the total size of the files in a directory: what it was when we last
+    looked, plus what this process has written since (counting a file that replaced
+    another as if it hadn't)
+
+    Looking at every file to find out is only worth it once there might be too many, so
+    we look again once the estimate is over `max_size`, or every `interval` seconds, to
+    catch up with what other processes have written.
+    """
+
+    def __init__(self, max_size, interval):
+        self.max_size = max_size
+        self.interval = interval
+        # unknown until we first look
+        self.size = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        """Add the size of a file we've written, and return whether it's time to look"""
+        with self.lock:
+            if self.size is None:
+                return True
+            self.size += size
+            return (
+                self.size > self.max_size
+                or time.monotonic() - self.checked_at >= self.interval
+            )
+
+    def checked(self, size):
+        """Record that we've looked, and found `size` bytes of files"""
+        with self.lock:
+            self.size = size
+            self.checked_at = time.monotonic()
+
+
+class ContentStore:
+    """
+    Files extracted from reports, stored under names made from the hash of their content
+
+    Stored files are removed once no stored fragment refers to them (see `collect`).
+
+    Attributes:
+        location (Path): directory to store files in
+    """
+
+    # the name of the URL that serves stored files, and the types of file it serves
+    url_name = None
+    content_types = {}
+    # whether to store compressed copies of files, for clients that accept them (see
+    # compression.compress_file)
+    precompress = False
+
+    def __init__(self, location):
+        self.location = Path(location)
+
+    def path(self, name):
+        return self.location / name
+
+    def url(self, name):
+        return reverse(self.url_name, args=(name,))
+
+    def save(self, data, extension):
+        """Store `data` if we don't already have it, and return its URL"""
+        name = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+        path = self.path(name)
+        if not self.touch(name):
+            self.location.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.location, suffix=".tmp")
+            with open(fd, "wb") as f:
+                f.write(data)
+            self._store(tmp_path, path)
+        return self.url(name)
+
+    def touch(self, name):
+        """
+        Mark the stored file `name` as recently used, so that it isn't removed before a
+        fragment that refers to it is stored, and return whether we have it
+        """
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def collect(self, referenced):
+        """
+        Remove the stored files whose names aren't in `referenced`, along with their
+        compressed copies
+
+        Files that were stored or used by a render that could still be running (see
+        RENDER_TIMEOUT) are kept, as the fragment that refers to them may not be stored
+        yet.
+        """
+        cutoff = time.time() - settings.RENDER_TIMEOUT
+        removed = 0
+        for path in self.location.glob("*"):
+            name = self._stored_name(path.name)
+            if name in referenced:
+                continue
+            try:
+                # a compressed copy goes with the file it's a copy of
+                if self.path(name).stat().st_mtime > cutoff:
+                    continue
+            except FileNotFoundError:
+                if name == path.name:  # pragma: no cover
+                    # removed by another process
+                    continue
+            path.unlink(missing_ok=True)
+            removed += 1
+        if removed:
+            logger.info(
+                "Removed unreferenced files", location=str(self.location), count=removed
+            )
+        return removed
+
+    def _stored_name(self, name):
+        """The name of the stored file that the file `name` is, or is a compressed copy of"""
+        if self.precompress:
+            for extension in FILE_ENCODINGS.values():
+                if name.endswith(f".{extension}"):
+                    return name.removesuffix(f".{extension}")
+        return name
+
+    def _store(self, tmp_path, path):
+        try:
+            if self.precompress:
+                compress_file(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        # the compressed copies go first, so that they're there whenever the file is
+        os.replace(tmp_path, path)
+
+    def writer(self, extension):
+        """
+        Open a file to write text to a piece at a time, which is stored once it's complete
+
+        Use it as a context manager; its `url` is set once it has been stored.
+        """
+        return ContentWriter(self, extension)
+
+
+class ContentWriter:
+    def __init__(self, store, extension):
+        self.store = store
+        self.extension = extension
+        self.url = None
+
+    def __enter__(self):
+        self.store.location.mkdir(parents=True, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=self.store.location, suffix=".tmp")
+        self._file = open(fd, "w", encoding="utf-8")
+        self._digest = hashlib.sha256()
+        return self
+
+    def write(self, text):
+        self._digest.update(text.encode("utf-8"))
+        self._file.write(text)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if exc_type is not None:
+            os.unlink(self._tmp_path)
+            return
+        name = f"{self._digest.hexdigest()}.{self.extension}"
+        path = self.store.path(name)
+        if self.store.touch(name):
+            # we've stored this already
+            os.unlink(self._tmp_path)
+        else:
+            self.store._store(self._tmp_path, path)
+        self.url = self.store.url(name)
+
+
+class ImageStore(ContentStore):
+    """Images extracted from reports (see `HTMLRenderer._extract_image`)"""
+
+    url_name = "report_image"
+    content_types = {
+        "gif": "image/gif",
+        "jpeg": "image/jpeg",
+        "jpg": "image/jpeg",
+        "png": "image/png",
+        "webp": "image/webp",
+    }
+
+
+class TableStore(ContentStore):
+    """The data from large tables extracted from reports (see `TableCapture`)"""
+
+    url_name = "report_table"
+    content_types = {"json": "application/json"}
+    precompress = True
+
+
+def get_fragment_store():
+    return FragmentStore(settings.FRAGMENT_STORE_DIR, settings.FRAGMENT_STORE_MAX_SIZE)
+
+
+def get_cell_store():
+    return CellStore(
+        settings.CELL_STORE_DIR,
+        settings.CELL_STORE_MAX_SIZE,
+        content_stores=[get_image_store(), get_table_store()],
+    )
+
+
+def get_image_store():
+    return ImageStore(settings.REPORT_IMAGES_DIR)
+
+
+def get_table_store():
+    return TableStore(settings.REPORT_TABLES_DIR)
+
+
+def fragment_placeholder(key):
+    """
+    A placeholder for the stored fragment `key`, to be replaced with the fragment itself
+    when a page is served (see `split_placeholders`)
+
+    Cached pages refer to fragments like this rather than including them, so that they
+    can be served from the store, either as they are or already gzipped.
+    """
+    return mark_safe(FRAGMENT_PLACEHOLDER.format(key))
+
+
+def split_placeholders(html):
+    """
+    Split `html` at its fragment placeholders, returning a list of the text around them,
+    with the fragments' keys in between
+    """
+    return _fragment_placeholders.split(html)
+
+
+def store_fragment(chunks, store=None):
+    """
+    Render report HTML from `chunks` of text, unless we've already rendered this content,
+    and return the key of its stored fragment
+
+    We need to have seen all of the content to know its hash, so it's spooled (to disk,
+    if it's large) while we hash it, and then only rendered if it's not in the store.
+
+    Rendering happens in a child process (see workers.py), and raises a RenderError if
+    it fails or goes over its time or memory budget.
+    """
+    store = store or get_fragment_store()
+    buffer_size = settings.RENDER_BUFFER_SIZE
+
+    digest = hashlib.sha256(RENDERER_VERSION.encode())
+    with tempfile.SpooledTemporaryFile(
+        max_size=buffer_size, mode="w+", encoding="utf-8"
+    ) as spool:
+        for chunk in chunks:
+            digest.update(chunk.encode("utf-8"))
+            spool.write(chunk)
+        key = digest.hexdigest()
+
+        stored = store.open_fragment(key)
+        if stored is not None:
+            stored.close()
+            return key
+
+        logger.info("Rendering report fragment", key=key)
+        spool.seek(0)
+        # The fragment files are opened here rather than in the child process, so that
+        # they're cleaned up if the child doesn't finish
+        with store.writer(key) as sink:
+            run_render(partial(_render, spool, sink, buffer_size))
+
+    if store.evict():
+        collect_content(store)
+    get_cell_store().evict()
+    return key
+
+
+def collect_content(store=None):
+    """
+    Remove the images and tables that no fragment in `store` refers to any more
+
+    Images and tables are only stored once, however many fragments refer to them, so they
+    can't be evicted along with fragments.  Instead, this is run once fragments have been
+    evicted.
+    """
+    store = store or get_fragment_store()
+    referenced = store.references()
+    get_image_store().collect(referenced)
+    get_table_store().collect(referenced)
+
+
+def store_report_fragment(remote, store=None):
+    """
+    Render the HTML of a report from its `remote` (a GithubReport or JobServerReport),
+    and return the key of its stored fragment
+
+    If the report file hasn't changed since we last rendered it, and the fragment we
+    rendered is still stored, we don't fetch the file again.  Otherwise, the remote
+    records what identifies the version that we fetch, so that next time we can ask
+    whether it's changed (see `is_modified` on each remote).
+
+    Afterwards, `report.last_updated` is up to date, without asking the remote again.
+    """
+    store = store or get_fragment_store()
+    report = remote.report
+    if report.pk is None:
+        return _store_report_fragment(remote, store)
+
+    # Only one worker checks and renders a report at once (see locks.py), so that only one
+    # of them asks the upstream about it. If another is already doing so, we wait (briefly)
+    # for it and use what it stored. We never render it ourselves after waiting, as the
+    # wait and the render together could take longer than the web worker is allowed, so
+    # if it's taking too long, or it failed, LockTimeout is raised and the user is told
+    # that the report is being refreshed.
+    lock = f"render-report:{report.pk}"
+    token = locks.acquire(lock)
+    if token is not None:
+        try:
+            return _store_report_fragment(remote, store)
+        finally:
+            locks.release(lock, token)
+
+    logger.info("Waiting for report to be rendered", report_id=report.pk)
+    checked_at = report.source_checked_at
+    locks.wait(lock)
+    latest = (
+        type(report).objects.values(*SOURCE_FIELDS, "last_updated").get(pk=report.pk)
+    )
+    key = latest["fragment_key"]
+    if (
+        latest["source_checked_at"] == checked_at
+        or not key
+        or not store.path(key).exists()
+    ):
+        raise locks.LockTimeout(lock)
+    for field, value in latest.items():
+        setattr(report, field, value)
+    return key
+
+
+def _store_report_fragment(remote, store):
+    key = remote.report.fragment_key
+    if key and store.path(key).exists() and not remote.is_modified():
+        logger.info("Report file not modified", key=key)
+        remote.report.record_source(source_checked_at=timezone.now())
+        return key
+
+    checked_at = timezone.now()
+    key = store_fragment(remote.iter_html(), store)
+    remote.report.record_source(
+        fragment_key=key, source_checked_at=checked_at, **remote.validators
+    )
+    return key
+
+
+def _render(spool, sink, buffer_size):
+    stream_html(
+        iter(partial(spool.read, buffer_size), ""),
+        sink,
+        images=get_image_store(),
+        tables=get_table_store(),
+        cells=get_cell_store(),
+    )
+    # the child process exits without flushing its open files
+    sink.finish()
@@ -1,4 +1,15 @@
-from osgithub import GithubClient
+from base64 import b64decode
+from codecs import getincrementaldecoder
+
+from django.conf import settings
+from furl import furl
+from osgithub import GithubContentFile
+
+from .http import get_github_client, get_session
+
+
+# Asks the contents API for a file's content as it is, rather than base64 encoded in JSON
+RAW_MEDIA_TYPE = "application/vnd.github.raw"
 
 
 class GithubReport:
@@ -8,10 +19,18 @@ class GithubReport:
     """
 
     def __init__(self, report, repo=None, use_cache=True):
-        self.client = GithubClient(use_cache=use_cache)
+        self.client = get_github_client(use_cache)
         self.report = report
         self._repo = repo
+        self._file = None
         self._fetched_html = None
+        self._modified = None
+        # the blob SHA of the file, and the ETag of the listing of the folder it's in, if
+        # we've asked whether it's changed and it has
+        self._latest = None
+        # what identifies the version of the file we've fetched, to be recorded once it's
+        # rendered (see fragments.store_report_fragment)
+        self.validators = {}
 
     @property
     def repo(self):
@@ -19,6 +38,11 @@ class GithubReport:
             self._repo = self.client.get_repo("opensafely", self.report.repo)
         return self._repo
 
+    @property
+    def upstream(self):
+        """The host we fetch the report from (see circuits.py)"""
+        return furl(self.client.base_url).host
+
     def file_exists(self):
         if (
             self.repo.get_matching_file_from_parent_contents(
@@ -34,27 +58,30 @@ class GithubReport:
             self.report.report_html_file_path, self.report.branch
         )
 
-    def get_html(self):
+    def get_file(self):
         """
-        Fetches a report html file (an exported jupyter notebook) from a github repo based
-        on `report`, a Report model instance.
+        Fetches the GithubContentFile for a report html file (an exported jupyter notebook)
+        from a github repo based on `report`, a Report model instance.
+
+        The contents API only includes the content of files up to 1MB.  For a larger file,
+        we remember that it's too large (`Report.use_git_blob`), and the GithubContentFile
+        has no content; the file is streamed in its raw form instead (see `open_raw`).
         """
-        if self._fetched_html is None:
+        if self._file is None:
+            path = self.report.report_html_file_path
+            ref = self.report.branch
             if self.report.use_git_blob:
-                file = self.repo.get_contents(
-                    self.report.report_html_file_path,
-                    self.report.branch,
-                    from_git_blob=True,
-                )
+                name = path.rsplit("/", 1)[-1]
+                sha = self._latest[0] if self._latest else ""
+                file = GithubContentFile(name, None, None, sha)
             else:
-                file, fetch_type = self.repo.get_contents(
-                    self.report.report_html_file_path,
-                    ref=self.report.branch,
-                    return_fetch_type=True,
-                )
-                if fetch_type == "blob":
+                contents = self.repo.client.get_json(self._contents_path(), ref=ref)
+                file = GithubContentFile.from_json(contents)
+                if not file.content:
+                    file.content = None
                     self.report.use_git_blob = True
                     self.report.save()
+            file.last_updated = self.repo.get_last_updated(path, ref)
 
             # convert to a date for Report.last_updated
             github_last_updated = file.last_updated.date()
@@ -62,17 +89,177 @@ class GithubReport:
                 self.report.last_updated = github_last_updated
                 self.report.save()
 
-            self._fetched_html = file.decoded_content
+            self._file = file
+            self._record_sha(file.sha)
+        return self._file
+
+    def open_raw(self):
+        """
+        Requests a report html file in its raw form, without reading its body, so that it
+        can be read incrementally with `iter_content()`
+
+        This skips the base64 encoding of the contents and blob APIs, so there's less to
+        transfer and nothing to decode.  It's always made without request caching, as the
+        requests cache doesn't tell this apart from a contents API request for the same
+        file, and we store what we render from it anyway (see fragments.py).
+        """
+        url = furl(self.client.base_url)
+        url.path.segments += self._contents_path()
+        response = get_session(use_cache=False).get(
+            url.url,
+            params={"ref": self.report.branch},
+            headers={**self.client.headers, "Accept": RAW_MEDIA_TYPE},
+            stream=True,
+        )
+        response.raise_for_status()
+        # GitHub gives the blob SHA as the ETag of a raw file
+        etag = response.headers.get("ETag", "").strip('"')
+        if _is_sha(etag):
+            self._record_sha(etag)
+        return response
+
+    def is_modified(self):
+        """
+        Has the report file changed since we last rendered it?
+
+        Rather than fetching the file, we list the folder it's in, which gives each file's
+        blob SHA but not its content, and compare the file's SHA with the one we rendered.
+        The listing is asked for conditionally on its ETag, so if nothing in the folder has
+        changed we get a 304 (Not Modified), which doesn't count towards our rate limit.
+        """
+        if self._modified is None:
+            self._modified = self._check_modified()
+        return self._modified
+
+    def _check_modified(self):
+        if not self.report.source_sha:
+            return True
+
+        headers = dict(self.client.headers)
+        if self.report.source_etag:
+            headers["If-None-Match"] = self.report.source_etag
+        # the contents of the folder that the file is in
+        response = self.client.get(
+            self._contents_path()[:-1], headers, ref=self.report.branch
+        )
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+
+        name = self._contents_path()[-1]
+        sha = next(
+            (entry["sha"] for entry in response.json() if entry["name"] == name), None
+        )
+        etag = response.headers.get("ETag", "")
+        if sha != self.report.source_sha:
+            self._latest = (sha, etag)
+            return True
+        if etag != self.report.source_etag:
+            self.report.record_source(source_etag=etag)
+        return False
+
+    def _contents_path(self):
+        return [
+            "repos",
+            "opensafely",
+            self.report.repo,
+            "contents",
+            *self.report.report_html_file_path.split("/"),
+        ]
+
+    def _record_sha(self, sha):
+        self.validators = {"source_sha": sha or ""}
+        if self._latest is not None and self._latest[0] == sha:
+            # the ETag of the folder listing we were given when we asked whether the file
+            # had changed
+            self.validators["source_etag"] = self._latest[1]
+
+    def get_html(self):
+        """
+        Fetches a report html file (an exported jupyter notebook) from a github repo based
+        on `report`, a Report model instance.
+        """
+        if self._fetched_html is None:
+            file = self.get_file()
+            if file.content is None:
+                self._fetched_html = "".join(self.iter_html())
+            else:
+                self._fetched_html = file.decoded_content
         return self._fetched_html
 
+    def iter_html(self, chunk_size=None):
+        """
+        Yields the report html in chunks, decoding it as we go rather than holding a
+        decoded copy of the whole file alongside the encoded one
+
+        Files too large for the contents API are streamed from GitHub as they're read.
+        """
+        if self._fetched_html is not None:
+            yield self._fetched_html
+            return
+
+        chunk_size = chunk_size or settings.RENDER_BUFFER_SIZE
+        file = self.get_file()
+        if file.content is not None:
+            yield from iter_base64_decoded(file.content, chunk_size)
+            return
+
+        response = self.open_raw()
+        response.encoding = "utf-8"
+        yield from response.iter_content(chunk_size, decode_unicode=True)
+
     def last_updated(self):
         """
         Return the last updated date separately to the fully processed HTML
+
+        If the file hasn't changed since we last rendered it, its last updated date
+        hasn't either, so we don't fetch it.
         """
-        self.get_html()
+        if not self.is_modified():
+            return self.report.last_updated
+        self.get_file()
         # last_updated is the only field on a Report instance that is retrieved from GitHub (rather
         # than being entered manually in the Report admin). As it is rendered in the template before
         # the processed html content, we need to be have refreshed the fetched GitHub data at the
         # point that the field it rendered, otherwise the pre-fetched (possibly stale) date will be
         # rendered and cached in the template.
         return self.report.last_updated
+
+
+def get_blob_shas(repo, branch):
+    """
+    Return the blob SHAs of the files in a branch of one of our repos, by path, from a
+    single request for its tree
+
+    GitHub truncates the trees of very large repos, in which case we return None.
+    """
+    tree = get_github_client(use_cache=False).get_json(
+        ["repos", "opensafely", repo, "git", "trees", branch], recursive=1
+    )
+    if tree.get("truncated"):
+        return None
+    return {
+        entry["path"]: entry["sha"] for entry in tree["tree"] if entry["type"] == "blob"
+    }
+
+
+def iter_base64_decoded(content, chunk_size):
+    """
+    Decodes base64-encoded utf-8 `content` into chunks of text
+
+    GitHub splits its base64 content over lines, so we strip out the newlines from each
+    chunk and carry over any incomplete 4-character group into the next one.
+    """
+    decoder = getincrementaldecoder("utf-8")()
+    remainder = ""
+    for start in range(0, len(content), chunk_size):
+        end = start + chunk_size
+        encoded = remainder + content[start:end].replace("\n", "")
+        complete = len(encoded) - len(encoded) % 4
+        encoded, remainder = encoded[:complete], encoded[complete:]
+        yield decoder.decode(b64decode(encoded))
+    yield decoder.decode(b64decode(remainder), final=True)
+
+
+def _is_sha(value):
+    return len(value) == 40 and all(c in "0123456789abcdef" for c in value)
@@ -0,0 +1,102 @@
+"""
+HTTP sessions for fetching reports from GitHub and job-server, shared across a process
+
+Every report we fetch used to get its own session, so every fetch paid for a new
+connection (and TLS handshake) and, with caching, a new connection to the requests
+cache database.  Instead each process keeps one session with caching and one without,
+and the clients for both remotes use them, so connections to each host are kept alive
+and reused.
+
+The sessions are shared between a worker's threads: requests' connection pools are
+thread-safe, and the response cache is files that are replaced as a whole.  So
+nothing that can differ between callers (such as an auth token) is set on a session;
+it's passed with each request instead.
+"""
+import os
+import threading
+
+import requests
+import requests_cache
+from django.conf import settings
+from osgithub import GithubClient
+
+from .circuits import CircuitBreakerAdapter
+from .http_cache import ResponseCache
+
+
+_lock = threading.Lock()
+_sessions = {}
+_github_clients = {}
+
+
+def get_session(use_cache=False):
+    """
+    Return this process's session, with or without request caching
+
+    Cached responses never expire; a report's cached responses are cleared when it
+    changes (see `Report.refresh_cache_token`), and the least recently used are evicted
+    when the cache is full (see http_cache.py).
+    """
+    session = _sessions.get(use_cache)
+    if session is not None:
+        return session
+    with _lock:
+        if use_cache not in _sessions:
+            _sessions[use_cache] = _make_session(use_cache)
+        return _sessions[use_cache]
+
+
+def get_github_client(use_cache=False):
+    """Return this process's GithubClient, using the shared session"""
+    client = _github_clients.get(use_cache)
+    if client is not None:
+        return client
+    session = get_session(use_cache)
+    with _lock:
+        if use_cache not in _github_clients:
+            client = GithubClient()
+            client.session.close()
+            client.session = session
+            _github_clients[use_cache] = client
+        return _github_clients[use_cache]
+
+
+def close_sessions():
+    """Close this process's sessions, so that the next request starts new ones"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _github_clients.clear()
+
+
+def _make_session(use_cache):
+    if use_cache:
+        cache = ResponseCache(
+            settings.HTTP_CACHE_DIR,
+            settings.HTTP_CACHE_MAX_SIZE,
+            compress=settings.HTTP_CACHE_COMPRESS,
+        )
+        session = requests_cache.CachedSession(backend=cache, expire_after=-1)
+    else:
+        session = requests.Session()
+
+    # Keep up to HTTP_POOL_SIZE connections open to each host. Beyond that, connections
+    # are still made when they're needed, but closed after use. Requests to a host that's
+    # failing aren't made at all (see circuits.py).
+    adapter = CircuitBreakerAdapter(pool_maxsize=settings.HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _forget_sessions():
+    # A child process (such as a render, see workers.py) mustn't use the connections it
+    # inherited, as they're still in use by its parent
+    global _lock
+    _lock = threading.Lock()
+    _sessions.clear()
+    _github_clients.clear()
+
+
+os.register_at_fork(after_in_child=_forget_sessions)
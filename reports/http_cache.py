@@ -0,0 +1,220 @@
+"""
+A bounded cache of responses from GitHub and job-server, for requests_cache
+
+requests_cache's SQLite backend keeps every response we've ever cached (they never
+expire; see `http.get_session`), so it grows without limit, and every worker writes to the
+one database file, so they queue up behind each other's locks.  Instead, each response is
+stored in a file of its own, named by its cache key and sharded into directories, and
+written to a temporary file that's moved into place, so workers never block each other.
+Responses are gzipped as they're stored (if HTTP_CACHE_COMPRESS), and once the cache is
+over HTTP_CACHE_MAX_SIZE the least recently used are evicted, as fragments are (see
+fragments.py).  Rather than looking at every file each time a response is stored, we keep
+an estimate of their total size, and only look once that might be over (see
+`fragments.DiskUsage`).
+
+Hits, misses and evictions are counted by each worker, and added to totals in the default
+cache every STATS_INTERVAL seconds, rather than with a query for every lookup (see
+counters.py); see the `http_cache_stats` management command.
+"""
+import gzip
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import structlog
+from django.conf import settings
+from requests_cache.backends.base import BaseCache, BaseStorage
+
+from . import counters
+from .fragments import DiskUsage, least_recently_used
+
+
+logger = structlog.getLogger()
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class ResponseCache(BaseCache):
+    """
+    Cached responses, stored as files, for requests_cache
+
+    Attributes:
+        location (Path): directory to store responses in
+        max_size (int): total size in bytes of stored responses, above which the least
+        recently used responses are evicted
+        compress (bool): whether to gzip responses as they're stored
+        evict_interval (float): how often in seconds we look at the stored responses as
+        we store more, even if our estimate of their total size is within max_size
+    """
+
+    counters = ("hits", "misses", "evictions")
+
+    def __init__(self, location, max_size, compress=False, evict_interval=60, **kwargs):
+        super().__init__(cache_name=str(location), **kwargs)
+        self.location = Path(location)
+        self.max_size = max_size
+        self.disk_usage = DiskUsage(max_size, evict_interval)
+        self.responses = FileStorage(
+            self.location / "responses", compress=compress, **kwargs
+        )
+        # the keys of responses that were redirected, by the keys of the requests that
+        # were redirected to them
+        self.redirects = FileStorage(
+            self.location / "redirects", serializer=KeySerializer
+        )
+        self.counts = counters.get_counter(
+            "http_cache", self.counters, settings.STATS_INTERVAL
+        )
+
+    @property
+    def urls(self):
+        # without loading every response, as clearing a repo's responses from the cache
+        # goes through all of their URLs (see osgithub's GithubRepo.clear_cache)
+        return self.responses.urls()
+
+    def get_response(self, key, default=None):
+        response = super().get_response(key)
+        self.counts.count("misses" if response is None else "hits")
+        return default if response is None else response
+
+    def save_response(self, response, cache_key=None, expires=None):
+        cache_key = cache_key or self.create_key(response.request)
+        super().save_response(response, cache_key, expires)
+        try:
+            size = self.responses.path(cache_key).stat().st_size
+        except FileNotFoundError:  # pragma: no cover
+            # evicted by another process
+            size = 0
+        if self.disk_usage.add(size):
+            self.evict()
+
+    def clear(self):
+        super().clear()
+        self.disk_usage.checked(0)
+
+    def evict(self):
+        """Remove the least recently used responses until we're within max_size"""
+        files = self.responses.files()
+        sizes = {path: size for _, size, path in files}
+        size = sum(sizes.values())
+        for path in least_recently_used(files, self.max_size):
+            path.unlink(missing_ok=True)
+            size -= sizes[path]
+            self.counts.count("evictions")
+            logger.info("Evicted cached response", key=path.name)
+        self.disk_usage.checked(size)
+
+    def stats(self):
+        files = self.responses.files()
+        return {
+            **self.counts.totals(),
+            "count": len(files),
+            "size": sum(size for _, size, _ in files),
+        }
+
+
+class FileStorage(BaseStorage):
+    """
+    A mapping of cache keys to values stored in files, for requests_cache
+
+    Each file starts with the URL of the response it holds (if it's a response), so that
+    we can list them without loading the responses themselves.
+    """
+
+    def __init__(self, location, compress=False, **kwargs):
+        super().__init__(**kwargs)
+        self.location = Path(location)
+        self.compress = compress
+
+    def path(self, key):
+        return self.location / key[:2] / key
+
+    def __getitem__(self, key):
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+            # mark as recently used, for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            raise KeyError(key)
+        _, _, data = data.partition(b"\n")
+        if data.startswith(GZIP_MAGIC):
+            data = gzip.decompress(data)
+        return self.serializer.loads(data)
+
+    def __setitem__(self, key, value):
+        data = self.serializer.dumps(value)
+        if self.compress:
+            data = gzip.compress(data, compresslevel=6)
+        url = getattr(value, "url", "") or ""
+
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with open(fd, "wb") as f:
+                f.write(url.encode("utf-8") + b"\n")
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def __delitem__(self, key):
+        try:
+            self.path(key).unlink()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for path in self._paths():
+            yield path.name
+
+    def __len__(self):
+        return sum(1 for _ in self._paths())
+
+    def clear(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+
+    def urls(self):
+        for path in self._paths():
+            try:
+                with path.open("rb") as f:
+                    url = f.readline().rstrip(b"\n").decode("utf-8")
+            except FileNotFoundError:  # pragma: no cover
+                # evicted by another process
+                continue
+            if url:
+                yield url
+
+    def files(self):
+        """A list of (mtime, size, path) of the stored files"""
+        files = []
+        for path in self._paths():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # pragma: no cover
+                # evicted by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _paths(self):
+        return (
+            path for path in self.location.glob("*/*") if not path.name.endswith(".tmp")
+        )
+
+
+class KeySerializer:
+    """Stores the cache keys that redirects refer to as they are"""
+
+    is_binary = True
+
+    @staticmethod
+    def dumps(value):
+        return value.encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        return data.decode("utf-8")
@@ -0,0 +1,72 @@
+"""
+Read the dimensions of the images embedded in reports
+
+We only need the width and height from the image's header, so rather than depend on an
+imaging library we read them directly for the formats that we extract from reports.
+"""
+import struct
+
+
+# JPEG start of frame markers, which are followed by the image's dimensions
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# JPEG markers which stand alone, without a length or payload
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD9)}
+
+
+def get_image_size(data):
+    """Return the (width, height) of the image in `data`, or None if we can't tell"""
+    try:
+        if data.startswith(b"\x89PNG\r\n\x1a\n"):
+            return _png_size(data)
+        if data.startswith((b"GIF87a", b"GIF89a")):
+            return struct.unpack_from("<HH", data, 6)
+        if data.startswith(b"\xff\xd8"):
+            return _jpeg_size(data)
+        if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+            return _webp_size(data)
+    except (IndexError, struct.error):
+        # truncated or corrupt image
+        return None
+    return None
+
+
+def _png_size(data):
+    if data[12:16] != b"IHDR":
+        return None
+    return struct.unpack_from(">II", data, 16)
+
+
+def _jpeg_size(data):
+    offset = 2
+    while offset < len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            # padding
+            offset += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", data, offset + 5)
+            return width, height
+        (length,) = struct.unpack_from(">H", data, offset + 2)
+        offset += 2 + length
+    return None
+
+
+def _webp_size(data):
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        width, height = struct.unpack_from("<HH", data, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        (bits,) = struct.unpack_from("<I", data, 21)
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return width, height
+    return None
@@ -1,8 +1,10 @@
 from datetime import datetime
 
-import requests
-import requests_cache
+from django.conf import settings
 from environs import Env
+from furl import furl
+
+from .http import get_session
 
 
 env = Env()
@@ -12,60 +14,64 @@ class JobServerClient:
     """
     A connection to the Jobs site
 
-    Optionally uses request caching
+    Optionally uses request caching.  Requests are made with the process's shared
+    session (see http.py), so connections are reused between clients.
 
     Attributes:
         user_agent (str): set from JOB_SERVER_USER_AGENT environment variable;
         a string to identify the application
         use_cache (bool): whether to use request caching; defaults to False
         token (str): optional authentication token
-        expire_after (int): For cached requests, set a global expiry for the session (default = -1; never expires)
-        urls_expire_after (dict): Set expiry on specific url patterns (falls back to `expire_after` if no match found), e.g.
-            urls_expire_after = {
-                '*/pulls': 60,  # expire requests to get pull requests after 60 secs
-                '*/branches': 60 * 5, # expire requests to get branches after 5 mins
-                '*/commits': 30,  # expire requests to get commits after 30 secs
-            }
     """
 
-    cache_name = env.str("REQUESTS_CACHE_NAME", default="http_cache")
     user_agent = env.str("JOB_SERVER_USER_AGENT", default="reports")
 
-    def __init__(
-        self, use_cache=False, token=None, expire_after=-1, urls_expire_after=None
-    ):
-        if use_cache:
-            self.session = requests_cache.CachedSession(
-                backend="sqlite",
-                cache_name=self.cache_name,
-                expire_after=expire_after,
-                urls_expire_after=urls_expire_after,
-            )
-        else:
-            self.session = requests.Session()
+    def __init__(self, use_cache=False, token=None):
+        self.session = get_session(use_cache)
 
         # always set a token, even if we're getting published outputs to simply
         # the code on either side.
         token = token or env.str("JOB_SERVER_TOKEN", default=None)
-        self.session.headers = {
+        self.headers = {
             "User-Agent": self.user_agent,
             "Authorization": token,
         }
 
     def file_exists(self, url):
-        return self.session.head(url, allow_redirects=True).ok
+        return self.session.head(url, headers=self.headers, allow_redirects=True).ok
 
-    def get_file(self, url):
-        r = self.session.get(url, allow_redirects=True, timeout=1)
+    def open_file(self, url, headers=None):
+        """
+        Requests a file without reading its body, so that it can be read incrementally
+        with `iter_content()`
+
+        Extra `headers` can make the request conditional, in which case the response may
+        be a 304 (Not Modified) with no body.
+
+        It's always made without request caching, as the requests cache would read the
+        whole body to store it before we could read any of it, and we store what we render
+        from it anyway (see fragments.py).
+        """
+        r = get_session(use_cache=False).get(
+            url,
+            headers={**self.headers, **(headers or {})},
+            allow_redirects=True,
+            timeout=1,
+            stream=True,
+        )
         r.raise_for_status()
 
         # parse the header into a datetime object to avoid implicit coercion elsewhere
+        last_modified = r.headers.get("Last-Modified")
+        if last_modified is None:
+            return r, None
         rfc_7231_date_format = "%a, %d %b %Y %H:%M:%S %Z"
-        last_updated = datetime.strptime(
-            r.headers.get("Last-Modified"),
-            rfc_7231_date_format,
-        )
+        last_updated = datetime.strptime(last_modified, rfc_7231_date_format)
+
+        return r, last_updated
 
+    def get_file(self, url):
+        r, last_updated = self.open_file(url)
         return r.text, last_updated
 
 
@@ -78,36 +84,94 @@ class JobServerReport:
     def __init__(self, report, use_cache=True):
         self.client = JobServerClient(use_cache=use_cache)
         self.report = report
+        self._response = None
         self._fetched_html = None
+        # what identifies the version of the file we've fetched, to be recorded once it's
+        # rendered (see fragments.store_report_fragment)
+        self.validators = {}
 
     def clear_cache(self):
         """Clear the cache for the Report's job-server URL"""
         if hasattr(self.client.session, "cache"):
             self.client.session.cache.delete_url(self.report.job_server_url)
 
+    @property
+    def upstream(self):
+        """The host we fetch the report from (see circuits.py)"""
+        return furl(self.report.job_server_url).host
+
     def file_exists(self):
         return self.client.file_exists(self.report.job_server_url)
 
-    def get_html(self):
+    def open_file(self, conditional=False):
         """
-        Fetches a report html file (an exported jupyter notebook) from a
-        job-server output URL based on `report`, a Report model instance.
+        Requests a report html file (an exported jupyter notebook) from a job-server
+        output URL based on `report`, a Report model instance, without reading its body.
+
+        If `conditional`, we ask for the file only if it's changed since we last rendered
+        it, and the response may be a 304 (Not Modified) with no body.
         """
-        if self._fetched_html is not None:
-            return self._fetched_html
+        if self._response is None or (
+            self._response.status_code == 304 and not conditional
+        ):
+            headers = self._conditional_headers() if conditional else {}
+            self._response, last_updated = self.client.open_file(
+                self.report.job_server_url, headers
+            )
+            if self._response.status_code == 304:
+                return self._response
+
+            self.validators = {
+                "source_etag": self._response.headers.get("ETag", ""),
+                "source_last_modified": self._response.headers.get("Last-Modified", ""),
+            }
 
-        file, last_updated = self.client.get_file(self.report.job_server_url)
+            # convert to a date for Report.last_updated
+            job_server_last_updated = last_updated.date()
+            if self.report.last_updated != job_server_last_updated:
+                self.report.last_updated = job_server_last_updated
+                self.report.save()
 
-        # convert to a date for Report.last_updated
-        job_server_last_updated = last_updated.date()
-        if self.report.last_updated != job_server_last_updated:
-            self.report.last_updated = job_server_last_updated
-            self.report.save()
+        return self._response
+
+    def is_modified(self):
+        """
+        Has the report file changed since we last rendered it?
+
+        This is a conditional request, so if it hasn't changed, its body isn't sent.
+        """
+        return self.open_file(conditional=True).status_code != 304
 
-        self._fetched_html = file
+    def _conditional_headers(self):
+        headers = {}
+        if self.report.source_etag:
+            headers["If-None-Match"] = self.report.source_etag
+        if self.report.source_last_modified:
+            headers["If-Modified-Since"] = self.report.source_last_modified
+        return headers
 
+    def get_html(self):
+        """
+        Fetches a report html file (an exported jupyter notebook) from a
+        job-server output URL based on `report`, a Report model instance.
+        """
+        if self._fetched_html is None:
+            self._fetched_html = self.open_file().text
         return self._fetched_html
 
+    def iter_html(self, chunk_size=None):
+        """Yields the report html in chunks as it is read from job-server"""
+        if self._fetched_html is not None:
+            yield self._fetched_html
+            return
+
+        response = self.open_file()
+        if response.encoding is None:
+            response.encoding = "utf-8"
+        yield from response.iter_content(
+            chunk_size or settings.RENDER_BUFFER_SIZE, decode_unicode=True
+        )
+
     @property
     def is_published(self):
         return "published" in self.report.job_server_url
@@ -117,7 +181,8 @@ class JobServerReport:
         Return the last updated date separately to the fully processed HTML
 
         This mirrors GitHubReport.last_updated so we can use a consistent API
-        in the template.
+        in the template.  Finding out doesn't need the file's body, so if it hasn't changed
+        since we last rendered it, we don't fetch it.
         """
-        self.get_html()
+        self.open_file(conditional=True)
         return self.report.last_updated
@@ -0,0 +1,61 @@
+"""
+Locks shared by all of our worker processes, on every host
+
+When a popular report's cache token changes, every worker that gets a request for it
+at the same moment would otherwise fetch and render it.  Instead, the first to take the
+report's lock does, and the others wait for it to finish and use what it stored.
+
+The locks are kept in the default cache, which is the database, so they work across
+hosts without anything else to run.  A cache `add` only succeeds if the key isn't
+already there, which makes it a lock; it expires, so that a worker that's killed while
+holding one doesn't block everyone else for good.
+"""
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class LockTimeout(Exception):
+    """We gave up waiting for another worker to release a lock"""
+
+
+def acquire(name, timeout=None):
+    """
+    Take the lock `name`, for at most `timeout` seconds, and return a token to release
+    it with, or None if it's held by someone else
+    """
+    timeout = timeout if timeout is not None else settings.LOCK_TIMEOUT
+    token = uuid.uuid4().hex
+    if cache.add(_key(name), token, timeout):
+        return token
+    return None
+
+
+def release(name, token):
+    """Release the lock `name`, unless it's expired and been taken by someone else"""
+    # This isn't atomic, but the lock would only have changed hands in between if it had
+    # already expired
+    if cache.get(_key(name)) == token:
+        cache.delete(_key(name))
+
+
+def wait(name, timeout=None, poll_interval=None):
+    """
+    Wait for the lock `name` to be released, for at most `timeout` seconds
+
+    Raises LockTimeout if it's still held.
+    """
+    timeout = timeout if timeout is not None else settings.LOCK_WAIT
+    poll_interval = poll_interval or settings.LOCK_POLL_INTERVAL
+    deadline = time.monotonic() + timeout
+    while cache.get(_key(name)) is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise LockTimeout(name)
+        time.sleep(min(poll_interval, remaining))
+
+
+def _key(name):
+    return f"lock:{name}"
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from reports.refresh import check_github_reports
+
+
+class Command(BaseCommand):
+    help = """
+        Check all reports hosted on GitHub for changes, with one request per repo, and ask
+        for those that have changed to be refreshed (see `refresh_reports`).
+    """  # noqa: A003
+
+    def handle(self, *args, **options):
+        changed = check_github_reports()
+        self.stdout.write(f"{changed} report(s) to refresh")
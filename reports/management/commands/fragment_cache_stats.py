@@ -0,0 +1,33 @@
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = """
+        Report the size of the cache of rendered page fragments, and how often they're
+        served from memory, from disk and from the shared cache (see
+        reports/tiered_cache.py).
+    """  # noqa: A003
+
+    def handle(self, *args, **options):
+        cache = caches["template_fragments"]
+        stats = cache.stats()
+        hits = stats["memory_hits"] + stats["disk_hits"] + stats["shared_hits"]
+        lookups = hits + stats["misses"]
+        hit_ratio = f"{hits / lookups:.1%}" if lookups else "n/a"
+
+        self.stdout.write(f"Location: {cache.location}")
+        self.stdout.write(f"Fragments: {stats['count']}")
+        self.stdout.write(
+            f"Size: {stats['size']:,} of {cache.max_size:,} bytes "
+            f"({stats['size'] / cache.max_size:.1%})"
+        )
+        self.stdout.write(
+            f"Hits: {hits:,} ({stats['memory_hits']:,} from memory, "
+            f"{stats['shared_hits']:,} from the shared cache), "
+            f"misses: {stats['misses']:,} (hit ratio {hit_ratio})"
+        )
+        self.stdout.write(
+            f"Evictions: {stats['disk_evictions']:,} from disk, "
+            f"{stats['memory_evictions']:,} from memory"
+        )
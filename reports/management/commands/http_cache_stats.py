@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from reports.http import get_session
+
+
+class Command(BaseCommand):
+    help = """
+        Report the size of the cache of responses from GitHub and job-server, and how
+        often requests are served from it (see reports/http_cache.py).
+    """  # noqa: A003
+
+    def handle(self, *args, **options):
+        cache = get_session(use_cache=True).cache
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_ratio = f"{stats['hits'] / lookups:.1%}" if lookups else "n/a"
+
+        self.stdout.write(f"Location: {cache.location}")
+        self.stdout.write(f"Responses: {stats['count']}")
+        self.stdout.write(
+            f"Size: {stats['size']:,} of {cache.max_size:,} bytes "
+            f"({stats['size'] / cache.max_size:.1%})"
+        )
+        self.stdout.write(
+            f"Hits: {stats['hits']:,}, misses: {stats['misses']:,} "
+            f"(hit ratio {hit_ratio})"
+        )
+        self.stdout.write(f"Evictions: {stats['evictions']:,}")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from reports.refresh import run_worker
+
+
+class Command(BaseCommand):
+    help = """
+        Refresh the cached content of reports in the background, as requests for
+        out-of-date content ask for it.  Started by gunicorn (see gunicorn.conf.py).
+    """  # noqa: A003
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            help="Seconds between checks for reports to refresh (default: REFRESH_POLL_INTERVAL)",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Refresh the reports that have been asked for, then exit",
+        )
+
+    def handle(self, *args, **options):
+        run_worker(poll_interval=options["poll_interval"], once=options["once"])
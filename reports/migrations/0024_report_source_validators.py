@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("reports", "0023_alter_report_last_updated"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="report",
+            name="fragment_key",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="report",
+            name="source_etag",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddField(
+            model_name="report",
+            name="source_last_modified",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="report",
+            name="source_sha",
+            field=models.CharField(blank=True, default="", max_length=40),
+        ),
+    ]
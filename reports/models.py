@@ -48,35 +48,8 @@ class AutoPopulatingCharField(models.CharField):
         return super().clean(value, model_instance)
 
 
-class PopulatedCategoryManager(models.Manager):
-    """
-    Manager that returns only Categories that have at least one associated Report
-    """
-
-    def get_queryset(self):
-        return (
-            super()
-            .get_queryset()
-            .annotate(count=models.Count("reports"))
-            .filter(count__gt=0)
-        ).order_by("name")
-
-    def for_user(self, user):
-        report_category_ids = set(
-            Report.objects.for_user(user).values_list("category_id", flat=True)
-        )
-        queryset = (
-            self.get_queryset().filter(id__in=report_category_ids).order_by("name")
-        )
-        if user.is_staff:
-            return queryset
-        return queryset.exclude(name__iexact="archive")
-
-
 class Category(models.Model):
     name = models.CharField(max_length=255, unique=True)
-    objects = models.Manager()
-    populated = PopulatedCategoryManager()
 
     class Meta:
         verbose_name_plural = "categories"
@@ -157,9 +130,20 @@ class Report(models.Model):
         verbose_name="Last released",
     )
     cache_token = models.UUIDField(default=uuid4)
-    # Flag to remember if this report needed to use the git blob method (see github.py),
-    # to avoid re-calling the contents endpoint if we know it will fail
+    # Flag to remember if this report's file is too large for the contents API to include
+    # its content, so that we go straight to streaming it in its raw form (see github.py)
     use_git_blob = models.BooleanField(default=False)
+    # The stored fragment (see fragments.py) rendered from the last report file we fetched,
+    # and what the file's host told us to identify that version of it by (for GitHub, its
+    # blob SHA and the ETag of its folder's listing), so that we can ask whether it's
+    # changed rather than fetching it again
+    fragment_key = models.CharField(max_length=64, default="", blank=True)
+    source_etag = models.CharField(max_length=255, default="", blank=True)
+    source_last_modified = models.CharField(max_length=64, default="", blank=True)
+    source_sha = models.CharField(max_length=40, default="", blank=True)
+    # When we last checked the report file for changes; after REPORT_CONTENT_REFRESH_AFTER,
+    # the cached content is refreshed in the background (see refresh.py)
+    source_checked_at = models.DateTimeField(null=True, blank=True)
     is_draft = models.BooleanField(
         default=False,
         help_text="Draft reports are only visible by a logged in user with relevant permissions",
@@ -192,6 +176,26 @@ class Report(models.Model):
         if commit:
             self.save()
 
+    def record_source(self, **fields):
+        """
+        Record what we know about the report file we last fetched
+
+        This is saved straight to the database, rather than with save(), as there's
+        nothing about it to validate and it doesn't affect how the report is cached.
+        """
+        for field, value in fields.items():
+            setattr(self, field, value)
+        if self.pk:
+            Report.objects.filter(pk=self.pk).update(**fields)
+
+    def clear_source(self):
+        """Forget the report file we last fetched, as it's not from the same place"""
+        self.fragment_key = ""
+        self.source_etag = ""
+        self.source_last_modified = ""
+        self.source_sha = ""
+        self.source_checked_at = None
+
     @property
     def meta_title(self):
         return f"{self.title} | OpenSAFELY: Reports"
@@ -293,12 +297,15 @@ class Report(models.Model):
 
     @classmethod
     def from_db(cls, db, field_names, values):
-        """Extended from_db method to store original field values on the instance"""
+        """
+        Extended from_db method to store original field values on the instance
+
+        Only the report's own fields are stored, so that loading many reports doesn't
+        cost a query for each; changes to its links refresh its cache token as they're
+        saved (see Link.save and Link.delete).
+        """
         instance = super().from_db(db, field_names, values)
         instance._loaded_values = dict(zip(field_names, values))
-        instance._loaded_values["links"] = {
-            link.pop("id"): link for link in instance.links.values()
-        }
         return instance
 
     def _check_and_refresh_cache(self):
@@ -310,11 +317,20 @@ class Report(models.Model):
             "cache_token",
             "last_updated",
             "use_git_blob",
+            "fragment_key",
+            "source_etag",
+            "source_last_modified",
+            "source_sha",
+            "source_checked_at",
             "is_draft",
-            "links",
         }
         all_field_keys = self._loaded_values.keys()
         http_cache_fields = set(all_field_keys) - requests_cache_fields - exclude_fields
+        if any(
+            getattr(self, field) != self._loaded_values[field]
+            for field in requests_cache_fields | {"job_server_url"}
+        ):
+            self.clear_source()
         if any(
             getattr(self, field) != self._loaded_values[field]
             for field in requests_cache_fields
@@ -431,3 +447,21 @@ class Link(models.Model):
         logger.info("Link deleted; refreshing report cache token")
         self.report.refresh_cache_token()
         super().delete(*args, **kwargs)
+
+
+class ReportRefresh(models.Model):
+    """
+    A request for a report's cached content to be refreshed in the background, because
+    it's older than REPORT_CONTENT_REFRESH_AFTER (see refresh.py)
+    """
+
+    report = models.OneToOneField(Report, on_delete=models.CASCADE, related_name="+")
+    requested_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ("requested_at",)
+        # only ever made and removed by the app itself
+        default_permissions = ()
+
+    def __str__(self):
+        return f"{self.report} (requested {self.requested_at})"
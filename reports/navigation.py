@@ -0,0 +1,221 @@
+"""
+The categories and reports listed in the sidebar of every page, and the recent activity
+listed on the landing page
+
+Listing them for each page took a query for the categories the user can see, and another
+for the reports in each category.  Instead, each worker builds the whole tree in a single
+query, holds it as tuples of plain records rather than model instances, and keeps the
+part of it that each class of user can see (everyone, users who can see drafts, and
+staff, who can see the archive as well), so that on a warm worker the sidebar costs no
+queries.
+
+The tree is built again whenever a Report or Category is saved or deleted.  Other workers
+find out from a version number in the default cache, which is bumped (once the change is
+committed) by every save and delete; they check it at most every
+NAVIGATION_CHECK_INTERVAL seconds.
+
+The recent activity (reports published or updated, most recent first) is worked out from
+the same query, once for users who can see drafts and once for everyone else, so the
+landing page costs no queries either.
+
+With LAZY_SIDEBAR on, only the categories are listed in each page, and the reports in
+each category are fetched as it's expanded (see views.navigation_reports).
+"""
+import datetime
+import threading
+import time
+from typing import NamedTuple, Tuple
+
+import structlog
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.urls import reverse
+
+from .models import Category, Report
+
+
+logger = structlog.getLogger()
+
+VERSION_KEY = "navigation:version"
+
+# The category whose reports are only listed for staff, and never in recent activity
+ARCHIVE = "archive"
+
+# The number of events listed in recent activity
+RECENT_ACTIVITY_LENGTH = 10
+
+
+class NavReport(NamedTuple):
+    id: int  # noqa: A003
+    menu_name: str
+    url: str
+    is_draft: bool
+
+
+class NavCategory(NamedTuple):
+    id: int  # noqa: A003
+    name: str
+    reports: Tuple[NavReport, ...]
+
+
+class Activity(NamedTuple):
+    """A report being published or updated"""
+
+    id: int  # noqa: A003
+    menu_name: str
+    url: str
+    activity: str
+    activity_date: datetime.date
+
+
+class _Tree(NamedTuple):
+    version: int
+    checked_at: float
+    categories: Tuple[NavCategory, ...]
+    # the recent activity that users can see, by whether they can see drafts
+    activity: dict
+    # the categories that each class of user can see, as they're asked for
+    visible: dict
+
+
+_lock = threading.Lock()
+_tree = None
+
+
+def categories_for_user(user):
+    """The categories, with their reports, that `user` can see, in the order they're listed"""
+    key = visibility(user)
+    tree = _get_tree()
+    if key not in tree.visible:
+        tree.visible[key] = _visible(tree.categories, *key)
+    return tree.visible[key]
+
+
+def recent_activity_for_user(user):
+    """The most recent reports published or updated that `user` can see"""
+    return _get_tree().activity[user.has_perm("reports.view_draft")]
+
+
+def visibility(user):
+    """The class of user that `user` is: whether they can see drafts, and the archive"""
+    return user.has_perm("reports.view_draft"), user.is_staff
+
+
+def version():
+    """The version of the tree that this worker has"""
+    return _get_tree().version
+
+
+def build():
+    """
+    Build the tree of every category that has reports, and the recent activity that
+    users who can and can't see drafts can see, from a single query
+    """
+    categories = []
+    events = []
+    rows = Report.objects.order_by("category__name", "menu_name").values_list(
+        "category_id",
+        "category__name",
+        "id",
+        "slug",
+        "menu_name",
+        "is_draft",
+        "publication_date",
+        "last_updated",
+    )
+    for category_id, category_name, *report in rows:
+        if not categories or categories[-1][0] != category_id:
+            categories.append((category_id, category_name, []))
+        report_id, slug, menu_name, is_draft, publication_date, last_updated = report
+        url = reverse("report_view", args=(slug,))
+        categories[-1][2].append(NavReport(report_id, menu_name, url, is_draft))
+
+        if category_name.lower() == ARCHIVE:
+            continue
+        # A report that's been updated is only listed as updated, unless it was updated
+        # on the day it was published, which is just a publication
+        if last_updated is None or last_updated == publication_date:
+            event = Activity(report_id, menu_name, url, "published", publication_date)
+        elif last_updated > publication_date:
+            event = Activity(report_id, menu_name, url, "updated", last_updated)
+        else:
+            continue
+        events.append((event, is_draft))
+
+    events.sort(key=lambda event: event[0].activity_date, reverse=True)
+    activity = {
+        can_view_drafts: tuple(
+            event for event, is_draft in events if can_view_drafts or not is_draft
+        )[:RECENT_ACTIVITY_LENGTH]
+        for can_view_drafts in (True, False)
+    }
+    categories = tuple(
+        NavCategory(category_id, name, tuple(reports))
+        for category_id, name, reports in categories
+    )
+    return categories, activity
+
+
+def invalidate():
+    """Build the tree again, in this worker and (once committed) in all of the others"""
+    reset()
+    transaction.on_commit(_bump_version)
+
+
+def reset():
+    """Forget this worker's tree, so that it's built again when it's next needed"""
+    global _tree
+    _tree = None
+
+
+def _get_tree():
+    global _tree
+    tree = _tree
+    now = time.monotonic()
+    if tree is not None and now - tree.checked_at < settings.NAVIGATION_CHECK_INTERVAL:
+        return tree
+
+    with _lock:
+        tree = _tree
+        # the version is set when it's missing (e.g. evicted) to something that it
+        # hasn't been before, so that a tree built before then isn't mistaken for current
+        version = cache.get_or_set(VERSION_KEY, time.time_ns, timeout=None)
+        if tree is not None and tree.version == version:
+            tree = tree._replace(checked_at=now)
+        else:
+            tree = _Tree(version, now, *build(), {})
+            logger.info("Navigation built", version=version)
+        _tree = tree
+    return tree
+
+
+def _visible(categories, can_view_drafts, is_staff):
+    visible = []
+    for category in categories:
+        if not is_staff and category.name.lower() == ARCHIVE:
+            continue
+        reports = category.reports
+        if not can_view_drafts:
+            reports = tuple(report for report in reports if not report.is_draft)
+        if reports:
+            visible.append(category._replace(reports=reports))
+    return tuple(visible)
+
+
+def _bump_version():
+    if not cache.add(VERSION_KEY, time.time_ns(), timeout=None):
+        cache.incr(VERSION_KEY)
+        # incr() sets the key's timeout back to the default
+        cache.touch(VERSION_KEY, timeout=None)
+    reset()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Report)
+@receiver(post_delete, sender=Report)
+def _content_changed(**kwargs):
+    invalidate()
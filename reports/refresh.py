@@ -0,0 +1,171 @@
+"""
+Refresh the cached content of reports in the background
+
+A report's rendered content is cached for REPORT_CONTENT_MAX_AGE.  Once it's older than
+REPORT_CONTENT_REFRESH_AFTER, it's still served straight from the cache, but the request
+also asks for it to be refreshed (a ReportRefresh).  A worker process (the
+`refresh_reports` management command, which gunicorn starts alongside the web workers)
+picks these up, checks whether the report file has changed, and renders the content
+into the cache again.  So a visitor only waits for a report to be fetched and rendered
+when its content has expired, or has been invalidated by a new cache token.
+
+The worker also checks all of the reports hosted on GitHub for changes every
+REFRESH_CHECK_INTERVAL seconds, and refreshes those that have changed (see
+`check_github_reports`), so that they're up to date before anyone asks for them.
+
+The worker is fed from the database rather than a queue, so there's nothing else to run.
+We expect there to be only one.
+"""
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+import structlog
+from django.conf import settings
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.db import close_old_connections
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .github import GithubReport, get_blob_shas
+from .job_server import JobServerReport
+from .models import Report, ReportRefresh
+
+
+logger = structlog.getLogger()
+
+# The report content fragment, as cached by the `{% cache %}` tag in report.html
+REPORT_CONTENT_FRAGMENT = "report_content"
+
+
+def get_fragment_cache():
+    """The cache that the `{% cache %}` template tag stores fragments in"""
+    try:
+        return caches["template_fragments"]
+    except InvalidCacheBackendError:
+        return caches["default"]
+
+
+def report_content_key(report):
+    """The cache key of a report's content, as the `{% cache %}` tag in report.html makes it"""
+    return make_template_fragment_key(REPORT_CONTENT_FRAGMENT, [report.cache_token])
+
+
+def is_stale(report):
+    """Is it time to check whether the report file has changed?"""
+    if report.source_checked_at is None:
+        return True
+    refresh_after = timedelta(seconds=settings.REPORT_CONTENT_REFRESH_AFTER)
+    return timezone.now() - report.source_checked_at > refresh_after
+
+
+def request_refresh(report):
+    """Ask for the report's cached content to be refreshed in the background"""
+    _, created = ReportRefresh.objects.get_or_create(report=report)
+    if created:
+        logger.info("Report refresh requested", report_id=report.pk)
+
+
+def refresh_report(report):
+    """
+    Check whether the report file has changed, and render the report's content into
+    the cache again
+    """
+    # The requests cache would give us the same file that we fetched last time
+    remote_cls = GithubReport if report.uses_github else JobServerReport
+    remote = remote_cls(report, use_cache=False)
+    content = render_to_string(
+        "partials/report_content.html", {"remote": remote, "report": report}
+    )
+    get_fragment_cache().set(
+        report_content_key(report), content, settings.REPORT_CONTENT_MAX_AGE
+    )
+    logger.info("Report refreshed", report_id=report.pk)
+
+
+def refresh_pending():
+    """Refresh the reports that have been asked for, oldest first, and return how many"""
+    count = 0
+    for refresh in ReportRefresh.objects.select_related("report"):
+        try:
+            refresh_report(refresh.report)
+        except Exception:
+            # It'll be asked for again by the next request for the report
+            logger.exception("Error refreshing report", report_id=refresh.report_id)
+        # Only now that it's done, so that it isn't asked for again in the meantime
+        refresh.delete()
+        count += 1
+    return count
+
+
+def check_github_reports():
+    """
+    Ask for the reports hosted on GitHub whose files have changed to be refreshed, and
+    return how many have
+
+    Many reports are in the same few repos, so rather than asking about each report's file
+    (see `GithubReport.is_modified`), we get the tree of each repo and branch once, which
+    gives the blob SHA of every file in it, and compare those with the SHAs of the files
+    we last rendered.  Reports that we haven't rendered yet have nothing to compare with,
+    so they're left until someone asks for them.
+    """
+    reports = defaultdict(list)
+    for report in (
+        Report.objects.filter(job_server_url="")
+        .exclude(source_sha="")
+        .values("pk", "repo", "branch", "report_html_file_path", "source_sha")
+    ):
+        reports[report["repo"], report["branch"]].append(report)
+
+    changed, unchanged = [], []
+    for (repo, branch), repo_reports in reports.items():
+        try:
+            shas = get_blob_shas(repo, branch)
+        except Exception:
+            logger.exception(
+                "Error checking repo for changes", repo=repo, branch=branch
+            )
+            continue
+        for report in repo_reports:
+            if shas is None:
+                # too large to list, so each report is checked as it's refreshed
+                changed.append(report["pk"])
+            elif shas.get(report["report_html_file_path"]) == report["source_sha"]:
+                unchanged.append(report["pk"])
+            else:
+                changed.append(report["pk"])
+
+    Report.objects.filter(pk__in=unchanged).update(source_checked_at=timezone.now())
+    for report_id in changed:
+        ReportRefresh.objects.get_or_create(report_id=report_id)
+    logger.info(
+        "Checked reports for changes",
+        repos=len(reports),
+        changed=len(changed),
+        unchanged=len(unchanged),
+    )
+    return len(changed)
+
+
+def run_worker(poll_interval=None, once=False):
+    """
+    Refresh reports as they're asked for, checking every `poll_interval` seconds, and
+    check for changed reports every REFRESH_CHECK_INTERVAL seconds
+    """
+    if poll_interval is None:
+        poll_interval = settings.REFRESH_POLL_INTERVAL
+    logger.info("Refresh worker started", poll_interval=poll_interval)
+    next_check = time.monotonic()
+    while True:
+        close_old_connections()
+        if settings.REFRESH_CHECK_INTERVAL and time.monotonic() >= next_check:
+            try:
+                check_github_reports()
+            except Exception:
+                logger.exception("Error checking reports for changes")
+            next_check = time.monotonic() + settings.REFRESH_CHECK_INTERVAL
+        refresh_pending()
+        if once:
+            return
+        time.sleep(poll_interval)
@@ -1,26 +1,772 @@
-from bs4 import BeautifulSoup
+import binascii
+import hashlib
+import json
+import re
+from base64 import b64decode
+from io import StringIO
+from urllib.parse import unquote_plus
+
+import structlog
+from django.conf import settings
 from django.utils.safestring import mark_safe
-from lxml.html.clean import Cleaner
+from lxml import etree
+from lxml.html import defs
+
+from .images import get_image_size
+
+
+logger = structlog.getLogger()
+
+# Bump this whenever a change to the renderer changes its output, so that we don't reuse fragments rendered by an
+# older version (see fragments.py)
+RENDERER_VERSION = "5"
+
+# Our sanitising policy. This mirrors what lxml's `Cleaner(page_structure=False, style=True, kill_tags=["head"])`
+# does (which is what we used to run over the whole document tree), but is applied to parser events as they arrive so
+# that we never need to hold a whole report in memory.
+
+# Elements that are removed along with everything inside them
+KILL_TAGS = {
+    "applet",
+    "button",
+    "head",
+    "input",
+    "link",
+    "meta",
+    "script",
+    "select",
+    "style",
+    "textarea",
+    *defs.frame_tags,
+}
+# Elements that are removed but whose contents are kept
+REMOVE_TAGS = {
+    "blink",
+    "embed",
+    "form",
+    "iframe",
+    "layer",
+    "marquee",
+    "object",
+    "param",
+}
+ALLOWED_TAGS = set(defs.tags) - REMOVE_TAGS
+SAFE_ATTRS = set(defs.safe_attrs)
+LINK_ATTRS = set(defs.link_attrs)
+VOID_TAGS = set(defs.empty_tags)
+
+# For small screens we want to allow side-scrolling for just a small number of elements. To enable this each one
+# needs to be wrapped in a div that we can target for styling.
+OVERFLOW_TAGS = {"table", "pre"}
+
+# Tables with more rows than VIRTUAL_TABLE_MIN_ROWS are replaced with a preview of this many rows, and their data is
+# loaded by the browser when it's needed
+VIRTUAL_TABLE_PREVIEW_ROWS = 20
+
+# Whitespace inside these elements is significant, so we never collapse it
+WHITESPACE_PRESERVING_TAGS = {"pre", "textarea"}
+
+# Images are loaded lazily, apart from the first few which are likely to be visible when the page loads
+EAGER_IMAGE_COUNT = 2
+
+# Notebook cells (from nbconvert's lab and classic templates), and how many of them we render as normal before
+# marking the rest to be rendered by the browser only once they're scrolled near to
+CELL_CLASSES = {"jp-Cell", "cell"}
+EAGER_CELL_COUNT = 8
+DEFERRED_CELL_CLASS = "deferred-cell"
+
+# Notebook exports are fed to the parser a cell at a time, so that we can reuse the output of cells that haven't changed
+# since we last rendered them (see CellFeed). Cells smaller than this (in characters) are quicker to render than to
+# store and look up, and bigger than this we don't want to hold in memory, so they're always rendered. We hold back
+# this much of the end of what we've been given in case the start of a cell is split across chunks.
+MIN_CACHED_CELL_SIZE = 4 * 1024
+MAX_CACHED_CELL_SIZE = 8 * 1024 * 1024
+CELL_START_LOOKBEHIND = 1024
+
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
+# How much of the start of a report we look at to decide whether it's a complete document or a fragment
+DOCUMENT_SNIFF_LENGTH = 4096
+
+# Links like "j a v a s c r i p t:" might be interpreted as javascript by some browsers
+_substitute_whitespace = re.compile(r"[\s\x00-\x08\x0B\x0C\x0E-\x19]+").sub
+# All kinds of schemes besides just javascript: can cause execution, but embedded (non-SVG) images are safe
+_find_image_dataurls = re.compile(r"data:image/(.+);base64,", re.I).findall
+_possibly_malicious_schemes = re.compile(
+    r"(javascript|jscript|livescript|vbscript|data|about|mocha):", re.I
+).findall
+_is_unsafe_image_type = re.compile(r"(xml|svg)", re.I).search
+_has_html_tag = re.compile(r"<html[\s>]", re.I).search
+# nbconvert always gives a cell's class first. This is only used to decide where to split a report up, so missing a cell
+# (in a report from somewhere else) just means we reuse less.
+_find_cell_start = re.compile(
+    r"""<div\s+class\s*=\s*["']?(?:jp-Cell|cell)(?=[\s"'>])"""
+).search
+_match_embedded_image = re.compile(
+    r"data:image/(png|jpe?g|gif|webp);base64,(.*)", re.I | re.S
+).fullmatch
 
 
 def process_html(html):
-    # We want to handle complete HTML documents and also fragments. We're going to extract the contents of the body
-    # at the end of this function, but it's easiest to normalize to complete documents because that's what the
-    # HTML-wrangling libraries we're using are most comfortable handling.
-    if "<html>" not in html:
-        html = f"<html><body>{html}</body></head>"
-
-    cleaned = Cleaner(page_structure=False, style=True, kill_tags=["head"]).clean_html(
-        html
+    """Sanitise a report's HTML and return the contents of its body, ready to be included in a page"""
+    sink = StringIO()
+    stream_html([html], sink)
+    return mark_safe(sink.getvalue())
+
+
+def stream_html(chunks, sink, buffer_size=None, images=None, tables=None, cells=None):
+    """
+    Sanitise report HTML incrementally, writing the contents of its body to `sink`
+
+    `chunks` is any iterable of strings (for example a response body being read from upstream), and `sink` is anything
+    with a `write()` method. We never build a document tree, so memory use is bounded by the size of the largest
+    chunk and `buffer_size` (the number of characters of output held before writing to the sink), not by the size
+    of the report.
+
+    If an `images` store is given, images embedded in the HTML as data URLs are saved to it and replaced with links. If
+    a `tables` store is given, the data from large tables is saved to it and the tables are replaced with previews (see
+    `TableCapture`). If a `cells` store is given, the output of each notebook cell is saved to it, and reused when we
+    render the same cell again (see `CellFeed`).
+    """
+    renderer = HTMLRenderer(
+        sink,
+        buffer_size or settings.RENDER_BUFFER_SIZE,
+        images=images,
+        tables=tables,
+        table_min_rows=settings.VIRTUAL_TABLE_MIN_ROWS,
     )
+    parser = etree.HTMLParser(target=renderer, remove_comments=True, remove_pis=True)
+    feed = parser if cells is None else CellFeed(parser, renderer, cells)
+
+    # We want to handle complete HTML documents and also fragments. The parser will imply the document structure for a
+    # fragment, but it puts some leading content in the <head>, so make sure fragments are treated as the body of a
+    # document. We decide which we've got from the start of the content.
+    # libxml2 ends an attribute value at a NUL, and then doesn't always end the elements it's started
+    chunks = (chunk.replace("\0", "") for chunk in chunks)
+    head = []
+    for chunk in chunks:
+        head.append(chunk)
+        if sum(len(c) for c in head) >= DOCUMENT_SNIFF_LENGTH:
+            break
+    head = "".join(head)
+    if not _has_html_tag(head):
+        parser.feed("<html><body>")
+    feed.feed(head)
+
+    for chunk in chunks:
+        feed.feed(chunk)
+    feed.close()
+
+
+class CellFeed:
+    """
+    Feeds report HTML to a parser a notebook cell at a time, reusing the output of cells that we've rendered before
+
+    Reports are re-released with only a few cells changed, so most of a re-released report's cells are ones we've
+    already rendered. We split the HTML where each cell starts, and look each cell up in the `store` by a hash of its
+    HTML and of the renderer's state (see `HTMLRenderer.cell_state`). If we have it, its output is written out in
+    place of parsing and rendering it; otherwise it's rendered as normal and its output recorded for next time.
+
+    We can only skip a piece of HTML if the parser would have finished it in the same state as it started, so output
+    is only recorded for a piece that turns out to hold a single, complete cell (see `HTMLRenderer.start_cell`). It's
+    only reused when the parser hasn't been left holding anything but whitespace from what came before it, or that
+    would come out after the cell rather than before it.
+    """
+
+    def __init__(self, parser, renderer, store):
+        self.parser = parser
+        self.renderer = renderer
+        self.store = store
+        # what we've been given but haven't fed to the parser yet
+        self._pending = []
+        self._pending_size = 0
+        # whether what's pending starts with a cell (rather than being the content before the first cell, or the rest
+        # of a cell too big to hold on to)
+        self._in_cell = False
+        # what we're going to feed to the parser, collected up so that we don't feed it lots of small pieces
+        self._unfed = []
+        self._unfed_size = 0
+        # whether the parser will have finished with everything it's been fed
+        self._clean = False
+        # whitespace at the end of what we've fed, which the parser would hold on to until it saw the next tag, so we
+        # keep it back and hand it to the renderer ourselves around a cell that we don't parse
+        self._whitespace = ""
+        self.reused = 0
+        self.rendered = 0
+
+    def feed(self, data):
+        while data:
+            tail = self._tail()
+            tail_start = self._pending_size - len(tail)
+            # don't find the start of the cell we've already got
+            match = _find_cell_start(
+                tail + data, max(int(self._in_cell) - tail_start, 0)
+            )
+            if not match:
+                break
+            text = "".join(self._pending) + data
+            boundary = tail_start + match.start()
+            self._flush(text[:boundary])
+            self._pending, self._pending_size = [], 0
+            self._in_cell = True
+            data = text[boundary:]
+
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._in_cell and self._pending_size > MAX_CACHED_CELL_SIZE:
+            self._in_cell = False
+        if not self._in_cell and self._pending_size > CELL_START_LOOKBEHIND:
+            text = "".join(self._pending)
+            self._feed_parser(text[:-CELL_START_LOOKBEHIND])
+            self._pending = [text[-CELL_START_LOOKBEHIND:]]
+            self._pending_size = CELL_START_LOOKBEHIND
+
+    def close(self):
+        self._flush("".join(self._pending))
+        self._pending, self._pending_size = [], 0
+        self._unfed.append(self._whitespace)
+        self._feed_unfed()
+        logger.info("Rendered report cells", reused=self.reused, rendered=self.rendered)
+        return self.parser.close()
+
+    def _tail(self):
+        tail = []
+        size = 0
+        for part in reversed(self._pending):
+            tail.append(part)
+            size += len(part)
+            if size >= CELL_START_LOOKBEHIND:
+                break
+        return "".join(reversed(tail))[-CELL_START_LOOKBEHIND:]
+
+    def _flush(self, text):
+        if not text:
+            return
+        if self._in_cell:
+            self._feed_cell(text)
+        else:
+            self._feed_parser(text)
+
+    def _feed_cell(self, html):
+        if (
+            not MIN_CACHED_CELL_SIZE <= len(html) <= MAX_CACHED_CELL_SIZE
+            or not self._clean
+            or not _ends_with_tag(html)
+        ):
+            self._feed_parser(html)
+            return
+        self._feed_unfed()
+        state = self.renderer.cell_state()
+        if state is None:
+            self._feed_parser(html)
+            return
+
+        if self._whitespace:
+            self.renderer.data(self._whitespace)
+        cell_html = html.rstrip(ASCII_SPACES)
+        self._whitespace = html.removeprefix(cell_html)
+        digest = hashlib.sha256(f"{RENDERER_VERSION}:{state}:".encode())
+        digest.update(cell_html.encode("utf-8"))
+        key = digest.hexdigest()
+        cell = self.store.get(key)
+        if cell is not None:
+            self.renderer.replay_cell(*cell)
+            self.reused += 1
+        else:
+            self.renderer.start_cell()
+            self.parser.feed(cell_html)
+            cell = self.renderer.end_cell()
+            if cell is not None:
+                self.store.save(key, *cell)
+            self.rendered += 1
+
+    def _feed_parser(self, text):
+        text = self._whitespace + text
+        content = text.rstrip(ASCII_SPACES)
+        self._whitespace = text.removeprefix(content)
+        if not content:
+            return
+        self._unfed.append(content)
+        self._unfed_size += len(content)
+        # the parser holds on to text until it sees the next tag
+        self._clean = content.endswith(">")
+        if self._unfed_size >= self.renderer.buffer_size:
+            self._feed_unfed()
+
+    def _feed_unfed(self):
+        if self._unfed:
+            self.parser.feed("".join(self._unfed))
+            self._unfed, self._unfed_size = [], 0
+
+
+def _ends_with_tag(html):
+    return html.rstrip(ASCII_SPACES).endswith(">")
+
+
+class CellRecording:
+    """The output of a notebook cell, as it's rendered (see `HTMLRenderer.start_cell`)"""
+
+    def __init__(self, depth, image_count, cell_count):
+        # how many elements were open outside the cell
+        self.depth = depth
+        self.image_count = image_count
+        self.cell_count = cell_count
+        # the cell's output, once it has started
+        self.html = None
+        self.complete = False
+        self.valid = True
+
+
+class HTMLRenderer:
+    """
+    An lxml parser target that sanitises the events it's given and writes out the contents of the document's body
+    """
+
+    def __init__(
+        self, sink, buffer_size, images=None, tables=None, table_min_rows=None
+    ):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.images = images
+        self.tables = tables
+        self.table_min_rows = table_min_rows
+        # the table we're capturing, if any
+        self._table = None
+        self._buffer = []
+        self._buffered = 0
+        self._text = []
+        # one (tag, whether we wrote out its tags) entry per open element
+        self._open = []
+        self._in_body = 0
+        self._killing = 0
+        self._preserving = 0
+        self._image_count = 0
+        self._cell_count = 0
+        # the notebook cell whose output we're recording, if any, and where we're writing its output to while it's open
+        self._recording = None
+        self._recorded = None
+
+    def start(self, tag, attrib):
+        tag = "img" if tag == "image" else tag
+        if self._recording is not None:
+            self._record_start(tag, attrib)
+        if self._killing or tag in KILL_TAGS:
+            self._killing += 1
+            return
+
+        if tag == "body":
+            self._in_body += 1
+        emit = self._in_body and tag != "body" and tag in ALLOWED_TAGS
+        self._open.append((tag, emit))
+        if not emit:
+            return
+
+        self._flush_text()
+        if tag == "table":
+            self._start_table(attrib)
+        elif self._table is not None and not self._table.start(tag, attrib):
+            self._release_table()
+        if tag in OVERFLOW_TAGS:
+            self._write('<div class="overflow-wrapper">')
+        extra_attrs = ""
+        if tag == "img":
+            attrib, extra_attrs = self._image_attrs(attrib)
+        elif tag == "div":
+            attrib = self._cell_attrs(attrib)
+        self._write(f"<{tag}{_render_attrs(attrib)}{extra_attrs}>")
+        if tag in WHITESPACE_PRESERVING_TAGS:
+            self._preserving += 1
+
+    def end(self, tag):
+        tag = "img" if tag == "image" else tag
+        if self._recording is not None and self._recorded is None:
+            # the end of something that isn't part of the cell
+            self._recording.valid = False
+        if self._killing:
+            self._killing -= 1
+            return
+
+        # libxml2 doesn't always end every element it starts, so an end closes any elements still open inside it, and
+        # one without a start is ignored
+        if tag not in (open_tag for open_tag, _ in self._open):
+            return
+        while True:
+            open_tag, emitted = self._open.pop()
+            self._end(open_tag, emitted)
+            if open_tag == tag:
+                break
+
+    def _end(self, tag, emitted):
+        if tag == "body":
+            self._in_body -= 1
+        if not emitted:
+            return
+
+        self._flush_text()
+        if tag in WHITESPACE_PRESERVING_TAGS:
+            self._preserving -= 1
+        if tag not in VOID_TAGS:
+            self._write(f"</{tag}>")
+        if tag in OVERFLOW_TAGS:
+            self._write("</div>")
+        if self._table is not None:
+            self._end_table_element(tag)
+        if self._recorded is not None and len(self._open) == self._recording.depth:
+            self._recording.complete = True
+            self._recorded = None
+
+    def data(self, data):
+        if self._in_body and not self._killing:
+            self._text.append(data)
+            if self._table is not None:
+                self._table.data(data)
+
+    def close(self):
+        while self._open:
+            self._end(*self._open.pop())
+        self._flush_text()
+        self.flush()
+
+    def cell_state(self):
+        """
+        Return what the output of a notebook cell rendered from here would depend on besides its HTML, or None if we
+        can't record or reuse a cell's output here
+        """
+        if (
+            self._killing
+            or self._preserving
+            or not self._in_body
+            or self._table is not None
+            or self._recording is not None
+        ):
+            return None
+        return (
+            min(self._image_count, EAGER_IMAGE_COUNT),
+            min(self._cell_count, EAGER_CELL_COUNT),
+            self.images is not None,
+            self.tables is not None and self.table_min_rows,
+        )
+
+    def start_cell(self):
+        """
+        Record the output of the notebook cell that starts with the next element
+
+        The recording is only usable if the next element is a cell, and nothing but that cell is rendered before
+        `end_cell` is called.
+        """
+        self._recording = CellRecording(
+            len(self._open), self._image_count, self._cell_count
+        )
+
+    def end_cell(self):
+        """Stop recording, and return the (html, image count, cell count) of the recorded cell, or None"""
+        recording, self._recording = self._recording, None
+        self._recorded = None
+        if not (recording.complete and recording.valid):
+            return None
+        return (
+            "".join(recording.html),
+            self._image_count - recording.image_count,
+            self._cell_count - recording.cell_count,
+        )
+
+    def replay_cell(self, html, image_count, cell_count):
+        """Write out the recorded output of a notebook cell, in place of rendering it"""
+        self._flush_text()
+        self._write(html)
+        self._image_count += image_count
+        self._cell_count += cell_count
+
+    def _record_start(self, tag, attrib):
+        recording = self._recording
+        if recording.html is not None:
+            if recording.complete:
+                # something after the cell
+                recording.valid = False
+            return
+        is_cell = (
+            tag == "div"
+            and not self._killing
+            and len(self._open) == recording.depth
+            and not CELL_CLASSES.isdisjoint(attrib.get("class", "").split())
+        )
+        if not is_cell:
+            recording.valid = False
+            recording.complete = True
+            return
+        # any text before the cell isn't part of it
+        self._flush_text()
+        recording.html = self._recorded = []
+
+    def flush(self):
+        if self._buffer:
+            self.sink.write("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def _flush_text(self):
+        # Text can arrive in several pieces, and can continue across elements that we drop, so we collect it up and
+        # only write it out when we next write a tag
+        if not self._text:
+            return
+        text = "".join(self._text)
+        self._text = []
+        if not self._preserving:
+            text = _collapse(text)
+        self._write(_escape_text(text))
+
+    def _image_attrs(self, attrib):
+        """
+        Return the attributes for an image, and any extra (already rendered) attributes to add to it
+
+        Reports can have hundreds of figures, so we have browsers load and decode them lazily, and give them a size
+        where we can so that the page doesn't reflow as they arrive.
+        """
+        attrib = self._extract_image(attrib)
+        self._image_count += 1
+        extra_attrs = ' decoding="async"'
+        if self._image_count > EAGER_IMAGE_COUNT:
+            extra_attrs += ' loading="lazy"'
+        return attrib, extra_attrs
+
+    def _extract_image(self, attrib):
+        # Notebooks embed their figures as base64 data URLs, which makes them a third bigger than they need to be and
+        # means that browsers can't cache them. We save them as files named by their content instead, so that they can
+        # be served with long-lived caching headers.
+        match = _match_embedded_image(attrib.get("src", ""))
+        if not match:
+            return attrib
+        image_type, data = match.groups()
+        try:
+            data = b64decode(data)
+        except binascii.Error:
+            return attrib
+
+        attrib = dict(attrib)
+        size = get_image_size(data)
+        if size and "width" not in attrib and "height" not in attrib:
+            attrib["width"], attrib["height"] = (str(n) for n in size)
+        if self.images is not None:
+            attrib["src"] = self.images.save(data, image_type.lower())
+        return attrib
+
+    def _cell_attrs(self, attrib):
+        # Cells far down a long report are marked so that the browser can skip laying them out and painting them until
+        # they're scrolled near to (see notebook.scss)
+        classes = attrib.get("class", "").split()
+        if CELL_CLASSES.isdisjoint(classes):
+            return attrib
+        self._cell_count += 1
+        if self._cell_count <= EAGER_CELL_COUNT:
+            return attrib
+        return {**attrib, "class": " ".join([*classes, DEFERRED_CELL_CLASS])}
+
+    def _start_table(self, attrib):
+        if self._table is not None:
+            if self._table.virtual:
+                # a table inside a cell of a virtual table; we just keep its text
+                self._table.nested += 1
+                return
+            # we don't virtualise tables with tables inside them
+            self._release_table()
+        if self.tables is not None:
+            self._table = TableCapture(
+                self.tables, self.table_min_rows, _render_attrs(attrib)
+            )
+
+    def _end_table_element(self, tag):
+        if tag != "table":
+            self._table.end(tag)
+        elif self._table.nested:
+            self._table.nested -= 1
+        else:
+            table, self._table = self._table, None
+            self._write(table.finish())
+
+    def _release_table(self):
+        """Stop capturing the current table, and write out what we've captured of it"""
+        table, self._table = self._table, None
+        self._write("".join(table.html))
+
+    def _write(self, html):
+        if self._table is not None:
+            self._table.write(html)
+            return
+        if self._recorded is not None:
+            self._recorded.append(html)
+        self._buffer.append(html)
+        self._buffered += len(html)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+
+class TableCapture:
+    """
+    Collects a table's output and data while we find out how big it is
+
+    A small table is written out as it is.  Once a table has more than `min_rows` rows,
+    we stop keeping its output, and instead write its data to the table store as it
+    arrives.  It's replaced with a <virtual-table> element, which shows a preview of its
+    first few rows and loads the rest when it's needed (see _virtual-table.js), so that
+    huge tables don't make huge pages.
+
+    The data is JSON, with the text of the header rows and of the body rows as lists of
+    cells: {"header": [[...], ...], "rows": [[...], ...]}
+    """
+
+    def __init__(self, store, min_rows, attrs):
+        self.store = store
+        self.min_rows = min_rows
+        self.attrs = attrs
+        # the table's output, until we decide to make it virtual
+        self.html = []
+        # the depth of any tables inside this one
+        self.nested = 0
+        self.header = []
+        self.preview = []
+        # body rows that we haven't written to the store yet
+        self.rows = []
+        self.row_count = 0
+        self.writer = None
+        self._rows_written = 0
+        self._in_head = False
+        self._row = None
+        self._cell = None
+
+    @property
+    def virtual(self):
+        return self.writer is not None
+
+    def write(self, html):
+        if not self.virtual:
+            self.html.append(html)
+
+    def start(self, tag, attrib):
+        """Handle the start of an element in the table; returns False if we can't virtualise the table"""
+        if tag == "thead":
+            self._in_head = True
+        elif tag == "tr":
+            self._row = []
+        elif tag in ("td", "th") and self._row is not None:
+            spans = "rowspan" in attrib or "colspan" in attrib
+            if spans and not self._in_head and not self.virtual:
+                # we can't show merged cells in a virtual table
+                return False
+            self._cell = []
+        return True
+
+    def data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def end(self, tag):
+        if tag == "thead":
+            self._in_head = False
+        elif tag in ("td", "th") and self._cell is not None:
+            self._row.append((tag, "".join(self._cell).strip(ASCII_SPACES)))
+            self._cell = None
+        elif tag == "tr" and self._row is not None:
+            self._add_row(self._row)
+            self._row = None
+
+    def finish(self):
+        """Return the output for the table, now that it has ended"""
+        if not self.virtual:
+            return "".join(self.html)
+        self.writer.write("]}")
+        self.writer.__exit__(None, None, None)
+        return self._render_preview()
+
+    def _add_row(self, row):
+        if self._in_head:
+            self.header.append(row)
+            return
+
+        self.row_count += 1
+        if len(self.preview) < VIRTUAL_TABLE_PREVIEW_ROWS:
+            self.preview.append(row)
+        if self.virtual:
+            self._write_row(row)
+            return
+        self.rows.append(row)
+        if self.row_count > self.min_rows:
+            self._make_virtual()
+
+    def _make_virtual(self):
+        self.html = None
+        self.writer = self.store.writer("json").__enter__()
+        header = [[text for _, text in row] for row in self.header]
+        self.writer.write(f'{{"header":{_to_json(header)},"rows":[')
+        for row in self.rows:
+            self._write_row(row)
+        self.rows = None
+
+    def _write_row(self, row):
+        separator = "," if self._rows_written else ""
+        self.writer.write(separator + _to_json([text for _, text in row]))
+        self._rows_written += 1
+
+    def _render_preview(self):
+        url = _escape_attr(self.writer.url)
+        rows = [
+            "<tr>"
+            + "".join(f"<{tag}>{_escape_text(text)}</{tag}>" for tag, text in row)
+            + "</tr>"
+            for row in self.header + self.preview
+        ]
+        header_count = len(self.header)
+        head = "".join(rows[:header_count])
+        body = "".join(rows[header_count:])
+        return (
+            f'<virtual-table data-src="{url}" data-rows="{self.row_count}">'
+            f'<div class="overflow-wrapper"><table{self.attrs}>'
+            f"<thead>{head}</thead><tbody>{body}</tbody></table></div>"
+            f'<p class="virtual-table__summary">Showing the first {len(self.preview)} of {self.row_count:,} rows. '
+            f'<a href="{url}" download>Download all rows (JSON)</a></p>'
+            "</virtual-table>"
+        )
+
+
+def _to_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _render_attrs(attrib):
+    attrs = []
+    for name, value in attrib.items():
+        if name not in SAFE_ATTRS:
+            continue
+        if name in LINK_ATTRS and _is_javascript_link(value):
+            value = ""
+        attrs.append(f' {name}="{_escape_attr(value)}"')
+    return "".join(attrs)
+
+
+def _is_javascript_link(link):
+    link = _substitute_whitespace("", unquote_plus(link))
+    safe_image_urls = 0
+    for image_type in _find_image_dataurls(link):
+        if _is_unsafe_image_type(image_type):
+            return True
+        safe_image_urls += 1
+    return len(_possibly_malicious_schemes(link)) > safe_image_urls
+
+
+def _collapse(text):
+    """
+    Reduce whitespace-only text to a single newline (or space, if it has no newlines)
+
+    Notebook exports are heavily indented, and none of that indentation is visible once rendered, so there's no point
+    in us storing or sending it.
+    """
+    if text.strip(ASCII_SPACES):
+        return text
+    return "\n" if "\n" in text else " "
+
 
-    soup = BeautifulSoup(cleaned, "html.parser")
+def _escape_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
-    # For small screens we want to allow side-scrolling for just a small number of elements. To enable this each one
-    # needs to be wrapped in a div that we can target for styling.
-    for tag in ["table", "pre"]:
-        for element in soup.find_all(tag):
-            element.wrap(soup.new_tag("div", attrs={"class": "overflow-wrapper"}))
 
-    body_content = "".join([str(element) for element in soup.body.contents])
-    return mark_safe(body_content)
+def _escape_attr(value):
+    return _escape_text(value).replace('"', "&quot;")
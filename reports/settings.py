@@ -149,7 +149,11 @@ DJANGO_VITE_DEV_MODE = env.bool("DJANGO_VITE_DEV_MODE", default=False)
 DJANGO_VITE_MANIFEST_PATH = BASE_DIR / "staticfiles" / "manifest.json"
 
 # Insert Whitenoise Middleware.
-STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+# The manifest is written by collectstatic, so the tests use the plain storage instead
+STATICFILES_STORAGE = env.str(
+    "STATICFILES_STORAGE",
+    default="whitenoise.storage.CompressedManifestStaticFilesStorage",
+)
 
 # EMAIL
 EMAIL_BACKEND = env.str("EMAIL_BACKEND", "django.core.mail.backends.dummy.EmailBackend")
@@ -170,13 +174,130 @@ initialise_sentry()
 INTERNAL_IPS = ["127.0.0.1"]
 
 # Caching
+# Hits, misses and evictions are counted by each worker, and added to the totals shared by
+# all of them every STATS_INTERVAL seconds (see counters.py)
+STATS_INTERVAL = env.float("STATS_INTERVAL", default=60)
+# Rendered page fragments (see the `{% cache %}` tag in report.html) are cached in the
+# database, shared by all hosts, up to FRAGMENT_CACHE_MAX_ENTRIES entries.  Each host keeps
+# a copy on disk, up to FRAGMENT_CACHE_MAX_SIZE bytes, and each worker keeps those it's used
+# most recently in memory, up to FRAGMENT_CACHE_MEMORY_SIZE bytes (see tiered_cache.py)
+FRAGMENT_CACHE_DIR = env.path("FRAGMENT_CACHE_DIR", default=BASE_DIR / "fragment_cache")
+FRAGMENT_CACHE_MAX_ENTRIES = env.int("FRAGMENT_CACHE_MAX_ENTRIES", default=10000)
+FRAGMENT_CACHE_MAX_SIZE = env.int("FRAGMENT_CACHE_MAX_SIZE", default=256 * 1024**2)
+FRAGMENT_CACHE_MEMORY_SIZE = env.int(
+    "FRAGMENT_CACHE_MEMORY_SIZE", default=32 * 1024**2
+)
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.db.DatabaseCache",
         "LOCATION": "cache_table",
-    }
+    },
+    "shared_fragments": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "fragment_cache_table",
+        # each fragment takes two entries: its value, and its token
+        "OPTIONS": {"MAX_ENTRIES": 2 * FRAGMENT_CACHE_MAX_ENTRIES},
+    },
+    "template_fragments": {
+        "BACKEND": "reports.tiered_cache.TieredCache",
+        "LOCATION": FRAGMENT_CACHE_DIR,
+        "OPTIONS": {
+            "SHARED": "shared_fragments",
+            "MAX_SIZE": FRAGMENT_CACHE_MAX_SIZE,
+            "MEMORY_MAX_SIZE": FRAGMENT_CACHE_MEMORY_SIZE,
+            "STATS_INTERVAL": STATS_INTERVAL,
+        },
+    },
 }
 
+# Each worker keeps the sidebar's navigation in memory, and checks whether it's changed at
+# most every NAVIGATION_CHECK_INTERVAL seconds (see navigation.py)
+NAVIGATION_CHECK_INTERVAL = env.float("NAVIGATION_CHECK_INTERVAL", default=5)
+# With lots of reports, list only the categories in the sidebar of each page, and fetch the
+# reports in a category as it's expanded
+LAZY_SIDEBAR = env.bool("LAZY_SIDEBAR", default=False)
+
+# Fetching reports
+# Connections to GitHub and job-server are kept open and shared by a worker's threads; the
+# number of connections to each host that a worker keeps open
+HTTP_POOL_SIZE = env.int("HTTP_POOL_SIZE", default=10)
+# Responses from GitHub and job-server are cached on disk (see http_cache.py). Total size
+# in bytes of cached responses, beyond which the least recently used are evicted, and
+# whether to gzip them.
+HTTP_CACHE_DIR = env.path("HTTP_CACHE_DIR", default=BASE_DIR / "http_cache")
+HTTP_CACHE_MAX_SIZE = env.int("HTTP_CACHE_MAX_SIZE", default=256 * 1024**2)
+HTTP_CACHE_COMPRESS = env.bool("HTTP_CACHE_COMPRESS", default=True)
+
+# Once GitHub or job-server has failed CIRCUIT_FAILURE_THRESHOLD times in a row (within
+# CIRCUIT_FAILURE_WINDOW seconds), we stop making requests to it for CIRCUIT_RESET_TIMEOUT
+# seconds before trying again, and serve reports as we last rendered them (see circuits.py)
+CIRCUIT_FAILURE_THRESHOLD = env.int("CIRCUIT_FAILURE_THRESHOLD", default=5)
+CIRCUIT_FAILURE_WINDOW = env.float("CIRCUIT_FAILURE_WINDOW", default=60)
+CIRCUIT_RESET_TIMEOUT = env.float("CIRCUIT_RESET_TIMEOUT", default=30)
+
+# Rendering
+# Number of characters of rendered report held in memory before being written out
+RENDER_BUFFER_SIZE = env.int("RENDER_BUFFER_SIZE", default=64 * 1024)
+
+# Rendered report fragments are stored on disk, keyed by a hash of their content
+FRAGMENT_STORE_DIR = env.path("FRAGMENT_STORE_DIR", default=BASE_DIR / "fragments")
+# Total size in bytes of stored fragments; the least recently used are evicted beyond this
+FRAGMENT_STORE_MAX_SIZE = env.int("FRAGMENT_STORE_MAX_SIZE", default=1024**3)
+# The rendered output of notebook cells is stored in the same way, so that cells which are
+# unchanged when a report is re-released don't need to be rendered again
+CELL_STORE_DIR = env.path("CELL_STORE_DIR", default=BASE_DIR / "cells")
+CELL_STORE_MAX_SIZE = env.int("CELL_STORE_MAX_SIZE", default=1024**3)
+
+# Images extracted from rendered reports are stored on disk, named by a hash of their
+# content, and removed once no stored fragment refers to them
+REPORT_IMAGES_DIR = env.path("REPORT_IMAGES_DIR", default=BASE_DIR / "report-images")
+# The data from large tables in reports is stored on disk, and removed, in the same way
+REPORT_TABLES_DIR = env.path("REPORT_TABLES_DIR", default=BASE_DIR / "report-tables")
+# Tables with more rows than this are replaced with a preview, and their data is loaded by
+# the browser when it's needed
+VIRTUAL_TABLE_MIN_ROWS = env.int("VIRTUAL_TABLE_MIN_ROWS", default=1000)
+
+# How long in seconds gunicorn lets a web worker handle a request before killing it (also
+# read by gunicorn.conf.py). Fetching and rendering a report must fit well within it, or
+# the worker is killed before we can say that the report is too large.
+WORKER_TIMEOUT = env.int("WORKER_TIMEOUT", default=60)
+
+# Reports are rendered in child processes, so that a pathological report can't tie up or
+# take down a web worker. The number of renders each web worker runs at once, how long in
+# seconds a render may take (which must be less than WORKER_TIMEOUT; see checks.py), and
+# how much resident memory in bytes it may use.
+RENDER_WORKERS = env.int("RENDER_WORKERS", default=2)
+RENDER_TIMEOUT = env.float("RENDER_TIMEOUT", default=20)
+RENDER_MAX_MEMORY = env.int("RENDER_MAX_MEMORY", default=1024**3)
+
+# Only one worker at a time fetches and renders a report, across all processes and hosts
+# (see locks.py); the others wait for it to finish. How long in seconds a worker may hold
+# a lock before it expires (in case it's killed), how long the others wait before giving
+# up and saying that the report is being refreshed (which, with RENDER_TIMEOUT, must be
+# less than WORKER_TIMEOUT; see checks.py), and how often they check.
+LOCK_TIMEOUT = env.float("LOCK_TIMEOUT", default=5 * 60)
+LOCK_WAIT = env.float("LOCK_WAIT", default=5)
+LOCK_POLL_INTERVAL = env.float("LOCK_POLL_INTERVAL", default=0.5)
+
+# Rendered report content is cached for REPORT_CONTENT_MAX_AGE seconds. Once it's older than
+# REPORT_CONTENT_REFRESH_AFTER, it's still served, but a background worker checks the report
+# file for changes and refreshes it (see refresh.py). The worker checks for reports to
+# refresh every REFRESH_POLL_INTERVAL seconds, and is started with gunicorn if
+# REFRESH_WORKER is on.
+REPORT_CONTENT_MAX_AGE = env.int("REPORT_CONTENT_MAX_AGE", default=7 * 24 * 60 * 60)
+REPORT_CONTENT_REFRESH_AFTER = env.int(
+    "REPORT_CONTENT_REFRESH_AFTER", default=24 * 60 * 60
+)
+REFRESH_POLL_INTERVAL = env.float("REFRESH_POLL_INTERVAL", default=5)
+REFRESH_WORKER = env.bool("REFRESH_WORKER", default=True)
+# The worker also checks all reports hosted on GitHub for changes, with one request per
+# repo, every REFRESH_CHECK_INTERVAL seconds (or never, if it's 0)
+REFRESH_CHECK_INTERVAL = env.float("REFRESH_CHECK_INTERVAL", default=60 * 60)
+
+# Stream report pages that aren't cached yet, sending the page around the report before
+# the report itself has been fetched and rendered
+STREAM_REPORTS = env.bool("STREAM_REPORTS", default=True)
+
 
 # CSP
 # https://django-csp.readthedocs.io/en/latest/configuration.html
@@ -188,14 +309,14 @@ CSP_DEFAULT_SRC = ["'none'"]
 CSP_STYLE_SRC = CSP_STYLE_SRC_ELEM = ["'self'", "https://fonts.googleapis.com"]
 CSP_SCRIPT_SRC = CSP_SCRIPT_SRC_ELEM = ["'self'", "https://plausible.io"]
 
-CSP_CONNECT_SRC = ["https://plausible.io"]
+CSP_CONNECT_SRC = ["'self'", "https://plausible.io"]
 CSP_FONT_SRC = ["'self'", "https://fonts.gstatic.com"]
 CSP_IMG_SRC = ["'self'", "data:"]
 CSP_MANIFEST_SRC = ["'self'"]
 
 # configure django-csp to work with Vite when using it in dev mode
 if DJANGO_VITE_DEV_MODE:
-    CSP_CONNECT_SRC = ["ws://localhost:3000/static/"]
+    CSP_CONNECT_SRC = ["'self'", "ws://localhost:3000/static/"]
     CSP_SCRIPT_SRC_ELEM = ["'self'", "http://localhost:3000"]
     CSP_STYLE_SRC_ELEM = ["'self'", "https://fonts.googleapis.com", "'unsafe-inline'"]
 
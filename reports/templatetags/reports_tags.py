@@ -1,25 +1,24 @@
 from django import template
 
-from ..rendering import process_html
+from ..fragments import fragment_placeholder, store_report_fragment
 
 
 register = template.Library()
 
 
-@register.simple_tag(takes_context=True)
-def category_reports_for_user(context, category):
-    """Filter out draft reports in a category if the current user is not logged in, or doesn't have permission"""
-    user = context["user"]
-    return category.reports.for_user(user)
-
-
 @register.simple_tag
 def render_html(remote_cls):
     """
     Render HTML from a "remote" class instance
 
     We cache the rendered report template so we don't want to pull the HTML via
-    the given remote class on each page load.  This allows us to call the
-    process_html function inside the cached template fragment named `report_content`.
+    the given remote class on each page load.  This allows us to render the HTML
+    inside the cached template fragment named `report_content`.
+
+    When the cache token changes but the report's content hasn't, we reuse the
+    previously rendered HTML from the fragment store rather than rendering it again,
+    and if the report file hasn't changed upstream, we don't fetch it either.
+    The HTML itself isn't included in the page, but a placeholder for it, which is
+    replaced with the stored fragment as the page is served (see views.report_response).
     """
-    return process_html(remote_cls.get_html())
+    return fragment_placeholder(store_report_fragment(remote_cls))
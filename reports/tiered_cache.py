@@ -0,0 +1,408 @@
+"""
+A cache backend for rendered page fragments, kept in memory and on disk in front of a
+shared cache
+
+The `{% cache %}` tag in report.html keeps each report's rendered content in the
+template_fragments cache.  In the database cache, every lookup was a query that read the
+pickled content back, and once there were MAX_ENTRIES entries a third of them were culled,
+at random and whatever their size.  Instead, each worker process keeps the values it's
+used most recently in memory, up to MEMORY_MAX_SIZE bytes, in front of a copy on disk, of
+which the least recently used are evicted once they add up to more than MAX_SIZE bytes
+(as stored fragments are; see fragments.py).
+
+The disk is each host's own, but the content is refreshed by whichever host's worker
+picks up the request to refresh it (see refresh.py), so every value is also kept in the
+SHARED cache (a database cache of its own), which is what's durable.  A lookup reads only
+the value's token from there, and the value itself is served from memory or disk if it's
+the one with that token (as the token is at the start of its file, that's much cheaper
+than reading the whole file), and otherwise read from the shared cache and kept on disk.
+Without a SHARED cache, the disk is all there is, and what's cached isn't shared between
+hosts.
+
+Looking at every file to find out how much is on disk is only worth it once there might
+be too much, so each process keeps an estimate: the total it found when it last looked,
+plus what it's written since.  It looks again once that's over MAX_SIZE, or every
+EVICT_INTERVAL seconds, to catch up with what other processes have written.
+
+Hits (from memory and from disk), misses and evictions are counted by each process, and
+added to totals in the default cache every STATS_INTERVAL seconds, rather than with a
+query for every lookup (see counters.py); see the `fragment_cache_stats` management
+command.
+"""
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from uuid import uuid4
+
+import structlog
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from . import counters
+from .fragments import DiskUsage, least_recently_used
+
+
+logger = structlog.getLogger()
+
+# Django makes an instance of a cache backend for each thread, so what's kept in memory,
+# and the estimate of what's on disk, are shared by the instances for each location
+_memory_tiers = {}
+_disk_usage = {}
+_shared_lock = threading.Lock()
+
+COUNTERS = (
+    "memory_hits",
+    "disk_hits",
+    "shared_hits",
+    "misses",
+    "memory_evictions",
+    "disk_evictions",
+)
+
+_MISSING = object()
+
+
+class TieredCache(BaseCache):
+    """
+    A cache that keeps values in memory in front of files on disk, in front of a shared
+    cache
+
+    Options:
+        SHARED (str): the alias of the cache that values are kept in for every host
+        MAX_SIZE (int): total size in bytes of the values on disk, above which the least
+        recently used are evicted
+        MEMORY_MAX_SIZE (int): total size in bytes (as pickled) of the values each
+        process keeps in memory
+        STATS_INTERVAL (float): how often in seconds each process adds its counts to the
+        totals in the default cache
+        EVICT_INTERVAL (float): how often in seconds each process looks at what's on disk
+        as it sets values, even if its estimate of the total is within MAX_SIZE
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self.location = Path(location)
+        self.max_size = options.get("MAX_SIZE", 256 * 1024**2)
+        self.memory_max_size = options.get("MEMORY_MAX_SIZE", 32 * 1024**2)
+        self.shared_alias = options.get("SHARED")
+        with _shared_lock:
+            self.memory = _memory_tiers.setdefault(
+                str(self.location), MemoryTier(self.memory_max_size)
+            )
+            self.disk_usage = _disk_usage.setdefault(
+                str(self.location),
+                DiskUsage(self.max_size, options.get("EVICT_INTERVAL", 60)),
+            )
+        self.counts = counters.get_counter(
+            "tiered_cache", COUNTERS, options.get("STATS_INTERVAL", 60)
+        )
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # Not atomic across processes, as with Django's file-based cache
+        if self.has_key(key, version=version):  # noqa: W601
+            return False
+        self.set(key, value, timeout, version=version)
+        return True
+
+    @property
+    def shared(self):
+        # looked up when it's used, as Django's caches are per thread
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        shared = self.shared
+        if shared is None:
+            value = self._get_local(key)
+        else:
+            # the token of the value that every host should be serving
+            token = shared.get(_token_key(key))
+            value = _MISSING if token is None else self._get_local(key, token)
+            if value is _MISSING and token is not None:
+                value = self._get_shared(key, shared)
+
+        if value is _MISSING:
+            self._delete(key)
+            self.counts.count("misses")
+            return default
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):  # noqa: A003
+        key = self.make_and_validate_key(key, version=version)
+        expires = self.get_backend_timeout(timeout)
+        shared = self.shared
+        if _has_expired(expires):
+            self._delete(key)
+            if shared is not None:
+                shared.delete_many([key, _token_key(key)])
+            return
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        token = uuid4().hex
+        if shared is not None:
+            # the value first, so that anyone who reads the new token can read it too
+            shared.set_many(
+                {key: (token, expires, data), _token_key(key): token},
+                _remaining(expires),
+            )
+        self._store(key, token, expires, value, data)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        expires = self.get_backend_timeout(timeout)
+        shared = self.shared
+        if shared is None:
+            return self._touch_local(key, expires)
+
+        entry = shared.get(key)
+        if entry is None:
+            return False
+        token, _, data = entry
+        shared.set_many(
+            {key: (token, expires, data), _token_key(key): token}, _remaining(expires)
+        )
+        self._touch_local(key, expires)
+        return True
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        deleted = self._delete(key)
+        shared = self.shared
+        if shared is None:
+            return deleted
+        shared.delete(_token_key(key))
+        return shared.delete(key)
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        shared = self.shared
+        if shared is not None:
+            return shared.has_key(_token_key(key))  # noqa: W601
+        try:
+            with self._path(key).open("rb") as f:
+                _, expires = _parse_header(f.readline())
+        except FileNotFoundError:
+            return False
+        return not _has_expired(expires)
+
+    def clear(self):
+        self.memory.clear()
+        shutil.rmtree(self.location, ignore_errors=True)
+        self.disk_usage.checked(0)
+        if self.shared is not None:
+            self.shared.clear()
+
+    def forget(self):
+        """
+        Forget what this process keeps for the cache's location: the values in memory,
+        and the estimate of what's on disk
+        """
+        with _shared_lock:
+            _memory_tiers.pop(str(self.location), None)
+            _disk_usage.pop(str(self.location), None)
+
+    def evict(self):
+        """Remove the least recently used values from disk until we're within max_size"""
+        files = self._files()
+        sizes = {path: size for _, size, path in files}
+        size = sum(sizes.values())
+        for path in least_recently_used(files, self.max_size):
+            path.unlink(missing_ok=True)
+            size -= sizes[path]
+            self.counts.count("disk_evictions")
+            logger.info("Evicted cached fragment", key=path.name)
+        self.disk_usage.checked(size)
+
+    def stats(self):
+        files = self._files()
+        return {
+            **self.counts.totals(),
+            "count": len(files),
+            "size": sum(size for _, size, _ in files),
+        }
+
+    def _get_local(self, key, token=None):
+        """The value from memory or disk, if it's the one with `token` (if given)"""
+        path = self._path(key)
+        try:
+            with path.open("rb") as f:
+                local_token, expires = _parse_header(f.readline())
+                if _has_expired(expires) or token not in (None, local_token):
+                    return _MISSING
+                value = self.memory.get(key, local_token)
+                if value is not _MISSING:
+                    self.counts.count("memory_hits")
+                else:
+                    data = f.read()
+                    value = pickle.loads(data)
+                    self._remember(key, local_token, value, len(data))
+                    self.counts.count("disk_hits")
+        except FileNotFoundError:
+            return _MISSING
+        # mark as recently used, for eviction
+        _touch(path)
+        return value
+
+    def _touch_local(self, key, expires):
+        try:
+            with self._path(key).open("rb") as f:
+                token, old_expires = _parse_header(f.readline())
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        if _has_expired(old_expires):
+            return False
+        # the token stays the same, so that the value is still served from memory
+        self._write(key, token, expires, data)
+        return True
+
+    def _get_shared(self, key, shared):
+        """The value from the shared cache, which is kept on disk and in memory"""
+        entry = shared.get(key)
+        if entry is None:
+            return _MISSING
+        token, expires, data = entry
+        if _has_expired(expires):
+            return _MISSING
+        value = pickle.loads(data)
+        self._store(key, token, expires, value, data)
+        self.counts.count("shared_hits")
+        return value
+
+    def _store(self, key, token, expires, value, data):
+        """Keep a value on disk and in memory"""
+        size = self._write(key, token, expires, data)
+        self._remember(key, token, value, len(data))
+        if self.disk_usage.add(size):
+            self.evict()
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return self.location / name[:2] / name
+
+    def _remember(self, key, token, value, size):
+        for _ in range(self.memory.put(key, token, value, size)):
+            self.counts.count("memory_evictions")
+
+    def _write(self, key, token, expires, data):
+        """Write a value's file, and return its size"""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        header = _header(token, expires)
+        try:
+            with open(fd, "wb") as f:
+                f.write(header)
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return len(header) + len(data)
+
+    def _delete(self, key):
+        self.memory.discard(key)
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _files(self):
+        """A list of (mtime, size, path) of the files on disk"""
+        files = []
+        for path in self.location.glob("*/*"):
+            if path.name.endswith(".tmp"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # pragma: no cover
+                # evicted by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+
+class MemoryTier:
+    """The most recently used values, by key, up to `max_size` bytes (as pickled)"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, token):
+        """The value for `key`, if we have the one with `token`"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != token:
+                return _MISSING
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, token, value, size):
+        """Keep a value, and return how many others were evicted to make room for it"""
+        with self.lock:
+            self._discard(key)
+            if size > self.max_size:
+                return 0
+            self.entries[key] = (token, value, size)
+            self.size += size
+            evicted = 0
+            while self.size > self.max_size:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                evicted += 1
+            return evicted
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+
+def _header(token, expires):
+    return f"{token} {'-' if expires is None else repr(expires)}\n".encode("ascii")
+
+
+def _parse_header(line):
+    token, _, expires = line.decode("ascii").strip().partition(" ")
+    return token, None if expires == "-" else float(expires)
+
+
+def _token_key(key):
+    """The key of a value's token in the shared cache"""
+    return f"{key}:token"
+
+
+def _remaining(expires):
+    """The timeout, in seconds from now, of a value that `expires`"""
+    return None if expires is None else expires - time.time()
+
+
+def _has_expired(expires):
+    return expires is not None and expires <= time.time()
+
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except FileNotFoundError:  # pragma: no cover
+        # evicted by another process since we read it, which is fine, as we have it
+        pass
@@ -16,16 +16,31 @@ Including another URLconf
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 from django.views.generic import RedirectView
 
-from .views import landing, report_view
+from .views import landing, navigation_reports, report_image, report_table, report_view
 
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("reports/", RedirectView.as_view(url="/", permanent=True)),
     path("reports/<slug:slug>/", report_view, name="report_view"),
+    re_path(
+        r"^report-images/(?P<name>[0-9a-f]{64}\.[a-z]+)$",
+        report_image,
+        name="report_image",
+    ),
+    re_path(
+        r"^report-tables/(?P<name>[0-9a-f]{64}\.json)$",
+        report_table,
+        name="report_table",
+    ),
+    path(
+        "navigation/<int:category_id>.json",
+        navigation_reports,
+        name="navigation_reports",
+    ),
     path("", landing, name="landing"),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
 
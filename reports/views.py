@@ -1,56 +1,58 @@
+import re
 from datetime import datetime
+from functools import partial
 
 import structlog
-from django.db.models import F, Q, Value
-from django.http import Http404
+from django.conf import settings
+from django.http import FileResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
-from django.template.response import TemplateResponse
-from django.views.decorators.cache import never_cache
+from django.template.loader import render_to_string
+from django.utils.cache import patch_vary_headers
+from django.utils.safestring import mark_safe
+from django.views.decorators.cache import cache_control, never_cache
+from django.views.decorators.http import condition
+from osgithub import GithubAPIException
+from requests.exceptions import RequestException
 
+from . import navigation
+from .circuits import CircuitBreaker
+from .compression import FILE_ENCODINGS, GzipSplicer
+from .fragments import (
+    fragment_placeholder,
+    get_fragment_store,
+    get_image_store,
+    get_table_store,
+    split_placeholders,
+    store_report_fragment,
+)
 from .github import GithubReport
 from .job_server import JobServerReport
+from .locks import LockTimeout
 from .models import Report
+from .refresh import get_fragment_cache, is_stale, report_content_key, request_refresh
+from .workers import RenderError, RenderMemoryExceeded, RenderTimeout
 
 
 logger = structlog.getLogger()
 
+# Placeholders for the parts of a streamed report page that are rendered separately
+REPORT_CONTENT_PLACEHOLDER = mark_safe("<!-- report-content -->")
 
-@never_cache
-def landing(request):
-    """Landing page for main site and post-login.  Displays recent Report activity"""
-    # We want the ten most recently published or updated outputs, without duplication. Until we've pulled them all
-    # back and compared their activity dates we don't know which ones we will be using, so we grab ten of each which
-    # must be enough.
-    all_reports = Report.objects.for_user(request.user).exclude(
-        category__name__iexact="archive"
-    )
+# How much of a stored fragment we read at a time, as we serve it
+FRAGMENT_CHUNK_SIZE = 64 * 1024
 
-    # To avoid duplication of reports in the activity list, we don't display the publication event for reports that
-    # have subsequently been updated. However if they are updated on the same day that they were published then we
-    # just consider that as a single publication event. The sum total of this is that we are only interested in
-    # publication dates where there has been no update or where the update date is the same as publication.
-    published = (
-        all_reports.filter(
-            Q(last_updated__isnull=True) | Q(publication_date__exact=F("last_updated")),
-        )
-        .order_by("-publication_date")[:10]
-        .annotate(activity=Value("published"), activity_date=F("publication_date"))
-    )
+# How long in seconds we ask a client to wait before trying again, when a report is still
+# being rendered by another worker (see locks.py)
+REFRESHING_RETRY_AFTER = 10
 
-    # As above, we ignore updates when they happen on the same day as publication.
-    updated = (
-        all_reports.filter(
-            last_updated__isnull=False,
-            last_updated__gt=F("publication_date"),
-        )
-        .order_by("-last_updated")[:10]
-        .annotate(activity=Value("updated"), activity_date=F("last_updated"))
-    )
 
-    # Merge the publish and update events and grab the ten most recent.
-    recent_activity = sorted(
-        [*published, *updated], key=lambda x: x.activity_date, reverse=True
-    )[:10]
+@never_cache
+def landing(request):
+    """
+    Landing page for main site and post-login.  Displays recent Report activity, which
+    each worker keeps in memory (see navigation.py)
+    """
+    recent_activity = navigation.recent_activity_for_user(request.user)
     context = {
         "recent_activity": recent_activity,
         "today": datetime.utcnow().date(),
@@ -63,8 +65,22 @@ def report_view(request, slug):
     """
     Fetches an html report file from github, and renders the style and body tags within
     the report template page.  This entire view is never cached, however the template content is cached (in the template)
-    for 24 hours using the report's cache_token as a key, and can be forced to refetch and update the cache with the
-    `force-update` query parameter.
+    for REPORT_CONTENT_MAX_AGE using the report's cache_token as a key, and can be forced to refetch and update the cache
+    with the `force-update` query parameter.  Content older than REPORT_CONTENT_REFRESH_AFTER is still served, but is
+    refreshed in the background (see refresh.py).
+
+    If the report content isn't cached, fetching and rendering it can take a while, so (with `STREAM_REPORTS` on) we
+    stream the page instead of waiting for it all to be ready (see `stream_report`).
+
+    The report's body is served from the fragment store rather than the template cache, gzipped if the client accepts
+    it (see `report_response`).
+
+    While the report's upstream (GitHub or job-server) is failing, and its content isn't cached, we serve it as we
+    last rendered it, saying that it may be out of date, rather than trying to fetch it (see circuits.py).  We do the
+    same if fetching it fails.
+
+    Only one worker renders a report at a time; if it's being rendered by another, we wait for that to finish, or
+    say that the report is being refreshed if it takes too long (see locks.py).
     """
     try:
         report = Report.objects.for_user(request.user).get(slug=slug)
@@ -84,11 +100,274 @@ def report_view(request, slug):
     remote_cls = GithubReport if report.uses_github else JobServerReport
     remote = remote_cls(report)
 
-    return TemplateResponse(
-        request,
-        "report.html",
+    context = {
+        "remote": remote,
+        "report": report,
+        "content_max_age": settings.REPORT_CONTENT_MAX_AGE,
+    }
+    compressed = accepts_encoding(request, "gzip")
+    fragment_key = report_content_key(report)
+    cached = fragment_key in get_fragment_cache()
+    if cached and is_stale(report):
+        # serve the content we have, and refresh it in the background (see refresh.py)
+        request_refresh(report)
+    elif not cached and CircuitBreaker(remote.upstream).is_open():
+        # Rather than trying to fetch the report, serve it as we last rendered it, if we
+        # can. That isn't cached, so the first request once the upstream recovers fetches it.
+        context["report_content"] = last_rendered_content(context)
+    if settings.STREAM_REPORTS and not cached and not context.get("report_content"):
+        return stream_report(request, context, fragment_key, compressed)
+
+    try:
+        # Render now rather than once we've started responding, so that we can show an
+        # error page if the report can't be rendered
+        page = render_to_string("report.html", context, request)
+        parts = open_fragments(page, remote, compressed)
+    except (RequestException, GithubAPIException) as error:
+        # osgithub raises GithubAPIException for errors from GitHub, such as going over
+        # its rate limit (which counts towards its circuit; see circuits.is_failure)
+        logger.error("Error fetching report", report_id=report.pk, error=str(error))
+        content = last_rendered_content(context)
+        if content is None:
+            return render(request, "report_error.html", {"report": report}, status=503)
+        page = render_to_string(
+            "report.html", {**context, "report_content": content}, request
+        )
+        parts = open_fragments(page, remote, compressed)
+    except RenderError as error:
+        logger.error("Error rendering report", report_id=report.pk, error=str(error))
+        return render(
+            request,
+            "report_error.html",
+            {"report": report, "too_large": is_over_budget(error)},
+            status=500,
+        )
+    except LockTimeout:
+        logger.info("Report is still being rendered", report_id=report.pk)
+        response = render(
+            request,
+            "report_error.html",
+            {"report": report, "refreshing": True},
+            status=503,
+        )
+        response["Retry-After"] = REFRESHING_RETRY_AFTER
+        return response
+    return report_response(parts, compressed)
+
+
+def last_rendered_content(context):
+    """
+    The report's content as we last rendered it, saying that it may be out of date, or
+    None if its rendered body is no longer stored
+    """
+    report = context["report"]
+    store = get_fragment_store()
+    if not report.fragment_key or not store.path(report.fragment_key).exists():
+        return None
+    logger.info("Serving last rendered report", report_id=report.pk)
+    return render_to_string(
+        "partials/report_content.html",
         {
-            "remote": remote,
-            "report": report,
+            **context,
+            "out_of_date": True,
+            "report_body": fragment_placeholder(report.fragment_key),
         },
     )
+
+
+def is_over_budget(error):
+    return isinstance(error, (RenderTimeout, RenderMemoryExceeded))
+
+
+def accepts_encoding(request, encoding):
+    # the same check as Django's GZipMiddleware
+    return bool(
+        re.search(rf"\b{encoding}\b", request.headers.get("Accept-Encoding", ""))
+    )
+
+
+def open_fragments(html, remote, compressed):
+    """
+    Split a page into its text and the stored fragments that it refers to, opened ready
+    to serve (gzipped, if `compressed`)
+
+    A fragment that's since been evicted from the store is rendered again.
+    """
+    store = get_fragment_store()
+    parts = split_placeholders(html)
+    for i in range(1, len(parts), 2):
+        file = store.open_fragment(parts[i], compressed)
+        if file is None:
+            file = store.open_fragment(store_report_fragment(remote, store), compressed)
+        parts[i] = file
+    return parts
+
+
+def report_response(parts, compressed):
+    """
+    Serve a report page from its `parts`: text, and stored fragment files
+
+    If the client accepts gzip, the text is compressed as we go and the fragments'
+    gzipped copies are spliced in (see compression.py), so that we only pay to compress
+    the small part of the page that isn't the report itself.
+    """
+    response = StreamingHttpResponse(encode_report(parts, compressed))
+    if compressed:
+        response["Content-Encoding"] = "gzip"
+    patch_vary_headers(response, ["Accept-Encoding"])
+    return response
+
+
+def encode_report(parts, compressed):
+    splicer = GzipSplicer() if compressed else None
+    for part in parts:
+        if isinstance(part, str):
+            if part:
+                data = part.encode("utf-8")
+                yield splicer.compress(data) if splicer else data
+            continue
+
+        with part:
+            if splicer:
+                yield from splicer.splice(part, FRAGMENT_CHUNK_SIZE)
+            else:
+                yield from iter(partial(part.read, FRAGMENT_CHUNK_SIZE), b"")
+    if splicer:
+        yield splicer.finish()
+
+
+def stream_report(request, context, fragment_key, compressed):
+    """
+    Stream a report page whose content isn't cached yet
+
+    The rest of the page (the layout, sidebar and so on) is rendered and sent straight
+    away.  The report's content follows once it has been rendered (its header shows when
+    the report was last updated, which we only know once we've asked its upstream).  The
+    content is cached in the same way as the `{% cache %}` tag in report.html would.
+    """
+    page = render_to_string(
+        "report.html",
+        {**context, "report_content": REPORT_CONTENT_PLACEHOLDER},
+        request,
+    )
+    page_start, page_end = page.split(REPORT_CONTENT_PLACEHOLDER)
+
+    def stream():
+        yield page_start
+        try:
+            yield from stream_report_content(context, fragment_key, compressed)
+        except LockTimeout:
+            logger.info(
+                "Report is still being rendered", report_id=context["report"].pk
+            )
+            yield render_to_string("partials/report_error.html", {"refreshing": True})
+        except (RequestException, GithubAPIException) as error:
+            logger.error(
+                "Error fetching report",
+                report_id=context["report"].pk,
+                error=str(error),
+            )
+            content = last_rendered_content(context)
+            if content is None:
+                yield render_to_string("partials/report_error.html")
+            else:
+                yield from open_fragments(content, context["remote"], compressed)
+        except Exception as error:
+            # We've already sent the response's status, so the best we can do is say so
+            # in the page.  Any elements we'd opened are closed by the browser at the end
+            # of the page's <main>.
+            logger.exception("Error streaming report", report_id=context["report"].pk)
+            yield render_to_string(
+                "partials/report_error.html", {"too_large": is_over_budget(error)}
+            )
+        yield page_end
+
+    response = report_response(stream(), compressed)
+    # Tell nginx not to buffer the response, or the browser won't see the page shell any sooner
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def stream_report_content(context, fragment_key, compressed):
+    # rendering the content stores the report's body, as a placeholder for its fragment
+    content = render_to_string("partials/report_content.html", context)
+    # the body is served from the store, just as it is when the page is cached
+    yield from open_fragments(content, context["remote"], compressed)
+
+    get_fragment_cache().set(fragment_key, content, settings.REPORT_CONTENT_MAX_AGE)
+
+
+@cache_control(public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+def report_image(request, name):
+    """
+    Serves an image extracted from a rendered report.  Images are named by the hash of
+    their content, so they never change and can be cached indefinitely.
+    """
+    return serve_stored_file(request, get_image_store(), name)
+
+
+@cache_control(public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+def report_table(request, name):
+    """
+    Serves the data from a large table extracted from a rendered report.  Like images,
+    these are named by the hash of their content and can be cached indefinitely.
+    """
+    return serve_stored_file(request, get_table_store(), name)
+
+
+def navigation_etag(request, category_id):
+    """
+    The ETag of the reports in a category, as a user can see them
+
+    It changes whenever the navigation does (see navigation.py), and differs between the
+    classes of user who see different reports.
+    """
+    can_view_drafts, is_staff = navigation.visibility(request.user)
+    return f"{navigation.version()}-{category_id}-{can_view_drafts:d}{is_staff:d}"
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=navigation_etag)
+def navigation_reports(request, category_id):
+    """
+    The reports in a category of the sidebar, which it fetches as the category is
+    expanded when LAZY_SIDEBAR is on.  Browsers keep them, and ask whether they've
+    changed with the ETag they were given.
+    """
+    for category in navigation.categories_for_user(request.user):
+        if category.id == category_id:
+            return JsonResponse(
+                {"reports": [report._asdict() for report in category.reports]}
+            )
+    raise Http404("Category does not exist")
+
+
+def serve_stored_file(request, store, name):
+    content_type = store.content_types.get(name.rsplit(".", 1)[-1])
+    if content_type is None:
+        raise Http404("File does not exist")
+
+    try:
+        file, encoding = open_stored_file(request, store, name)
+    except FileNotFoundError:
+        raise Http404("File does not exist")
+
+    response = FileResponse(file, content_type=content_type)
+    if store.precompress:
+        if encoding:
+            response["Content-Encoding"] = encoding
+        patch_vary_headers(response, ["Accept-Encoding"])
+    return response
+
+
+def open_stored_file(request, store, name):
+    """Open a stored file, or a compressed copy of it that the client accepts"""
+    path = store.path(name)
+    if store.precompress:
+        for encoding, extension in FILE_ENCODINGS.items():
+            if accepts_encoding(request, encoding):
+                try:
+                    return open(f"{path}.{extension}", "rb"), encoding
+                except FileNotFoundError:
+                    continue
+    return path.open("rb"), None
@@ -0,0 +1,105 @@
+"""
+Run report renders in child processes, within a time and memory budget
+
+A pathological report (deeply nested tables, millions of elements) can take a very long
+time and a lot of memory to render.  Rendering it in the web worker's own process would
+stop that worker serving any other requests, and could get it killed, so we render in a
+child process which we can kill if it goes over budget.
+"""
+import multiprocessing
+import resource
+import threading
+import time
+from functools import cache
+
+import structlog
+from django.conf import settings
+
+
+logger = structlog.getLogger()
+
+# How often we check on a render's progress, in seconds
+POLL_INTERVAL = 0.05
+
+# We rely on the child process inheriting the render's state (open files, the content to
+# render) rather than it being pickled across
+_context = multiprocessing.get_context("fork")
+
+
+class RenderError(Exception):
+    """A report could not be rendered"""
+
+
+class RenderTimeout(RenderError):
+    """A report took longer to render than it's allowed"""
+
+
+class RenderMemoryExceeded(RenderError):
+    """A report used more memory to render than it's allowed"""
+
+
+@cache
+def _worker_slots(count):
+    return threading.BoundedSemaphore(count)
+
+
+def run_render(render, timeout=None, max_memory=None):
+    """
+    Call `render()` in a child process, and wait for it to finish
+
+    `render` should write its output somewhere (such as a file that we've opened) rather
+    than return it.  If it takes longer than `timeout` seconds, or its resident memory
+    goes over `max_memory` bytes (including any memory it shares with this process), the
+    child is killed and we raise a RenderError.  The number of renders we run at once
+    is limited to `RENDER_WORKERS`, and waiting for a free worker counts towards the
+    timeout.
+    """
+    timeout = timeout if timeout is not None else settings.RENDER_TIMEOUT
+    max_memory = max_memory if max_memory is not None else settings.RENDER_MAX_MEMORY
+    deadline = time.monotonic() + timeout
+
+    slots = _worker_slots(settings.RENDER_WORKERS)
+    if not slots.acquire(timeout=timeout):
+        logger.warning("No render worker available", timeout=timeout)
+        raise RenderTimeout(f"No render worker became available in {timeout}s")
+
+    try:
+        process = _context.Process(target=render, daemon=True)
+        process.start()
+        started = time.monotonic()
+        try:
+            _wait(process, deadline, max_memory)
+        finally:
+            if process.is_alive():
+                process.kill()
+            process.join()
+    finally:
+        slots.release()
+
+    if process.exitcode != 0:
+        logger.error("Render failed", exitcode=process.exitcode)
+        raise RenderError(f"Render failed with exit code {process.exitcode}")
+    logger.info("Render complete", duration=round(time.monotonic() - started, 3))
+
+
+def _wait(process, deadline, max_memory):
+    while True:
+        process.join(POLL_INTERVAL)
+        if not process.is_alive():
+            return
+        if time.monotonic() > deadline:
+            logger.error("Render timed out", pid=process.pid)
+            raise RenderTimeout("Render took too long")
+        if max_memory and resident_memory(process.pid) > max_memory:
+            logger.error("Render exceeded its memory limit", pid=process.pid)
+            raise RenderMemoryExceeded("Render used too much memory")
+
+
+def resident_memory(pid):
+    """Return the resident memory in bytes of process `pid`, or 0 if we can't tell"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+    except (FileNotFoundError, IndexError, ValueError):  # pragma: no cover
+        return 0
+    return pages * resource.getpagesize()
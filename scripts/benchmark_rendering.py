@@ -0,0 +1,558 @@
+"""
+Benchmark report rendering, using a generated corpus of notebook exports
+
+Each case is a synthetic nbconvert (lab template) export, made up of one kind of cell
+repeated until the report reaches the requested size, so that we can see how rendering
+scales with each kind of content.  Reports are generated from a fixed seed, so the same
+case and size always produce the same report.
+
+Each measurement runs in a fresh process, so that its peak memory isn't hidden by an
+earlier, bigger one, and nothing is fetched over the network: the report_view target
+reads the report from a local file in place of GitHub.
+
+This is for development only, so it's kept out of the reports package; run it with
+`just benchmark`, or `python -m scripts.benchmark_rendering --help` for its options.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from base64 import b64encode
+from datetime import date, datetime, timezone
+from functools import partial
+from pathlib import Path
+from unittest import mock
+
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.test import Client, override_settings
+
+from reports.rendering import RENDERER_VERSION, process_html
+from reports.workers import resident_memory
+
+
+# Sizes of the reports we generate, in bytes, by name
+SIZES = {
+    "100KB": 100 * 1024,
+    "1MB": 1024**2,
+    "10MB": 10 * 1024**2,
+    "50MB": 50 * 1024**2,
+    "200MB": 200 * 1024**2,
+}
+UNITS = {"B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3}
+
+# Like report renders, measurements inherit their state from this process
+_context = multiprocessing.get_context("fork")
+
+WORDS = (
+    "patients practice vaccine coverage registered population measure decile "
+    "region ethnicity deprivation age band sex count rate proportion week"
+).split()
+
+DOCUMENT_START = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8" />
+<title>Benchmark report</title>
+<style type="text/css">
+{style}
+</style>
+<script src="https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.7/MathJax.js"></script>
+</head>
+<body class="jp-Notebook" data-jp-theme-light="true" data-jp-theme-name="JupyterLab Light">
+"""
+DOCUMENT_END = """
+</body>
+</html>
+"""
+# nbconvert inlines all of JupyterLab's styles into each export
+STYLE = "\n".join(
+    f".jp-Style-{i} {{ color: var(--jp-ui-font-color{i % 4}); margin: {i}px; }}"
+    for i in range(300)
+)
+
+
+def _words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def _code_cell(source, outputs):
+    return f"""
+<div class="jp-Cell jp-CodeCell jp-Notebook-cell">
+<div class="jp-Cell-inputWrapper">
+<div class="jp-InputArea jp-Cell-inputArea">
+<div class="jp-InputPrompt jp-InputArea-prompt">In&nbsp;[1]:</div>
+<div class="jp-CodeMirrorEditor jp-Editor jp-InputArea-editor" data-type="inline">
+     <div class="CodeMirror cm-s-jupyter">
+<div class=" highlight hl-ipython3"><pre><span></span>{source}</pre></div>
+     </div>
+</div>
+</div>
+</div>
+<div class="jp-Cell-outputWrapper">
+<div class="jp-OutputArea jp-Cell-outputArea">
+<div class="jp-OutputArea-child">
+    <div class="jp-OutputPrompt jp-OutputArea-prompt">Out[1]:</div>
+{outputs}
+</div>
+</div>
+</div>
+</div>
+"""
+
+
+def text_cell(rng, index):
+    """A markdown cell with a heading and some paragraphs, and a short code cell"""
+    paragraphs = "\n".join(f"<p>{_words(rng, 80)}</p>" for _ in range(3))
+    markdown = f"""
+<div class="jp-Cell jp-MarkdownCell jp-Notebook-cell">
+<div class="jp-Cell-inputWrapper">
+<div class="jp-InputArea jp-Cell-inputArea"><div class="jp-InputPrompt jp-InputArea-prompt">
+</div><div class="jp-RenderedHTMLCommon jp-RenderedMarkdown jp-MarkdownOutput " data-mime-type="text/markdown">
+<h2 id="Section-{index}">Section {index}<a class="anchor-link" href="#Section-{index}">&#182;</a></h2>
+{paragraphs}
+</div>
+</div>
+</div>
+</div>
+"""
+    source = (
+        '<span class="kn">import</span> <span class="nn">pandas</span> '
+        '<span class="k">as</span> <span class="nn">pd</span>\n'
+        f'<span class="n">df</span> <span class="o">=</span> <span class="n">pd</span>'
+        f'<span class="o">.</span><span class="n">read_csv</span><span class="p">(</span>'
+        f'<span class="s2">&quot;output/measure_{index}.csv&quot;</span><span class="p">)</span>'
+    )
+    output = (
+        '<div class="jp-RenderedText jp-OutputArea-output" data-mime-type="text/plain">'
+        f"<pre>{_words(rng, 20)}</pre></div>"
+    )
+    return markdown + _code_cell(source, output)
+
+
+def table_cell(rng, index, rows=50, columns=8):
+    """A code cell with a pandas dataframe as its output"""
+    header = "".join(f"<th>{rng.choice(WORDS)}_{i}</th>" for i in range(columns))
+    body = "\n".join(
+        f"<tr><th>{row}</th>"
+        + "".join(f"<td>{rng.random() * 1000:.2f}</td>" for _ in range(columns))
+        + "</tr>"
+        for row in range(rows)
+    )
+    output = f"""
+<div class="jp-RenderedHTMLCommon jp-RenderedHTML jp-OutputArea-output jp-OutputArea-executeResult" data-mime-type="text/html">
+<div>
+<style scoped>
+    .dataframe tbody tr th:only-of-type {{ vertical-align: middle; }}
+    .dataframe thead th {{ text-align: right; }}
+</style>
+<table border="1" class="dataframe">
+  <thead>
+    <tr style="text-align: right;"><th></th>{header}</tr>
+  </thead>
+  <tbody>
+{body}
+  </tbody>
+</table>
+</div>
+</div>
+"""
+    return _code_cell(f'<span class="n">df_{index}</span>', output)
+
+
+def image_cell(rng, index, width=200, height=80):
+    """A code cell with a matplotlib figure (a PNG, embedded as a data URL) as its output"""
+    data = b64encode(_png(rng, width, height)).decode()
+    output = f"""
+<div class="jp-RenderedImage jp-OutputArea-output ">
+<img src="data:image/png;base64,{data}"
+>
+</div>
+"""
+    return _code_cell(
+        f'<span class="n">plt</span><span class="o">.</span><span class="n">show</span>'
+        f'<span class="p">()</span>  <span class="c1"># figure {index}</span>',
+        output,
+    )
+
+
+def nested_cell(rng, index, depth=500, table_depth=20):
+    """A code cell whose output is very deeply nested markup"""
+    divs = "<div><span>" * depth + _words(rng, 5) + "</span></div>" * depth
+    tables = (
+        "<table><tr><td>" * table_depth
+        + _words(rng, 5)
+        + "</td></tr></table>" * table_depth
+    )
+    output = (
+        '<div class="jp-RenderedHTMLCommon jp-RenderedHTML jp-OutputArea-output" '
+        f'data-mime-type="text/html">{divs}{tables}</div>'
+    )
+    return _code_cell(f'<span class="n">display</span>({index})', output)
+
+
+def _png(rng, width, height):
+    # random pixels, so that (like a real figure) it doesn't compress to nothing
+    rows = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            _png_chunk(b"IHDR", header),
+            _png_chunk(b"IDAT", zlib.compress(rows, 1)),
+            _png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+def _png_chunk(kind, data):
+    checksum = zlib.crc32(kind + data)
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", checksum)
+
+
+CASES = {
+    "text": text_cell,
+    "tables": table_cell,
+    "images": image_cell,
+    "nested": nested_cell,
+}
+
+
+def generate_report(case, size, seed=0):
+    """Yield the chunks of a generated report made of `case` cells, of at least `size` bytes"""
+    rng = random.Random(seed)
+    make_cell = CASES[case]
+    chunk = DOCUMENT_START.format(style=STYLE)
+    written = len(chunk)
+    yield chunk
+    index = 0
+    while written < size:
+        chunk = make_cell(rng, index)
+        written += len(chunk)
+        index += 1
+        yield chunk
+    yield DOCUMENT_END
+
+
+def write_report(case, size, directory, seed=0):
+    """Write a generated report to `directory`, if it isn't there already, and return its path"""
+    path = Path(directory) / f"{case}-{size}-{seed}.html"
+    if not path.exists():
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, encoding="utf-8", delete=False
+        ) as f:
+            f.writelines(generate_report(case, size, seed))
+        os.replace(f.name, path)
+    return path
+
+
+def parse_size(size):
+    """Parse a size like "100KB" or "1MB" into a number of bytes"""
+    if size in SIZES:
+        return SIZES[size]
+    match = re.fullmatch(r"(\d+)(B|KB|MB|GB)?", size.upper())
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    number, unit = match.groups()
+    return int(number) * UNITS[unit or "B"]
+
+
+class FileRemote:
+    """Stands in for GithubReport, reading a report from a local file"""
+
+    # nothing is fetched, so this never fails (see circuits.py)
+    upstream = "localhost"
+
+    def __init__(self, report, path):
+        self.report = report
+        self.path = path
+        self.validators = {}
+
+    def get_html(self):
+        return self.path.read_text(encoding="utf-8")
+
+    def iter_html(self, chunk_size=1024**2):
+        with self.path.open(encoding="utf-8") as f:
+            yield from iter(partial(f.read, chunk_size), "")
+
+    def is_modified(self):
+        return True
+
+
+def run_process_html(path):
+    """Render the report at `path` with process_html, and return the output size"""
+    html = path.read_text(encoding="utf-8")
+    return len(process_html(html).encode("utf-8"))
+
+
+def run_report_view(path):
+    """
+    Request a report page for the report at `path`, with nothing cached, and return the
+    response size
+
+    The report is created in a transaction that we roll back, and rendered fragments,
+    cells, images and tables, and the template_fragments cache, are stored in a temporary
+    directory, so that nothing is left behind, and nothing is served from a previous run.
+    """
+    # imported once Django has been set up (see main)
+    from reports.models import Category, Report
+
+    with tempfile.TemporaryDirectory() as storage, transaction.atomic():
+        category, _ = Category.objects.get_or_create(name="Benchmarks")
+        # bulk_create skips Report.save(), which would validate the repo with GitHub
+        (report,) = Report.objects.bulk_create(
+            [
+                Report(
+                    category=category,
+                    title=f"Benchmark {path.stem}",
+                    description="A generated report",
+                    repo="benchmarks",
+                    report_html_file_path=path.name,
+                    publication_date=date.today(),
+                    last_updated=date.today(),
+                )
+            ]
+        )
+        remote = partial(FileRemote, path=path)
+        with override_settings(
+            ALLOWED_HOSTS=["testserver"],
+            CACHES={
+                **settings.CACHES,
+                "template_fragments": {
+                    **settings.CACHES["template_fragments"],
+                    "LOCATION": Path(storage) / "fragment-cache",
+                },
+            },
+            FRAGMENT_STORE_DIR=Path(storage) / "fragments",
+            CELL_STORE_DIR=Path(storage) / "cells",
+            REPORT_IMAGES_DIR=Path(storage) / "images",
+            REPORT_TABLES_DIR=Path(storage) / "tables",
+            RENDER_TIMEOUT=24 * 60 * 60,
+            RENDER_MAX_MEMORY=0,
+        ), mock.patch("reports.views.GithubReport", remote):
+            fragment_cache = caches["template_fragments"]
+            fragment_cache.clear()
+            try:
+                response = Client().get(report.get_absolute_url())
+                if response.streaming:
+                    content = b"".join(response.streaming_content)
+                else:  # pragma: no cover
+                    content = response.content
+            finally:
+                fragment_cache.clear()
+                fragment_cache.forget()
+        transaction.set_rollback(True)
+
+    if response.status_code != 200:  # pragma: no cover
+        raise RuntimeError(f"report_view responded with {response.status_code}")
+    return len(content)
+
+
+TARGETS = {
+    "process_html": run_process_html,
+    "report_view": run_report_view,
+}
+
+
+def measure(target, path):
+    """
+    Run `target` on the report at `path` in a new process, and return its wall time (in
+    seconds), peak memory (the most resident memory in bytes that it, or any process it
+    started, used beyond what it started with) and output size (in bytes)
+    """
+    receiver, sender = _context.Pipe(duplex=False)
+    process = _context.Process(target=_measure, args=(TARGETS[target], path, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:  # pragma: no cover
+        result = {"error": "Benchmark process exited unexpectedly"}
+    process.join()
+    return result
+
+
+def _measure(run, path, sender):
+    try:
+        baseline = resident_memory(os.getpid())
+        start = time.perf_counter()
+        output_size = run(path)
+        wall_time = time.perf_counter() - start
+        # ru_maxrss is in kilobytes
+        peak = 1024 * max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        result = {
+            "wall_time": round(wall_time, 4),
+            "peak_memory": max(peak - baseline, 0),
+            "output_size": output_size,
+        }
+    except Exception as error:
+        result = {"error": repr(error)}
+    sender.send(result)
+    sender.close()
+
+
+def run_benchmarks(cases, sizes, targets, corpus_dir, seed=0, on_result=None):
+    """
+    Measure each of `targets` on a generated report for each of `cases` and `sizes`, and
+    return the results, calling `on_result` with each one as it's ready
+    """
+    results = []
+    for case in cases:
+        for size_name in sizes:
+            path = write_report(case, parse_size(size_name), corpus_dir, seed)
+            for target in targets:
+                result = {
+                    "case": case,
+                    "size": size_name,
+                    "target": target,
+                    "input_size": path.stat().st_size,
+                    **measure(target, path),
+                }
+                results.append(result)
+                if on_result:
+                    on_result(result)
+    return {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "renderer_version": RENDERER_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "results": results,
+    }
+
+
+def compare(results, baseline):
+    """
+    Yield each result in `results` that's also in `baseline`, with the ratios of its
+    wall time and peak memory to the baseline's (so less than 1 is an improvement)
+    """
+    baseline = {_key(result): result for result in baseline["results"]}
+    for result in results["results"]:
+        previous = baseline.get(_key(result))
+        if not previous or "error" in result or "error" in previous:
+            continue
+        yield {
+            **result,
+            "wall_time_ratio": _ratio(result["wall_time"], previous["wall_time"]),
+            "peak_memory_ratio": _ratio(result["peak_memory"], previous["peak_memory"]),
+        }
+
+
+def _key(result):
+    return result["case"], result["size"], result["target"]
+
+
+def _ratio(value, previous):
+    return round(value / previous, 3) if previous else None
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="""
+            Benchmark report rendering against generated notebook exports, recording the
+            wall time, peak memory and output size of each case.  Nothing is fetched over
+            the network.
+        """
+    )
+    parser.add_argument(
+        "--case",
+        dest="cases",
+        action="append",
+        choices=CASES,
+        help="Kind of report to generate (default: all)",
+    )
+    parser.add_argument(
+        "--size",
+        dest="sizes",
+        action="append",
+        help=f"Size of report to generate, such as {', '.join(SIZES)} (default: all of those)",
+    )
+    parser.add_argument(
+        "--target",
+        dest="targets",
+        action="append",
+        choices=TARGETS,
+        help="What to measure (default: all)",
+    )
+    parser.add_argument(
+        "--corpus-dir",
+        help="Directory to keep generated reports in, to reuse them between runs (default: a temporary directory)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        default="benchmark-results.json",
+        help="File to write results to, as JSON (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compare", help="Results file from an earlier run to compare with"
+    )
+    options = parser.parse_args(argv)
+
+    sizes = options.sizes or list(SIZES)
+    for size in sizes:
+        try:
+            parse_size(size)  # fail early on invalid sizes
+        except ValueError as error:
+            parser.error(str(error))
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "reports.settings")
+    django.setup()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run_benchmarks(
+            cases=options.cases or list(CASES),
+            sizes=sizes,
+            targets=options.targets or list(TARGETS),
+            corpus_dir=options.corpus_dir or tmp_dir,
+            seed=options.seed,
+            on_result=print_result,
+        )
+
+    with open(options.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {options.output}", file=sys.stderr)
+
+    if options.compare:
+        print(f"\nCompared with {options.compare}:")
+        for result in compare(results, load_results(options.compare)):
+            print(
+                "{case:<8} {size:>6} {target:<14} wall time x{wall_time_ratio}, "
+                "peak memory x{peak_memory_ratio}".format(**result)
+            )
+
+
+def print_result(result):
+    if "error" in result:
+        print("{case:<8} {size:>6} {target:<14} {error}".format(**result))
+        return
+    print(
+        "{case:<8} {size:>6} {target:<14} {wall_time:>9.3f}s "
+        "{peak_memory_mb:>9.1f}MB peak, {output_size} bytes out".format(
+            peak_memory_mb=result["peak_memory"] / 1024**2, **result
+        ),
+        flush=True,
+    )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -1,6 +1,5 @@
 import logging
 from os import environ
-from pathlib import Path
 
 import django.db.models
 import httpretty as _httpretty
@@ -12,6 +11,9 @@ from django.core import management
 from model_bakery import baker
 from structlog.testing import LogCapture
 
+from reports import counters, navigation
+from reports.http import close_sessions
+
 
 User = get_user_model()
 
@@ -38,15 +40,9 @@ def researcher():
     yield user
 
 
-def remove_cache_file_if_exists():
-    test_cache_path = Path(__file__).parent.parent / "test_cache.sqlite"
-    if test_cache_path.exists():  # pragma: no cover
-        test_cache_path.unlink()
-
-
 def pytest_sessionstart(session):
     """
-    Modify logging and clean up old test cache files before session starts
+    Modify logging before session starts
 
     requests_cache emits an annoying and unnecessary warning about unrecognised kwargs
     because we're using a custom cache name.  Set its log level to ERROR just for the tests
@@ -54,13 +50,6 @@ def pytest_sessionstart(session):
     logger = logging.getLogger("requests_cache")
     logger.setLevel("ERROR")
 
-    remove_cache_file_if_exists()
-
-
-def pytest_sessionfinish(session, exitstatus):
-    """clean up test cache files after session starts"""
-    remove_cache_file_if_exists()  # pragma: no cover
-
 
 @pytest.fixture(name="log_output", scope="module")
 def fixture_log_output():
@@ -69,7 +58,9 @@ def fixture_log_output():
 
 @pytest.fixture(autouse=True)
 def fixture_configure_structlog(log_output):
-    structlog.configure(processors=[log_output])
+    # Don't cache loggers, or module-level loggers would keep logging to whichever
+    # module's log_output they were first used with
+    structlog.configure(processors=[log_output], cache_logger_on_first_use=False)
 
 
 @pytest.fixture
@@ -80,6 +71,30 @@ def httpretty():
     _httpretty.disable()
 
 
+@pytest.fixture(autouse=True)
+def close_http_sessions():
+    # Don't reuse connections (which may be to httpretty's fake sockets) between tests
+    yield
+    close_sessions()
+
+
+@pytest.fixture(autouse=True)
+def reset_counters():
+    # Each test's database is rolled back at the end, so counts waiting to be added to the
+    # totals in it must be forgotten too
+    counters.reset()
+    yield
+    counters.reset()
+
+
+@pytest.fixture(autouse=True)
+def reset_navigation():
+    # Each test's database is rolled back at the end, so a worker's navigation must be too
+    navigation.reset()
+    yield
+    navigation.reset()
+
+
 @pytest.fixture
 def reset_environment_after_test():
     old_environ = dict(environ)
@@ -104,6 +119,23 @@ def mock_repo_url(mocker):
     return create_mock_repo
 
 
+@pytest.fixture(autouse=True)
+def storage_dirs(settings, tmp_path):
+    # Everything that's stored on disk is stored in the test's own directory
+    settings.HTTP_CACHE_DIR = tmp_path / "http-cache"
+    settings.CACHES = {
+        **settings.CACHES,
+        "template_fragments": {
+            **settings.CACHES["template_fragments"],
+            "LOCATION": tmp_path / "fragment-cache",
+        },
+    }
+    settings.FRAGMENT_STORE_DIR = tmp_path / "fragments"
+    settings.CELL_STORE_DIR = tmp_path / "cells"
+    settings.REPORT_IMAGES_DIR = tmp_path / "report-images"
+    settings.REPORT_TABLES_DIR = tmp_path / "report-tables"
+
+
 @pytest.fixture(autouse=True)
 def skip_github_validation(reset_environment_after_test):
     environ["GITHUB_VALIDATION"] = "False"
@@ -0,0 +1,154 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from reports.rendering import process_html
+from reports.tiered_cache import TieredCache
+from scripts.benchmark_rendering import (
+    CASES,
+    compare,
+    generate_report,
+    main,
+    parse_size,
+    run_process_html,
+    run_report_view,
+    write_report,
+)
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_generate_report(case):
+    html = "".join(generate_report(case, 50 * 1024))
+
+    assert len(html) >= 50 * 1024
+    assert html.rstrip().endswith("</html>")
+    # the same seed always generates the same report
+    assert html == "".join(generate_report(case, 50 * 1024))
+    assert html != "".join(generate_report(case, 50 * 1024, seed=1))
+
+    rendered = process_html(html)
+    assert 'class="jp-Cell jp-CodeCell jp-Notebook-cell' in rendered
+    assert "<script" not in rendered
+
+
+def test_generate_report_images_are_valid():
+    html = "".join(generate_report("images", 50 * 1024))
+    rendered = process_html(html)
+    # we could read the images' sizes, so they're valid PNGs
+    assert 'width="200" height="80"' in rendered
+
+
+def test_write_report(tmp_path):
+    path = write_report("text", 10 * 1024, tmp_path)
+    assert path.name == "text-10240-0.html"
+    assert path.read_text() == "".join(generate_report("text", 10 * 1024))
+
+    # an existing report is reused
+    path.write_text("<p>foo</p>")
+    assert write_report("text", 10 * 1024, tmp_path).read_text() == "<p>foo</p>"
+    assert run_process_html(path) == len("<p>foo</p>")
+
+
+@pytest.mark.django_db
+def test_run_report_view_leaves_nothing_behind(tmp_path, settings, mocker):
+    # so that there are tables to store too
+    settings.VIRTUAL_TABLE_MIN_ROWS = 1
+    forget = mocker.spy(TieredCache, "forget")
+    for case in CASES:
+        assert run_report_view(write_report(case, 50 * 1024, tmp_path)) > 0
+
+    assert not settings.CELL_STORE_DIR.exists()
+    assert not settings.REPORT_TABLES_DIR.exists()
+    assert not Path(settings.CACHES["template_fragments"]["LOCATION"]).exists()
+    # nor in the memory of this process
+    assert forget.call_count == len(CASES)
+
+
+@pytest.mark.django_db
+def test_main(tmp_path, capsys):
+    output = tmp_path / "results.json"
+    main(
+        [
+            "--case=text",
+            "--size=20KB",
+            f"--corpus-dir={tmp_path}",
+            f"--output={output}",
+        ]
+    )
+
+    results = json.loads(output.read_text())
+    assert [
+        (result["case"], result["size"], result["target"])
+        for result in results["results"]
+    ] == [("text", "20KB", "process_html"), ("text", "20KB", "report_view")]
+    for result in results["results"]:
+        assert "error" not in result
+        assert result["wall_time"] > 0
+        assert result["output_size"] > 0
+    assert (tmp_path / "text-20480-0.html").exists()
+
+    # compare against the previous run
+    main(
+        [
+            "--case=text",
+            "--size=20KB",
+            "--target=process_html",
+            f"--output={tmp_path / 'compared.json'}",
+            f"--compare={output}",
+        ]
+    )
+    assert "Compared with" in capsys.readouterr().out
+
+
+def test_main_invalid_size(capsys):
+    with pytest.raises(SystemExit):
+        main(["--size=big"])
+    assert "Invalid size: big" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize(
+    "size,expected",
+    [("100KB", 100 * 1024), ("200MB", 200 * 1024**2), ("3kb", 3 * 1024), ("10", 10)],
+)
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError, match="Invalid size"):
+        parse_size("big")
+
+
+def test_compare():
+    def result(case, wall_time, peak_memory, **kwargs):
+        return {
+            "case": case,
+            "size": "1MB",
+            "target": "process_html",
+            "wall_time": wall_time,
+            "peak_memory": peak_memory,
+            **kwargs,
+        }
+
+    baseline = {
+        "results": [
+            result("text", 2.0, 100),
+            result("tables", 1.0, 0),
+            result("images", 1.0, 100, error="Boom"),
+        ]
+    }
+    results = {
+        "results": [
+            result("text", 1.0, 150),
+            result("tables", 1.0, 100),
+            result("images", 1.0, 100),
+            result("nested", 1.0, 100),
+        ]
+    }
+
+    compared = list(compare(results, baseline))
+
+    assert [
+        (r["case"], r["wall_time_ratio"], r["peak_memory_ratio"]) for r in compared
+    ] == [("text", 0.5, 1.5), ("tables", 1.0, None)]
@@ -0,0 +1,16 @@
+from reports.checks import check_render_budget
+
+
+def test_check_render_budget(settings):
+    settings.WORKER_TIMEOUT = 60
+    settings.RENDER_TIMEOUT = 20
+    settings.LOCK_WAIT = 5
+    assert check_render_budget(None) == []
+
+    settings.LOCK_WAIT = 40
+    errors = check_render_budget(None)
+    assert [error.id for error in errors] == ["reports.E002"]
+
+    settings.RENDER_TIMEOUT = 60
+    errors = check_render_budget(None)
+    assert [error.id for error in errors] == ["reports.E001"]
@@ -0,0 +1,133 @@
+import pytest
+from requests.exceptions import ConnectionError
+
+from reports.circuits import CircuitBreaker, CircuitOpen
+from reports.http import get_session
+
+
+URL = "https://jobs.opensafely.org/org/project/workspace/published/file_id"
+
+
+@pytest.fixture(autouse=True)
+def circuit_settings(settings):
+    settings.CIRCUIT_FAILURE_THRESHOLD = 2
+    settings.CIRCUIT_RESET_TIMEOUT = 30
+
+
+def fail(breaker):
+    assert breaker.allow()
+    breaker.record_failure()
+
+
+@pytest.mark.django_db
+def test_circuit_opens_after_failures():
+    breaker = CircuitBreaker("upstream")
+    fail(breaker)
+    assert not breaker.is_open()
+    fail(breaker)
+    assert breaker.is_open()
+    assert not CircuitBreaker("upstream").allow()
+    # each upstream has its own circuit
+    assert CircuitBreaker("other").allow()
+
+
+@pytest.mark.django_db
+def test_circuit_failures_reset_by_success():
+    breaker = CircuitBreaker("upstream")
+    fail(breaker)
+    assert breaker.allow()
+    breaker.record_success()
+    fail(CircuitBreaker("upstream"))
+    assert not breaker.is_open()
+
+
+@pytest.mark.django_db
+def test_circuit_half_open(settings):
+    settings.CIRCUIT_RESET_TIMEOUT = -1
+    fail(CircuitBreaker("upstream"))
+    fail(CircuitBreaker("upstream"))
+
+    # the circuit has been open for long enough, so one request may probe the upstream
+    settings.CIRCUIT_RESET_TIMEOUT = 30
+    probe = CircuitBreaker("upstream")
+    assert probe.allow()
+    assert not CircuitBreaker("upstream").allow()
+    assert CircuitBreaker("upstream").is_open()
+
+    # the probe fails, so the circuit opens again
+    probe.record_failure()
+    assert not CircuitBreaker("upstream").allow()
+
+
+@pytest.mark.django_db
+def test_circuit_closes_after_successful_probe(settings):
+    settings.CIRCUIT_RESET_TIMEOUT = -1
+    fail(CircuitBreaker("upstream"))
+    fail(CircuitBreaker("upstream"))
+
+    probe = CircuitBreaker("upstream")
+    assert probe.allow()
+    probe.record_success()
+    assert not probe.is_open()
+    breaker = CircuitBreaker("upstream")
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+@pytest.mark.django_db
+def test_sessions_use_circuits(httpretty):
+    httpretty.register_uri(httpretty.GET, URL, status=503, body="")
+    session = get_session()
+    assert session.get(URL).status_code == 503
+    assert session.get(URL).status_code == 503
+
+    # the circuit is open, so the request isn't made
+    with pytest.raises(CircuitOpen):
+        session.get(URL)
+    assert len(httpretty.latest_requests()) == 2
+    assert CircuitBreaker("jobs.opensafely.org").is_open()
+    assert not CircuitBreaker("api.github.com").is_open()
+
+
+@pytest.mark.django_db
+def test_sessions_count_connection_errors(mocker):
+    mocker.patch(
+        "requests.adapters.HTTPAdapter.send", side_effect=ConnectionError("Refused")
+    )
+    session = get_session()
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            session.get(URL)
+    assert CircuitBreaker("jobs.opensafely.org").is_open()
+
+
+@pytest.mark.django_db
+def test_sessions_do_not_count_client_errors(httpretty):
+    httpretty.register_uri(httpretty.GET, URL, status=404, body="")
+    session = get_session()
+    for _ in range(3):
+        assert session.get(URL).status_code == 404
+    assert not CircuitBreaker("jobs.opensafely.org").is_open()
+
+
+@pytest.mark.django_db
+def test_sessions_count_rate_limits(httpretty):
+    forbidden = "https://api.github.com/repos/opensafely/private"
+    rate_limited = "https://api.github.com/repos/opensafely/test"
+    httpretty.register_uri(httpretty.GET, forbidden, status=403, body="")
+    httpretty.register_uri(
+        httpretty.GET,
+        rate_limited,
+        status=403,
+        body='{"message": "API rate limit exceeded"}',
+        adding_headers={"X-RateLimit-Remaining": "0"},
+    )
+    session = get_session()
+    # forbidden, but not because of the rate limit
+    for _ in range(3):
+        assert session.get(forbidden).status_code == 403
+    assert not CircuitBreaker("api.github.com").is_open()
+
+    for _ in range(2):
+        assert session.get(rate_limited).status_code == 403
+    assert CircuitBreaker("api.github.com").is_open()
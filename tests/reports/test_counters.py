@@ -0,0 +1,42 @@
+import pytest
+from django.core.cache import cache
+
+from reports import counters
+
+
+@pytest.mark.django_db
+def test_counts_are_added_to_totals_in_intervals(django_assert_num_queries):
+    counter = counters.get_counter("test", ["hits", "misses"], interval=60)
+    assert counters.get_counter("test", ["hits", "misses"], interval=0) is counter
+
+    with django_assert_num_queries(0):
+        counter.count("hits")
+        counter.count("hits")
+    assert cache.get("test:hits") is None
+
+    assert counter.totals() == {"hits": 2, "misses": 0}
+    assert cache.get("test:hits") == 2
+    assert cache.get("test:misses") is None
+
+
+@pytest.mark.django_db
+def test_counts_are_added_once_the_interval_has_passed():
+    counter = counters.get_counter("test", ["hits"], interval=0)
+    counter.count("hits")
+    assert cache.get("test:hits") == 1
+
+    # from another process
+    cache.incr("test:hits", 2)
+    counter.count("hits")
+    assert counter.totals() == {"hits": 4}
+
+
+@pytest.mark.django_db
+def test_reset():
+    counter = counters.get_counter("test", ["hits"], interval=60)
+    counter.count("hits")
+
+    counters.reset()
+
+    counter = counters.get_counter("test", ["hits"], interval=60)
+    assert counter.totals() == {"hits": 0}
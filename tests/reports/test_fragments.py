@@ -0,0 +1,392 @@
+import gzip
+import hashlib
+import os
+import time
+from base64 import b64encode
+
+import brotli
+import pytest
+from django.utils import timezone
+from model_bakery import baker
+
+from reports import locks, workers
+from reports.fragments import (
+    CellStore,
+    FragmentStore,
+    ImageStore,
+    TableStore,
+    fragment_placeholder,
+    get_fragment_store,
+    get_image_store,
+    split_placeholders,
+    store_fragment,
+    store_report_fragment,
+)
+from reports.models import Report
+from reports.templatetags.reports_tags import render_html
+
+from .utils import assert_html_equal
+
+
+class FakeRemote:
+    def __init__(self, html, report=None, modified=True):
+        self.html = html
+        self.report = report or Report()
+        self.modified = modified
+        self.validators = {"source_etag": "etag"}
+        self.fetched = False
+
+    def is_modified(self):
+        return self.modified
+
+    def iter_html(self):
+        self.fetched = True
+        yield from self.html
+
+
+@pytest.mark.django_db
+def test_fragment_store_get_and_write(tmp_path):
+    store = FragmentStore(tmp_path, max_size=1000)
+    assert store.get("abcd") is None
+
+    with store.writer("abcd") as f:
+        f.write("<p>café</p>")
+        f.finish()
+
+    assert store.get("abcd") == "<p>café</p>"
+    with store.open_fragment("abcd", compressed=True) as compressed:
+        assert gzip.decompress(compressed.read()).decode() == "<p>café</p>"
+    assert store.stats() == {
+        "hits": 2,
+        "misses": 1,
+        "evictions": 0,
+        "count": 1,
+        "size": sum(path.stat().st_size for path in tmp_path.glob("*/*")),
+    }
+
+
+@pytest.mark.django_db
+def test_fragment_store_lookups_without_queries(tmp_path, django_assert_num_queries):
+    store = FragmentStore(tmp_path, max_size=1000)
+    with store.writer("abcd") as f:
+        f.write("<p>foo</p>")
+        f.finish()
+
+    # hits and misses are counted in memory, and added to the totals later
+    with django_assert_num_queries(0):
+        assert store.get("abcd") == "<p>foo</p>"
+        assert store.get("efgh") is None
+
+    stats = store.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+@pytest.mark.django_db
+def test_fragment_store_write_failure_leaves_nothing_behind(tmp_path):
+    store = FragmentStore(tmp_path, max_size=1000)
+
+    with pytest.raises(ValueError):
+        with store.writer("abcd") as f:
+            f.write("<p>partial")
+            raise ValueError()
+
+    assert store.get("abcd") is None
+    assert list(tmp_path.glob("**/*.*")) == []
+
+
+@pytest.mark.django_db
+def test_fragment_store_evicts_least_recently_used(tmp_path):
+    store = FragmentStore(tmp_path, max_size=0)
+    for mtime, key in enumerate(["aaaa", "bbbb", "cccc"]):
+        with store.writer(key) as f:
+            f.write("x" * 10)
+            f.finish()
+        os.utime(store.path(key), (mtime, mtime))
+
+    # room for two of the fragments, and their gzipped copies
+    store.max_size = store.stats()["size"] * 2 // 3
+    store.evict()
+
+    assert store.get("aaaa") is None
+    assert store.get("bbbb") is not None
+    assert store.get("cccc") is not None
+    assert not store.compressed_path("aaaa").exists()
+    assert store.stats()["evictions"] == 1
+
+
+@pytest.mark.django_db
+def test_fragment_store_records_references(tmp_path):
+    store = FragmentStore(tmp_path, max_size=1000)
+    name = f"{'a' * 64}.png"
+    with store.writer("abcd") as f:
+        # split between writes
+        f.write(f'<img src="/report-images/{name[:30]}')
+        f.write(f'{name[30:]}"><p>{"b" * 64}</p>')
+        f.finish()
+
+    assert store.references() == {name}
+
+    # a fragment stored before we recorded them
+    store.references_path("abcd").unlink()
+    assert store.references() == {name}
+    assert store.references_path("abcd").exists()
+
+
+def test_content_store_collect(tmp_path):
+    store = ImageStore(tmp_path)
+    store.save(b"referenced", "png")
+    store.save(b"unreferenced", "png")
+    store.save(b"recent", "png")
+    old = time.time() - 24 * 60 * 60
+    names = {path.read_bytes(): path.name for path in tmp_path.iterdir()}
+    for data in [b"referenced", b"unreferenced"]:
+        os.utime(store.path(names[data]), (old, old))
+
+    assert store.collect({names[b"referenced"]}) == 1
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        [names[b"referenced"], names[b"recent"]]
+    )
+
+
+def test_cell_store_get_save_and_evict(tmp_path):
+    store = CellStore(tmp_path, max_size=1000)
+    assert store.get("aaaa") is None
+
+    store.save("aaaa", "<p>café</p>\n", 1, 2)
+    store.save("bbbb", "<p>b</p>", 0, 1)
+    assert store.get("aaaa") == ("<p>café</p>\n", 1, 2)
+
+    os.utime(store.path("aaaa"), (0, 0))
+    store.max_size = store.path("bbbb").stat().st_size
+    store.evict()
+
+    assert store.get("aaaa") is None
+    assert store.get("bbbb") == ("<p>b</p>", 0, 1)
+
+
+@pytest.mark.django_db
+def test_content_store_collect_with_compressed_copies(tmp_path):
+    store = TableStore(tmp_path)
+    referenced = store.save(b"[1]", "json").rsplit("/", 1)[-1]
+    store.save(b"[2]", "json")
+    old = time.time() - 24 * 60 * 60
+    for path in tmp_path.iterdir():
+        os.utime(path, (old, old))
+
+    assert store.collect({referenced}) == 3
+    stored = [referenced, f"{referenced}.br", f"{referenced}.gz"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == stored
+
+    # the file has been used since, but its copies haven't, and they're kept with it
+    store.touch(referenced)
+    assert store.collect(set()) == 0
+    assert sorted(path.name for path in tmp_path.iterdir()) == stored
+
+
+@pytest.mark.django_db
+def test_cell_store_does_not_reuse_cells_whose_images_are_removed(tmp_path):
+    images = ImageStore(tmp_path / "images")
+    store = CellStore(tmp_path / "cells", max_size=1000, content_stores=[images])
+    url = images.save(b"image", "png")
+    store.save("aaaa", f'<img src="{url}">', 1, 1)
+    assert store.get("aaaa") == (f'<img src="{url}">', 1, 1)
+
+    images.path(url.rsplit("/", 1)[-1]).unlink()
+
+    assert store.get("aaaa") is None
+
+
+@pytest.mark.django_db
+def test_content_store_writer(tmp_path):
+    store = TableStore(tmp_path)
+
+    with store.writer("json") as writer:
+        writer.write('{"rows":')
+        writer.write("[]}")
+
+    content = '{"rows":[]}'
+    name = f"{hashlib.sha256(content.encode()).hexdigest()}.json"
+    assert store.path(name).read_text() == content
+    assert writer.url == f"/report-tables/{name}"
+    # with compressed copies for clients that accept them
+    assert brotli.decompress(store.path(f"{name}.br").read_bytes()).decode() == content
+    assert gzip.decompress(store.path(f"{name}.gz").read_bytes()).decode() == content
+
+    # the same content again is stored once
+    with store.writer("json") as again:
+        again.write(content)
+    assert again.url == writer.url
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_content_store_writer_failure_leaves_nothing_behind(tmp_path):
+    store = TableStore(tmp_path)
+
+    with pytest.raises(ValueError):
+        with store.writer("json") as writer:
+            writer.write("[")
+            raise ValueError()
+
+    assert list(tmp_path.iterdir()) == []
+    assert writer.url is None
+
+
+@pytest.mark.django_db
+def test_store_fragment_reuses_rendered_content(mocker):
+    run_render = mocker.patch("reports.fragments.run_render", wraps=workers.run_render)
+    store = get_fragment_store()
+    html = ["<html><body><p>foo</p>", "<script>x</script><p>bar</p></body></html>"]
+
+    key = store_fragment(html, store)
+    assert run_render.call_count == 1
+
+    # same content, no rendering
+    assert store_fragment(html, store) == key
+    assert run_render.call_count == 1
+
+    # changed content is rendered
+    new_key = store_fragment(["<p>baz</p>"], store)
+    assert new_key != key
+    assert run_render.call_count == 2
+
+    stats = store.stats()
+    assert (stats["hits"], stats["misses"], stats["count"]) == (1, 2, 2)
+    assert_html_equal(store.get(key), "<p>foo</p><p>bar</p>")
+    assert_html_equal(store.get(new_key), "<p>baz</p>")
+
+
+@pytest.mark.django_db
+def test_store_fragment_with_new_renderer_version(mocker):
+    html = ["<p>foo</p>"]
+    key = store_fragment(html)
+
+    mocker.patch("reports.fragments.RENDERER_VERSION", "new")
+    assert store_fragment(html) != key
+
+    assert get_fragment_store().stats()["count"] == 2
+
+
+@pytest.mark.django_db
+def test_store_fragment_removes_images_once_unreferenced(settings):
+    def report(image):
+        return [f'<img src="data:image/png;base64,{b64encode(image).decode()}">']
+
+    images = get_image_store()
+    store = get_fragment_store()
+    first = store_fragment(report(b"first"), store)
+    (first_image,) = images.location.iterdir()
+    old = time.time() - 2 * settings.RENDER_TIMEOUT
+    os.utime(first_image, (old, old))
+    os.utime(store.path(first), (old, old))
+
+    # room for one fragment
+    store.max_size = store.stats()["size"]
+    store_fragment(report(b"second"), store)
+
+    assert store.get(first) is None
+    assert not first_image.exists()
+    assert len(list(images.location.iterdir())) == 1
+
+
+@pytest.mark.django_db
+def test_render_html_tag():
+    # the tag renders a placeholder for the stored fragment
+    _, key, _ = split_placeholders(
+        render_html(FakeRemote(["<p>foo</p>", "<table></table>"]))
+    )
+    assert_html_equal(
+        get_fragment_store().get(key),
+        '<p>foo</p><div class="overflow-wrapper"><table></table></div>',
+    )
+
+
+@pytest.mark.django_db
+def test_store_report_fragment_only_fetches_modified_files():
+    report = baker.make(Report, repo="test", report_html_file_path="foo.html")
+    key = store_report_fragment(FakeRemote(["<p>foo</p>"], report))
+    report.refresh_from_db()
+    assert (report.fragment_key, report.source_etag) == (key, "etag")
+
+    # not modified, so the stored fragment is used without fetching the file
+    remote = FakeRemote(["<p>foo</p>"], report, modified=False)
+    assert store_report_fragment(remote) == key
+    assert not remote.fetched
+
+    # the fragment has been evicted, so the file is fetched and rendered again
+    store = get_fragment_store()
+    store.path(key).unlink()
+    remote = FakeRemote(["<p>foo</p>"], report, modified=False)
+    assert store_report_fragment(remote) == key
+    assert remote.fetched
+    assert store.get(key) == "<p>foo</p>"
+
+    remote = FakeRemote(["<p>bar</p>"], report)
+    new_key = store_report_fragment(remote)
+    assert new_key != key
+    assert Report.objects.get(pk=report.pk).fragment_key == new_key
+
+
+@pytest.mark.django_db
+def test_store_report_fragment_waits_for_another_worker(mocker):
+    report = baker.make(Report, repo="test", report_html_file_path="foo.html")
+    lock = f"render-report:{report.pk}"
+    token = locks.acquire(lock)
+
+    def render_elsewhere(name):
+        # the other worker renders the report while we wait
+        key = store_fragment(["<p>foo</p>"])
+        Report.objects.get(pk=report.pk).record_source(
+            fragment_key=key, source_checked_at=timezone.now()
+        )
+        locks.release(name, token)
+
+    mocker.patch("reports.locks.wait", side_effect=render_elsewhere)
+    remote = FakeRemote(["<p>foo</p>"], report)
+    key = store_report_fragment(remote)
+    assert not remote.fetched
+    assert report.fragment_key == key
+    assert get_fragment_store().get(key) == "<p>foo</p>"
+
+
+@pytest.mark.django_db
+def test_store_report_fragment_after_another_worker_fails(mocker):
+    report = baker.make(Report, repo="test", report_html_file_path="foo.html")
+    lock = f"render-report:{report.pk}"
+    token = locks.acquire(lock)
+    # the other worker gives up without rendering the report
+    mocker.patch(
+        "reports.locks.wait", side_effect=lambda name: locks.release(name, token)
+    )
+
+    # we don't render it after waiting, as there may not be time; the next request does
+    remote = FakeRemote(["<p>foo</p>"], report)
+    with pytest.raises(locks.LockTimeout):
+        store_report_fragment(remote)
+    assert not remote.fetched
+    assert locks.acquire(lock) is not None
+
+
+@pytest.mark.django_db
+def test_store_report_fragment_gives_up_waiting(settings):
+    settings.LOCK_WAIT = 0
+    report = baker.make(Report, repo="test", report_html_file_path="foo.html")
+    locks.acquire(f"render-report:{report.pk}")
+
+    remote = FakeRemote(["<p>foo</p>"], report)
+    with pytest.raises(locks.LockTimeout):
+        store_report_fragment(remote)
+    assert not remote.fetched
+
+
+def test_split_placeholders():
+    key = "a" * 64
+    assert split_placeholders(f"<main>{fragment_placeholder(key)}</main>") == [
+        "<main>",
+        key,
+        "</main>",
+    ]
+    # anything else that looks like a comment is left alone
+    assert split_placeholders("<!-- report-fragment:xyz -->") == [
+        "<!-- report-fragment:xyz -->"
+    ]
@@ -1,4 +1,5 @@
 import json
+import textwrap
 from base64 import b64encode
 from datetime import date
 
@@ -6,7 +7,7 @@ import pytest
 from model_bakery import baker
 from osgithub import GithubAPIException, GithubClient, GithubRepo
 
-from reports.github import GithubReport
+from reports.github import GithubReport, iter_base64_decoded
 from reports.models import Report
 
 
@@ -67,18 +68,8 @@ def test_get_normal_html_from_github(httpretty):
 
 
 @pytest.mark.django_db
-def test_get_large_html_from_github(httpretty):
-    """
-    Test that a GithubException for a too-large file is caught and the content fetched
-    from the git_blob by sha instead
-    """
-    html = """
-        <html>
-            <body><p>foo</p></body>
-        </html>
-    """
-    # Mock the github requests
-    # /contents on the too-large file returns a 403
+def test_iter_html_from_github(httpretty):
+    html = "<html><body><p>caf\u00e9</p></body></html>" * 10
     httpretty.register_uri(
         httpretty.GET,
         "https://api.github.com/repos/opensafely/test/contents/foo.html?ref=main",
@@ -86,39 +77,7 @@ def test_get_large_html_from_github(httpretty):
         body=json.dumps(
             {
                 "name": "foo.html",
-                "path": "foo.html",
                 "sha": "abcd1234",
-                "size": 1234,
-                "encoding": "base64",
-                "content": "",
-            }
-        ),
-    )
-    # /contents on the parent folder returns two files
-    httpretty.register_uri(
-        httpretty.GET,
-        "https://api.github.com/repos/opensafely/test/contents/?ref=main",
-        status=200,
-        body=json.dumps(
-            [
-                {"name": "bar.html", "sha": "abcd9999"},
-                {"name": "foo.html", "sha": "abcd1234"},
-            ]
-        ),
-        adding_headers={"Last-Modified": "Tue, 27 Apr 2021 10:00:00 GMT"},
-    )
-    # /git/blobs on the sha from the found file in the parent folder
-    httpretty.register_uri(
-        httpretty.GET,
-        "https://api.github.com/repos/opensafely/test/git/blobs/abcd1234",
-        status=200,
-        body=json.dumps(
-            {
-                "name": "foo.html",
-                "path": "foo.html",
-                "sha": "abcd1234",
-                "size": 1234,
-                "encoding": "base64",
                 "content": b64encode(html.encode()).decode(),
             }
         ),
@@ -131,6 +90,52 @@ def test_get_large_html_from_github(httpretty):
         sha="main",
         commit_dates="2021-04-25T10:00:00Z",
     )
+    repo = GithubRepo(GithubClient(use_cache=False), name="test", owner="opensafely")
+    report = baker.make(Report, report_html_file_path="foo.html", repo="test")
+    github_report = GithubReport(report, repo=repo)
+
+    chunks = list(github_report.iter_html(chunk_size=7))
+    assert len(chunks) > 1
+    assert "".join(chunks) == html
+    assert report.last_updated == date(2021, 4, 25)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 4, 61, 1000])
+def test_iter_base64_decoded(chunk_size):
+    text = "<p>\u00a3100 \u2014 caf\u00e9</p>\n" * 20
+    encoded = b64encode(text.encode()).decode()
+    # GitHub wraps its base64 content at 60 characters
+    encoded = "\n".join(textwrap.wrap(encoded, 60))
+
+    assert "".join(iter_base64_decoded(encoded, chunk_size)) == text
+
+
+@pytest.mark.django_db
+def test_get_large_html_from_github(httpretty):
+    """
+    Test that a file too large for the contents API to include its content is streamed
+    in its raw form instead
+    """
+    html = "<html><body><p>caf\u00e9</p></body></html>" * 10
+    url = "https://api.github.com/repos/opensafely/test/contents/foo.html?ref=main"
+    sha = "abcd1234" * 5
+
+    def contents(request, uri, headers):
+        # /contents on the too-large file returns no content, unless we ask for it raw
+        if request.headers["Accept"] == "application/vnd.github.raw":
+            return 200, {**headers, "ETag": f'"{sha}"'}, html.encode()
+        body = {"name": "foo.html", "sha": sha, "encoding": "none", "content": ""}
+        return 200, headers, json.dumps(body)
+
+    httpretty.register_uri(httpretty.GET, url, body=contents)
+    register_commits_uri(
+        httpretty,
+        owner="opensafely",
+        repo="test",
+        path="foo.html",
+        sha="main",
+        commit_dates="2021-04-25T10:00:00Z",
+    )
 
     repo = GithubRepo(
         client=GithubClient(use_cache=False), owner="opensafely", name="test"
@@ -140,44 +145,32 @@ def test_get_large_html_from_github(httpretty):
 
     github_report = GithubReport(report, repo=repo)
     report.refresh_from_db()
-    assert github_report.get_html() == html
+    assert "".join(github_report.iter_html(chunk_size=7)) == html
     # last updated date is retrieved from the last commmit
     assert report.last_updated == date(2021, 4, 25)
+    assert github_report.validators == {"source_sha": sha}
 
-    # 4 calls were made, to /contents and /commits for the single file and its updated date,
-    # then to /contents for the parent folder, and /git/blob for the file contents
-    assert len(httpretty.latest_requests()) == 4
+    # 3 calls were made, to /contents and /commits for the single file and its updated
+    # date, then to /contents for the raw file
+    assert len(httpretty.latest_requests()) == 3
 
-    # After the first get_html call, use_git_blob is set to avoid re-attempting to call
-    # get_contents on the single file, which will fail
-    # get_contents is called twice, once on the single file, once for the parent folder contents
+    # After the first fetch, use_git_blob is set to remember that the file is too large
+    # for the contents API
     assert report.use_git_blob is True
 
-    # refetch; the html has now been stored on the GithubReport, so no additional calls are made
-    assert github_report.get_html() == html
-    latest_requests = httpretty.latest_requests()
-    assert len(latest_requests) == 4
-
-    # instantiate a new GithubReport and re-fetch; get_contents is not called again on the single file,
-    # only on the parent folder
+    # instantiate a new GithubReport and re-fetch; the contents API isn't asked for the
+    # file's metadata again, only for the raw file
     github_report = GithubReport(report, repo=repo)
     assert github_report.get_html() == html
-    # Only 3 more calls, to /contents for the parent folder, /git/blob for the file contents
-    # and /commits for the update date
+    # Only 2 more calls, to /commits for the update date and /contents for the raw file
     latest_requests = httpretty.latest_requests()
-    assert len(latest_requests) == 7
-    assert (
-        latest_requests[-3].url
-        == "https://api.github.com/repos/opensafely/test/contents/?ref=main"
-    )
-    assert (
-        latest_requests[-2].url
-        == "https://api.github.com/repos/opensafely/test/git/blobs/abcd1234"
-    )
-    assert (
-        latest_requests[-1].url
-        == "https://api.github.com/repos/opensafely/test/commits?sha=main&path=foo.html&per_page=1"
+    assert len(latest_requests) == 5
+    assert latest_requests[-2].url == (
+        "https://api.github.com/repos/opensafely/test/commits?sha=main&path=foo.html&per_page=1"
     )
+    assert latest_requests[-1].url == url
+    assert latest_requests[-1].headers["Accept"] == "application/vnd.github.raw"
+    assert github_report.validators == {"source_sha": sha}
 
 
 @pytest.mark.django_db
@@ -201,6 +194,116 @@ def test_github_report_get_parent_contents_invalid_folder(httpretty):
         github_report.get_parent_contents()
 
 
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "status,files,modified,etag",
+    [
+        (304, None, False, '"old"'),
+        (200, {"foo.html": "abcd1234", "bar.html": "1234abcd"}, False, '"new"'),
+        (200, {"foo.html": "efgh5678"}, True, '"old"'),
+        (200, {"bar.html": "1234abcd"}, True, '"old"'),
+    ],
+    ids=["Not modified", "Same blob", "Changed blob", "Removed"],
+)
+def test_github_report_is_modified(httpretty, status, files, modified, etag):
+    # the listing of the folder that the file is in, which doesn't include its content
+    url = "https://api.github.com/repos/opensafely/test/contents/reports?ref=main"
+    body = [{"name": name, "sha": sha} for name, sha in (files or {}).items()]
+    httpretty.register_uri(
+        httpretty.GET,
+        url,
+        status=status,
+        body=json.dumps(body) if files else "",
+        adding_headers={"ETag": '"new"'},
+    )
+    report = baker.make(Report, repo="test", report_html_file_path="reports/foo.html")
+    report.record_source(source_sha="abcd1234", source_etag='"old"')
+
+    github_report = GithubReport(report, use_cache=False)
+    assert github_report.is_modified() is modified
+    assert (
+        httpretty.last_request().path
+        == "/repos/opensafely/test/contents/reports?ref=main"
+    )
+    assert httpretty.last_request().headers["If-None-Match"] == '"old"'
+
+    # we only ask once
+    github_report.is_modified()
+    assert len(httpretty.latest_requests()) == 1
+    report.refresh_from_db()
+    assert report.source_etag == etag
+
+
+@pytest.mark.django_db
+def test_github_report_last_updated_not_modified(httpretty):
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://api.github.com/repos/opensafely/test/contents?ref=main",
+        status=304,
+    )
+    report = baker.make(
+        Report,
+        repo="test",
+        report_html_file_path="foo.html",
+        last_updated=date(2021, 4, 25),
+    )
+    report.record_source(source_sha="abcd1234", source_etag='"abcd"')
+
+    # the file isn't fetched, as it hasn't changed
+    assert GithubReport(report, use_cache=False).last_updated() == date(2021, 4, 25)
+    assert len(httpretty.latest_requests()) == 1
+
+
+@pytest.mark.django_db
+def test_github_report_records_validators_of_fetched_file(httpretty):
+    html = "<p>foo</p>"
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://api.github.com/repos/opensafely/test/contents/foo.html?ref=main",
+        status=200,
+        body=json.dumps(
+            {
+                "name": "foo.html",
+                "sha": "efgh5678",
+                "content": b64encode(html.encode()).decode(),
+            }
+        ),
+        adding_headers={"ETag": '"new"'},
+    )
+    register_commits_uri(
+        httpretty,
+        owner="opensafely",
+        repo="test",
+        path="foo.html",
+        sha="main",
+        commit_dates="2021-04-25T10:00:00Z",
+    )
+    report = baker.make(Report, repo="test", report_html_file_path="foo.html")
+    repo = GithubRepo(GithubClient(use_cache=False), name="test", owner="opensafely")
+
+    # without a file we've rendered, there's nothing to compare with
+    github_report = GithubReport(report, repo=repo, use_cache=False)
+    assert github_report.is_modified()
+    assert github_report.get_html() == html
+    assert github_report.validators == {"source_sha": "efgh5678"}
+
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://api.github.com/repos/opensafely/test/contents?ref=main",
+        status=200,
+        body=json.dumps([{"name": "foo.html", "sha": "efgh5678"}]),
+        adding_headers={"ETag": '"new"'},
+    )
+    report.record_source(source_sha="abcd1234")
+    github_report = GithubReport(report, repo=repo, use_cache=False)
+    assert github_report.is_modified()
+    assert github_report.get_html() == html
+    assert github_report.validators == {
+        "source_sha": "efgh5678",
+        "source_etag": '"new"',
+    }
+
+
 @pytest.mark.django_db
 def test_integration():
     """Fetch and extract html from a real repo"""
@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from reports.github import GithubReport
+from reports.http import get_github_client, get_session
+from reports.job_server import JobServerClient, JobServerReport
+
+
+def test_clients_share_sessions():
+    cached = get_session(use_cache=True)
+    uncached = get_session(use_cache=False)
+    assert cached is not uncached
+    assert hasattr(cached.cache, "delete_url")
+
+    assert JobServerClient(use_cache=True).session is cached
+    assert JobServerReport(None, use_cache=False).client.session is uncached
+    assert GithubReport(None).client is GithubReport(None).client
+    assert GithubReport(None, use_cache=False).client.session is uncached
+
+
+def test_session_connection_pool_size(settings):
+    settings.HTTP_POOL_SIZE = 3
+    adapter = get_session().get_adapter("https://api.github.com")
+    assert adapter._pool_maxsize == 3
+
+
+@pytest.mark.django_db
+def test_tokens_are_not_shared_between_clients(httpretty):
+    url = "https://jobs.opensafely.org/api/v2/releases/file/file_id"
+    httpretty.register_uri(httpretty.HEAD, url, status=200, body="")
+
+    JobServerClient(token="first").file_exists(url)
+    JobServerClient(token="second").file_exists(url)
+
+    assert [r.headers["Authorization"] for r in httpretty.latest_requests()] == [
+        "first",
+        "second",
+    ]
+    assert "Authorization" not in get_session().headers
+
+
+def test_child_process_does_not_reuse_sessions():
+    session = get_session()
+    client = get_github_client()
+    read_fd, write_fd = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        reused = get_session() is session or get_github_client() is client
+        os.write(write_fd, b"1" if reused else b"0")
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert os.read(read_fd, 1) == b"0"
+    assert get_session() is session
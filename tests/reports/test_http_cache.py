@@ -0,0 +1,166 @@
+import gzip
+import os
+
+import pytest
+
+from reports.http import get_session
+from reports.http_cache import ResponseCache
+
+
+URL = "https://jobs.opensafely.org/org/project/workspace/published/"
+
+
+def mock_files(httpretty, *names, size=1000):
+    for name in names:
+        httpretty.register_uri(httpretty.GET, URL + name, status=200, body=name * size)
+
+
+def cache_key(cache, url):
+    return next(key for key in cache.responses if cache.responses[key].url == url)
+
+
+@pytest.mark.django_db
+def test_responses_are_cached(httpretty):
+    mock_files(httpretty, "a")
+    session = get_session(use_cache=True)
+
+    assert session.get(URL + "a").text == "a" * 1000
+    response = session.get(URL + "a")
+    assert response.from_cache
+    assert response.text == "a" * 1000
+    assert len(httpretty.latest_requests()) == 1
+    assert list(session.cache.urls) == [URL + "a"]
+    assert session.cache.stats() == {
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+        "count": 1,
+        "size": session.cache.stats()["size"],
+    }
+
+
+@pytest.mark.django_db
+def test_cached_responses_without_queries(httpretty, django_assert_num_queries):
+    mock_files(httpretty, "a")
+    session = get_session(use_cache=True)
+    session.get(URL + "a")
+
+    # hits are counted in memory, and added to the totals later
+    with django_assert_num_queries(0):
+        assert session.get(URL + "a").from_cache
+
+    assert session.cache.stats()["hits"] == 1
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("compress", [True, False])
+def test_responses_compressed(httpretty, tmp_path, compress):
+    mock_files(httpretty, "a")
+    cache = ResponseCache(tmp_path, max_size=10**6, compress=compress)
+    session = get_session(use_cache=True)
+    session.cache = cache
+
+    session.get(URL + "a")
+
+    ((_, size, path),) = cache.responses.files()
+    data = path.read_bytes().partition(b"\n")[2]
+    assert data.startswith(b"\x1f\x8b") == compress
+    if compress:
+        assert size < 1000
+        assert b"a" * 1000 in gzip.decompress(data)
+    # either can be read, whatever we're storing now
+    cache.responses.compress = not compress
+    assert session.get(URL + "a").text == "a" * 1000
+
+
+@pytest.mark.django_db
+def test_least_recently_used_responses_are_evicted(httpretty, tmp_path):
+    mock_files(httpretty, "a", "b", "c")
+    cache = ResponseCache(tmp_path, max_size=10**6)
+    session = get_session(use_cache=True)
+    session.cache = cache
+
+    for name in ("a", "b"):
+        session.get(URL + name)
+    (_, size, _), _ = cache.responses.files()
+    cache.max_size = cache.disk_usage.max_size = size * 2
+
+    # mark "a" as used since "b"
+    os.utime(cache.responses.path(cache_key(cache, URL + "b")), (0, 0))
+    session.get(URL + "a")
+    assert len(httpretty.latest_requests()) == 2
+
+    session.get(URL + "c")
+    assert sorted(cache.urls) == [URL + "a", URL + "c"]
+    assert cache.stats()["evictions"] == 1
+
+    # "b" is fetched again
+    session.get(URL + "b")
+    assert len(httpretty.latest_requests()) == 4
+
+
+@pytest.mark.django_db
+def test_responses_only_looked_at_when_they_might_be_too_big(
+    httpretty, tmp_path, mocker
+):
+    mock_files(httpretty, "a", "b", "c")
+    cache = ResponseCache(tmp_path, max_size=10**6)
+    session = get_session(use_cache=True)
+    session.cache = cache
+    files = mocker.spy(cache.responses, "files")
+
+    # the first response stored looks, to find out what's there
+    for name in ("a", "b"):
+        session.get(URL + name)
+    assert files.call_count == 1
+
+    (_, size, _), _ = cache.responses.files()
+    cache.max_size = cache.disk_usage.max_size = size * 2
+    files.reset_mock()
+
+    # over the limit
+    session.get(URL + "c")
+    assert files.call_count == 1
+    assert cache.stats()["evictions"] == 1
+
+
+@pytest.mark.django_db
+def test_responses_looked_at_in_intervals(httpretty, tmp_path, mocker):
+    mock_files(httpretty, "a", "b")
+    cache = ResponseCache(tmp_path, max_size=10**6, evict_interval=0)
+    session = get_session(use_cache=True)
+    session.cache = cache
+    files = mocker.spy(cache.responses, "files")
+
+    for name in ("a", "b"):
+        session.get(URL + name)
+    assert files.call_count == 2
+
+
+@pytest.mark.django_db
+def test_redirects_are_cached(httpretty):
+    httpretty.register_uri(
+        httpretty.GET, URL + "old", status=302, adding_headers={"Location": URL + "new"}
+    )
+    mock_files(httpretty, "new")
+    session = get_session(use_cache=True)
+
+    assert session.get(URL + "old").text == "new" * 1000
+    assert session.get(URL + "old").from_cache
+    assert len(httpretty.latest_requests()) == 2
+
+
+@pytest.mark.django_db
+def test_delete_and_clear(httpretty):
+    mock_files(httpretty, "a", "b")
+    session = get_session(use_cache=True)
+    session.get(URL + "a")
+    session.get(URL + "b")
+
+    session.cache.delete(cache_key(session.cache, URL + "a"))
+    assert list(session.cache.urls) == [URL + "b"]
+    assert len(session.cache.responses) == 1
+
+    session.cache.clear()
+    assert list(session.cache.urls) == []
+    assert session.get(URL + "b").text == "b" * 1000
@@ -0,0 +1,61 @@
+import struct
+
+import pytest
+
+from reports.images import get_image_size
+
+
+def png(width, height):
+    return b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR" + struct.pack(">II", width, height)
+
+
+def jpeg(width, height):
+    # an APP0 segment, which we should skip over, and then the start of frame
+    header = b"\xff\xd8\xff\xe0\x00\x04\x00\x00\xff\xc0\x00\x11\x08"
+    return header + struct.pack(">HH", height, width)
+
+
+def webp(chunk, payload):
+    return b"RIFF\x00\x00\x00\x00WEBP" + chunk + payload
+
+
+@pytest.mark.parametrize(
+    "data,size",
+    [
+        (png(640, 480), (640, 480)),
+        (b"GIF87a" + struct.pack("<HH", 16, 32), (16, 32)),
+        (jpeg(1024, 768), (1024, 768)),
+        (
+            webp(b"VP8 ", b"\x00" * 10 + struct.pack("<HH", 300, 200)),
+            (300, 200),
+        ),
+        (
+            webp(b"VP8L", b"\x00" * 5 + struct.pack("<I", 299 | 199 << 14)),
+            (300, 200),
+        ),
+        (
+            webp(
+                b"VP8X",
+                b"\x00" * 8 + (299).to_bytes(3, "little") + (199).to_bytes(3, "little"),
+            ),
+            (300, 200),
+        ),
+    ],
+    ids=["PNG", "GIF", "JPEG", "WebP (lossy)", "WebP (lossless)", "WebP (extended)"],
+)
+def test_get_image_size(data, size):
+    assert get_image_size(data) == size
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"not an image",
+        png(640, 480)[:20],
+        jpeg(1024, 768)[:10],
+        b"\xff\xd8\x00",
+    ],
+    ids=["Unknown format", "Truncated PNG", "Truncated JPEG", "Corrupt JPEG"],
+)
+def test_get_image_size_unknown(data):
+    assert get_image_size(data) is None
@@ -5,6 +5,7 @@ from django.utils import timezone
 from django.utils.http import http_date
 from model_bakery import baker
 
+from reports.http import get_session
 from reports.job_server import JobServerClient, JobServerReport
 from reports.models import Report
 
@@ -54,7 +55,9 @@ def test_clear_cache_with_caching_session(httpretty):
 
     wrapper = JobServerReport(report, use_cache=True)
 
-    wrapper.get_html()
+    # the report file itself is never cached (see JobServerClient.open_file), but other
+    # responses for its URL are
+    wrapper.client.session.get(url)
     assert url in list(wrapper.client.session.cache.urls)
 
     wrapper.clear_cache()
@@ -224,3 +227,124 @@ def test_report_last_updated_after_fetching(httpretty):
     JobServerReport(report).get_html()
     report.refresh_from_db()
     assert report.last_updated == now.date()
+
+
+@pytest.mark.django_db
+def test_iter_html_from_job_server(httpretty):
+    expected_html = "<html><body><p>caf\u00e9</p></body></html>" * 10
+    url = "https://jobs.opensafely.org/org/project/workspace/published/file_id"
+
+    # Mock the job-server file_exists() request
+    httpretty.register_uri(
+        httpretty.HEAD, url, responses=[httpretty.Response(status=200, body="")]
+    )
+
+    now = timezone.now()
+    httpretty.register_uri(
+        httpretty.GET,
+        url,
+        responses=[
+            httpretty.Response(
+                status=200,
+                body=expected_html.encode(),
+                adding_headers={"Last-Modified": http_date(now.timestamp())},
+            )
+        ],
+    )
+
+    report = baker.make(Report, job_server_url=url)
+    job_server_report = JobServerReport(report, use_cache=False)
+
+    chunks = list(job_server_report.iter_html(chunk_size=7))
+    assert len(chunks) > 1
+    assert "".join(chunks) == expected_html
+    assert report.last_updated == now.date()
+
+
+@pytest.mark.django_db
+def test_iter_html_from_job_server_with_caching_session(httpretty):
+    expected_html = "<html><body><p>caf\u00e9</p></body></html>" * 10
+    url = "https://jobs.opensafely.org/org/project/workspace/published/file_id"
+    httpretty.register_uri(
+        httpretty.HEAD, url, responses=[httpretty.Response(status=200, body="")]
+    )
+    httpretty.register_uri(
+        httpretty.GET,
+        url,
+        responses=[
+            httpretty.Response(
+                status=200,
+                body=expected_html.encode(),
+                adding_headers={"Last-Modified": http_date(timezone.now().timestamp())},
+            )
+        ],
+    )
+
+    report = baker.make(Report, job_server_url=url)
+    job_server_report = JobServerReport(report, use_cache=True)
+
+    # the body isn't read, and stored in the requests cache, before we iterate over it
+    response = job_server_report.open_file()
+    assert not response._content_consumed
+    chunks = list(job_server_report.iter_html(chunk_size=7))
+    assert len(chunks) > 1
+    assert "".join(chunks) == expected_html
+    assert url not in list(get_session(use_cache=True).cache.urls)
+
+
+@pytest.mark.django_db
+def test_conditional_request_to_job_server(httpretty):
+    url = "https://jobs.opensafely.org/org/project/workspace/published/file_id"
+    httpretty.register_uri(
+        httpretty.HEAD, url, responses=[httpretty.Response(status=200, body="")]
+    )
+    last_modified = http_date((timezone.now() - timedelta(days=5)).timestamp())
+    httpretty.register_uri(
+        httpretty.GET,
+        url,
+        responses=[
+            httpretty.Response(status=304, body=""),
+            httpretty.Response(
+                status=200,
+                body="<p>foo</p>",
+                adding_headers={"Last-Modified": last_modified, "ETag": '"abc"'},
+            ),
+        ],
+    )
+    report = baker.make(Report, job_server_url=url)
+    report.record_source(source_etag='"abc"', source_last_modified=last_modified)
+    job_server_report = JobServerReport(report, use_cache=False)
+
+    # the last updated date comes from the conditional request, without the body
+    assert not job_server_report.is_modified()
+    assert job_server_report.last_updated() == report.last_updated
+    request = httpretty.last_request()
+    assert request.headers["If-None-Match"] == '"abc"'
+    assert request.headers["If-Modified-Since"] == last_modified
+
+    # but if we need the body after all, it's fetched unconditionally
+    assert "".join(job_server_report.iter_html()) == "<p>foo</p>"
+    assert "If-None-Match" not in httpretty.last_request().headers
+    assert job_server_report.validators == {
+        "source_etag": '"abc"',
+        "source_last_modified": last_modified,
+    }
+
+
+@pytest.mark.django_db
+def test_unconditional_request_without_validators(httpretty):
+    url = "https://jobs.opensafely.org/org/project/workspace/published/file_id"
+    httpretty.register_uri(
+        httpretty.HEAD, url, responses=[httpretty.Response(status=200, body="")]
+    )
+    httpretty.register_uri(
+        httpretty.GET,
+        url,
+        status=200,
+        body="<p>foo</p>",
+        adding_headers={"Last-Modified": http_date(timezone.now().timestamp())},
+    )
+    report = baker.make(Report, job_server_url=url)
+
+    assert JobServerReport(report, use_cache=False).is_modified()
+    assert "If-Modified-Since" not in httpretty.last_request().headers
@@ -0,0 +1,42 @@
+import pytest
+
+from reports import locks
+
+
+@pytest.mark.django_db
+def test_acquire_and_release():
+    token = locks.acquire("test")
+    assert token is not None
+    assert locks.acquire("test") is None
+    assert locks.acquire("other") is not None
+
+    # only the holder can release it
+    locks.release("test", "not-the-token")
+    assert locks.acquire("test") is None
+    locks.release("test", token)
+    assert locks.acquire("test") is not None
+
+
+@pytest.mark.django_db
+def test_acquire_expired():
+    assert locks.acquire("test", timeout=-1) is not None
+    assert locks.acquire("test") is not None
+
+
+@pytest.mark.django_db
+def test_wait(mocker):
+    # released
+    locks.wait("test")
+
+    token = locks.acquire("test")
+    mocker.patch(
+        "reports.locks.time.sleep", side_effect=lambda _: locks.release("test", token)
+    )
+    locks.wait("test", timeout=10)
+
+
+@pytest.mark.django_db
+def test_wait_timeout():
+    locks.acquire("test")
+    with pytest.raises(locks.LockTimeout):
+        locks.wait("test", timeout=0.01, poll_interval=0.01)
@@ -1,8 +1,11 @@
+
 import pytest
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group, Permission
 from django.core import management
+from django.core.cache import caches
 
+from reports.http import get_session
 from reports.models import Link, Report
 
 
@@ -84,3 +87,59 @@ def test_ensure_groups_existing_group():
     permissions = Permission.objects.filter(content_type__app_label="reports")
     for permission in permissions:
         assert permission in group.permissions.all()
+
+
+@pytest.mark.django_db
+def test_refresh_reports(mocker):
+    refresh_pending = mocker.patch("reports.refresh.refresh_pending")
+    management.call_command("refresh_reports", once=True)
+    refresh_pending.assert_called_once_with()
+
+
+@pytest.mark.django_db
+def test_check_reports(mocker, capsys):
+    mocker.patch("reports.refresh.check_github_reports", return_value=3)
+    management.call_command("check_reports")
+    assert capsys.readouterr().out == "3 report(s) to refresh\n"
+
+
+@pytest.mark.django_db
+def test_http_cache_stats(httpretty, capsys):
+    url = "https://jobs.opensafely.org/org/project/workspace/published/file_id"
+    httpretty.register_uri(httpretty.GET, url, status=200, body="foo")
+    session = get_session(use_cache=True)
+    session.get(url)
+    session.get(url)
+    session.get(url)
+
+    management.call_command("http_cache_stats")
+
+    output = capsys.readouterr().out
+    assert "Responses: 1\n" in output
+    assert "Hits: 2, misses: 1 (hit ratio 66.7%)" in output
+    assert "Evictions: 0" in output
+
+
+@pytest.mark.django_db
+def test_fragment_cache_stats(settings, capsys):
+    settings.CACHES = {
+        **settings.CACHES,
+        "template_fragments": {
+            **settings.CACHES["template_fragments"],
+            "OPTIONS": {"SHARED": "shared_fragments", "STATS_INTERVAL": 0},
+        },
+    }
+    cache = caches["template_fragments"]
+    cache.set("key", "value")
+    cache.get("key")
+    cache.get("missing")
+
+    management.call_command("fragment_cache_stats")
+
+    output = capsys.readouterr().out
+    assert "Fragments: 1\n" in output
+    assert (
+        "Hits: 1 (1 from memory, 0 from the shared cache), misses: 1 (hit ratio 50.0%)"
+        in output
+    )
+    assert "Evictions: 0 from disk, 0 from memory" in output
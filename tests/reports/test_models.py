@@ -2,7 +2,6 @@ import datetime
 from os import environ
 
 import pytest
-from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import ValidationError
 from model_bakery import baker
 
@@ -77,66 +76,6 @@ def test_report_model_validation(
         baker.make(Report, **report_fields)
 
 
-@pytest.mark.django_db
-def test_category_manager(mock_repo_url):
-    # one category exists already, from the migrations.
-    category = Category.objects.first()
-    # Create a second category; neither have any associated Reports
-    baker.make(Category, name="test")
-
-    # No populated categories
-    assert Category.populated.exists() is False
-    mock_repo_url("https://github.com/opensafely/test-repo")
-    baker.make_recipe("reports.dummy_report", category=category)
-    # 2 category objects, only one populated
-    assert Category.objects.count() == 2
-    assert Category.populated.count() == 1
-    assert Category.populated.first() == category
-
-
-@pytest.mark.django_db
-def test_category_for_user(user_no_permission, user_with_permission, mock_repo_url):
-    category = Category.objects.first()
-    draft_category = baker.make(Category, name="test")
-    mock_repo_url("https://github.com/opensafely/test-repo")
-    baker.make_recipe("reports.dummy_report", category=category)
-    baker.make_recipe("reports.dummy_report", category=draft_category, is_draft=True)
-
-    user = AnonymousUser()
-    assert list(Category.populated.for_user(user)) == list(
-        Category.objects.filter(id=category.id)
-    )
-    assert list(Category.populated.for_user(user_no_permission)) == list(
-        Category.objects.filter(id=category.id)
-    )
-    assert list(Category.populated.for_user(user_with_permission)) == list(
-        Category.populated.all()
-    )
-
-
-@pytest.mark.django_db
-def test_archive_category_for_user(
-    user_no_permission, user_with_permission, mock_repo_url
-):
-    # Archive category is never returned in the populated_for_user manager
-    category = Category.objects.first()
-    archive_category = baker.make(Category, name="Archive")
-    mock_repo_url("https://github.com/opensafely/test-repo")
-    baker.make_recipe("reports.dummy_report", category=category)
-    baker.make_recipe("reports.dummy_report", category=archive_category)
-
-    user = AnonymousUser()
-    assert list(Category.populated.for_user(user)) == list(
-        Category.objects.filter(id=category.id)
-    )
-    assert list(Category.populated.for_user(user_no_permission)) == list(
-        Category.objects.filter(id=category.id)
-    )
-    assert list(Category.populated.for_user(user_with_permission)) == list(
-        Category.objects.filter(id=category.id)
-    )
-
-
 @pytest.mark.django_db
 def test_report_all_github_and_all_job_server_fields_filled():
     category = baker.make(Category, name="test")
@@ -392,6 +331,30 @@ def test_cache_refresh_on_report_save_with_links(mock_repo_url):
     assert initial_cache_token != report.cache_token
 
 
+@pytest.mark.django_db
+def test_loading_reports_does_not_query_their_links(
+    mock_repo_url, django_assert_num_queries
+):
+    mock_repo_url("https://github.com/opensafely/test-repo")
+    category = Category.objects.first()
+    for _ in range(3):
+        report = baker.make_recipe("reports.dummy_report", category=category)
+        baker.make(Link, report=report, url="https://test.test")
+
+    with django_assert_num_queries(1):
+        reports = list(Report.objects.all())
+    assert len(reports) == 3
+
+    # a report loaded without its links still refreshes its cache token when a field
+    # that's rendered changes
+    report = reports[0]
+    initial_cache_token = report.cache_token
+    report.title = "A new title"
+    report.save()
+    report.refresh_from_db()
+    assert initial_cache_token != report.cache_token
+
+
 @pytest.mark.django_db
 def test_generate_repo_link_for_new_report(mock_repo_url):
     mock_repo_url("https://github.com/opensafely/test")
@@ -0,0 +1,176 @@
+from datetime import date
+
+import pytest
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.urls import reverse
+from model_bakery import baker
+
+from reports import navigation
+from reports.models import Category, Report
+
+
+@pytest.fixture
+def reports(mock_repo_url):
+    mock_repo_url("https://github.com/opensafely/test-repo")
+    category = Category.objects.first()
+    test_category = baker.make(Category, name="Test")
+    archive = baker.make(Category, name="Archive")
+    return {
+        "published": baker.make_recipe(
+            "reports.dummy_report", category=category, menu_name="b"
+        ),
+        "draft": baker.make_recipe(
+            "reports.dummy_report", category=category, menu_name="a", is_draft=True
+        ),
+        "draft_only": baker.make_recipe(
+            "reports.dummy_report", category=test_category, is_draft=True
+        ),
+        "archived": baker.make_recipe("reports.dummy_report", category=archive),
+    }
+
+
+def _names(categories):
+    return {
+        category.name: [report.menu_name for report in category.reports]
+        for category in categories
+    }
+
+
+@pytest.mark.django_db
+def test_build(reports, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        categories, _ = navigation.build()
+
+    assert [category.name for category in categories] == ["Archive", "Reports", "Test"]
+    report = categories[1].reports[0]
+    assert report == navigation.NavReport(
+        reports["draft"].id, "a", reports["draft"].get_absolute_url(), True
+    )
+
+
+@pytest.mark.django_db
+def test_categories_for_user(reports, user_no_permission, user_with_permission):
+    archived = reports["archived"].menu_name
+    draft_only = reports["draft_only"].menu_name
+
+    assert _names(navigation.categories_for_user(AnonymousUser())) == {"Reports": ["b"]}
+    assert _names(navigation.categories_for_user(user_no_permission)) == {
+        "Reports": ["b"]
+    }
+    assert _names(navigation.categories_for_user(user_with_permission)) == {
+        "Reports": ["a", "b"],
+        "Test": [draft_only],
+    }
+
+    user_with_permission.is_staff = True
+    assert _names(navigation.categories_for_user(user_with_permission)) == {
+        "Archive": [archived],
+        "Reports": ["a", "b"],
+        "Test": [draft_only],
+    }
+
+
+@pytest.mark.django_db
+def test_categories_for_user_without_queries(reports, django_assert_num_queries):
+    user = AnonymousUser()
+    # builds the tree
+    navigation.categories_for_user(user)
+
+    with django_assert_num_queries(0):
+        categories = navigation.categories_for_user(user)
+    assert _names(categories) == {"Reports": ["b"]}
+
+
+@pytest.mark.django_db
+def test_categories_for_user_updated_on_save_and_delete(reports):
+    user = AnonymousUser()
+    assert _names(navigation.categories_for_user(user)) == {"Reports": ["b"]}
+
+    report = reports["draft"]
+    report.is_draft = False
+    report.save()
+    assert _names(navigation.categories_for_user(user)) == {"Reports": ["a", "b"]}
+
+    category = Category.objects.get(name="Reports")
+    category.name = "Other reports"
+    category.save()
+    assert _names(navigation.categories_for_user(user)) == {"Other reports": ["a", "b"]}
+
+    Report.objects.filter(pk=report.pk).delete()
+    assert _names(navigation.categories_for_user(user)) == {"Other reports": ["b"]}
+
+
+@pytest.mark.django_db
+def test_categories_for_user_updated_by_other_workers(
+    reports, settings, django_assert_num_queries
+):
+    user = AnonymousUser()
+    navigation.categories_for_user(user)
+
+    # another worker publishes a draft
+    Report.objects.filter(pk=reports["draft"].pk).update(is_draft=False)
+    cache.incr(navigation.VERSION_KEY)
+
+    # which we don't know about until we next check the version
+    with django_assert_num_queries(0):
+        categories = navigation.categories_for_user(user)
+    assert _names(categories) == {"Reports": ["b"]}
+
+    settings.NAVIGATION_CHECK_INTERVAL = 0
+    assert _names(navigation.categories_for_user(user)) == {"Reports": ["a", "b"]}
+
+    # only the version is read when it hasn't changed
+    with django_assert_num_queries(1):
+        navigation.categories_for_user(user)
+
+
+@pytest.mark.django_db
+def test_version_is_bumped_once_committed(reports, django_capture_on_commit_callbacks):
+    cache.delete(navigation.VERSION_KEY)
+    navigation.categories_for_user(AnonymousUser())
+    version = cache.get(navigation.VERSION_KEY)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        reports["published"].save()
+
+    assert cache.get(navigation.VERSION_KEY) == version + 1
+
+
+@pytest.mark.django_db
+def test_recent_activity_for_user(reports, user_with_permission):
+    published = reports["published"]
+    published.publication_date = date(2021, 1, 1)
+    published.last_updated = date(2021, 3, 1)
+    published.save()
+    draft = reports["draft"]
+    draft.publication_date = date(2021, 2, 1)
+    draft.save()
+    Report.objects.exclude(pk__in=[published.pk, draft.pk]).update(
+        publication_date=date(2020, 1, 1), last_updated=None
+    )
+
+    # archived reports are never listed
+    assert navigation.recent_activity_for_user(AnonymousUser()) == (
+        navigation.Activity(
+            published.id, "b", published.get_absolute_url(), "updated", date(2021, 3, 1)
+        ),
+    )
+    activity = navigation.recent_activity_for_user(user_with_permission)
+    assert [(event.id, event.activity) for event in activity] == [
+        (published.id, "updated"),
+        (draft.id, "published"),
+        (reports["draft_only"].id, "published"),
+    ]
+
+
+@pytest.mark.django_db
+def test_landing_without_queries(client, reports, django_assert_num_queries):
+    client.get(reverse("landing"))
+
+    # only the cache middleware's lookup of the page, which is never cached
+    with django_assert_num_queries(1):
+        response = client.get(reverse("landing"))
+    assert [event.id for event in response.context["recent_activity"]] == [
+        reports["published"].id
+    ]
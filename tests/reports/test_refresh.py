@@ -0,0 +1,223 @@
+import json
+from datetime import date, datetime, timedelta
+
+import pytest
+from django.utils import timezone
+from django.utils.http import http_date
+from model_bakery import baker
+
+from reports.fragments import fragment_placeholder, store_fragment
+from reports.models import Report, ReportRefresh
+from reports.refresh import (
+    check_github_reports,
+    get_fragment_cache,
+    is_stale,
+    refresh_pending,
+    refresh_report,
+    report_content_key,
+    run_worker,
+)
+
+
+# Not used by other tests, so no responses for it are in the requests cache
+URL = "https://jobs.opensafely.org/org/project/workspace/published/refreshed_file"
+
+
+def mock_job_server_file(httpretty, body):
+    httpretty.register_uri(
+        httpretty.HEAD, URL, responses=[httpretty.Response(status=200, body="")]
+    )
+    httpretty.register_uri(
+        httpretty.GET,
+        URL,
+        status=200,
+        body=body,
+        adding_headers={"Last-Modified": http_date(datetime.now().timestamp())},
+    )
+
+
+def make_stale(report):
+    checked_at = timezone.now() - timedelta(days=2)
+    Report.objects.filter(pk=report.pk).update(source_checked_at=checked_at)
+
+
+def get_content(client, report):
+    response = client.get(report.get_absolute_url())
+    return b"".join(response.streaming_content).decode()
+
+
+@pytest.mark.django_db
+def test_is_stale(settings):
+    settings.REPORT_CONTENT_REFRESH_AFTER = 60
+    report = Report()
+    assert is_stale(report)
+
+    report.source_checked_at = timezone.now() - timedelta(seconds=30)
+    assert not is_stale(report)
+
+    report.source_checked_at = timezone.now() - timedelta(seconds=90)
+    assert is_stale(report)
+
+
+@pytest.mark.django_db
+def test_stale_content_is_served_and_refreshed_in_background(client, httpretty):
+    mock_job_server_file(httpretty, "<html><body><p>Old content</p></body></html>")
+    report = baker.make(Report, job_server_url=URL)
+    assert "<p>Old content</p>" in get_content(client, report)
+    assert not ReportRefresh.objects.exists()
+
+    # the content is out of date, but it's still served without fetching the report
+    mock_job_server_file(httpretty, "<html><body><p>New content</p></body></html>")
+    make_stale(report)
+    httpretty.reset()
+    assert "<p>Old content</p>" in get_content(client, report)
+    assert "<p>Old content</p>" in get_content(client, report)
+    assert httpretty.latest_requests() == []
+    assert ReportRefresh.objects.filter(report=report).count() == 1
+
+    # the worker fetches and renders the report again
+    mock_job_server_file(httpretty, "<html><body><p>New content</p></body></html>")
+    assert refresh_pending() == 1
+    assert not ReportRefresh.objects.exists()
+
+    httpretty.reset()
+    assert "<p>New content</p>" in get_content(client, report)
+    assert httpretty.latest_requests() == []
+    assert not ReportRefresh.objects.exists()
+
+
+@pytest.mark.django_db
+def test_refresh_error(client, httpretty, log_output):
+    mock_job_server_file(httpretty, "<html><body><p>Old content</p></body></html>")
+    report = baker.make(Report, job_server_url=URL)
+    get_content(client, report)
+    make_stale(report)
+    get_content(client, report)
+
+    httpretty.register_uri(httpretty.GET, URL, status=500, body="")
+    assert refresh_pending() == 1
+
+    assert log_output.entries[-1]["event"] == "Error refreshing report"
+    # the old content is still served, and the refresh will be asked for again
+    assert not ReportRefresh.objects.exists()
+    assert "<p>Old content</p>" in get_content(client, report)
+    assert ReportRefresh.objects.exists()
+
+
+@pytest.mark.django_db
+def test_refresh_unchanged_github_report(httpretty):
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://api.github.com/repos/opensafely/test/contents/reports?ref=main",
+        status=200,
+        # another file in the folder has changed, but this one hasn't
+        body=json.dumps(
+            [
+                {"name": "other.html", "sha": "5678efgh"},
+                {"name": "report.html", "sha": "abcd1234"},
+            ]
+        ),
+        adding_headers={"ETag": '"new"'},
+    )
+    report = baker.make(
+        Report,
+        repo="test",
+        report_html_file_path="reports/report.html",
+        last_updated=date(2021, 4, 25),
+    )
+    key = store_fragment(["<p>Rendered content</p>"])
+    report.record_source(fragment_key=key, source_sha="abcd1234", source_etag='"old"')
+
+    refresh_report(report)
+
+    # the file isn't fetched, just the listing of its folder
+    assert len(httpretty.latest_requests()) == 1
+    content = get_fragment_cache().get(report_content_key(report))
+    assert fragment_placeholder(key) in content
+    assert "25 Apr 2021" in content
+    report.refresh_from_db()
+    assert (report.source_sha, report.source_etag) == ("abcd1234", '"new"')
+
+
+def mock_tree(httpretty, repo, files, truncated=False):
+    httpretty.register_uri(
+        httpretty.GET,
+        f"https://api.github.com/repos/opensafely/{repo}/git/trees/main?recursive=1",
+        status=200,
+        body=json.dumps(
+            {
+                "tree": [{"path": "reports", "type": "tree", "sha": "0000"}]
+                + [
+                    {"path": path, "type": "blob", "sha": sha}
+                    for path, sha in files.items()
+                ],
+                "truncated": truncated,
+            }
+        ),
+    )
+
+
+def make_github_report(path, sha, repo="test"):
+    report = baker.make(Report, repo=repo, report_html_file_path=path)
+    report.record_source(source_sha=sha)
+    return report
+
+
+@pytest.mark.django_db
+def test_check_github_reports(httpretty, log_output):
+    mock_tree(
+        httpretty,
+        "test",
+        {"reports/same.html": "abcd1234", "reports/changed.html": "efgh5678"},
+    )
+    httpretty.register_uri(
+        httpretty.GET,
+        "https://api.github.com/repos/opensafely/broken/git/trees/main?recursive=1",
+        status=404,
+        body=json.dumps({"message": "Not Found"}),
+    )
+    same = make_github_report("reports/same.html", "abcd1234")
+    changed = make_github_report("reports/changed.html", "1234abcd")
+    removed = make_github_report("reports/removed.html", "1234abcd")
+    # not rendered yet, so there's nothing to compare with
+    baker.make(Report, repo="test", report_html_file_path="reports/new.html")
+    make_github_report("reports/same.html", "abcd1234", repo="broken")
+
+    assert check_github_reports() == 2
+
+    # one request per repo, whatever the number of reports
+    assert len(httpretty.latest_requests()) == 2
+    assert set(ReportRefresh.objects.values_list("report_id", flat=True)) == {
+        changed.pk,
+        removed.pk,
+    }
+    same.refresh_from_db()
+    assert same.source_checked_at is not None
+    assert "Error checking repo for changes" in [
+        entry["event"] for entry in log_output.entries
+    ]
+
+    # asking again doesn't ask for the refreshes again
+    assert check_github_reports() == 2
+    assert ReportRefresh.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_check_github_reports_truncated_tree(httpretty):
+    mock_tree(httpretty, "test", {"reports/same.html": "abcd1234"}, truncated=True)
+    report = make_github_report("reports/same.html", "abcd1234")
+
+    # each report is checked as it's refreshed instead
+    assert check_github_reports() == 1
+    assert ReportRefresh.objects.get().report_id == report.pk
+
+
+@pytest.mark.django_db
+def test_worker_checks_github_reports(mocker, settings):
+    check = mocker.patch("reports.refresh.check_github_reports")
+    run_worker(once=True)
+    check.assert_called_once_with()
+
+    settings.REFRESH_CHECK_INTERVAL = 0
+    run_worker(once=True)
+    check.assert_called_once_with()
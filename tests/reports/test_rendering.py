@@ -1,6 +1,13 @@
+import json
+import re
+from base64 import b64encode
+from hashlib import sha256
+from io import StringIO
+
 import pytest
 
-from reports.rendering import process_html
+from reports.fragments import CellStore, ImageStore, TableStore
+from reports.rendering import HTMLRenderer, process_html, stream_html
 
 from .utils import assert_html_equal
 
@@ -164,3 +171,357 @@ def test_html_processing_extracts_body(html):
 def test_html_processing_wraps_scrollables(input_html, expected):
     html = process_html(input_html)
     assert_html_equal(html, expected)
+
+
+@pytest.mark.django_db
+def test_html_processing_collapses_whitespace_outside_pre():
+    html = process_html(
+        """
+            <div>
+                <p>foo</p>    <p>bar</p>
+            </div>
+            <pre>  some
+    indented code  </pre>
+        """
+    )
+    assert html == (
+        "\n<div>\n<p>foo</p> <p>bar</p>\n</div>\n"
+        '<div class="overflow-wrapper"><pre>  some\n    indented code  </pre></div>\n'
+    )
+
+
+@pytest.mark.django_db
+def test_html_processing_strips_unsafe_attributes():
+    html = process_html(
+        """
+            <a href="javascript:alert('BOOM!')" class="link">foo</a>
+            <img src="data:image/png;base64,iVBORw0KGgo=" alt="a figure">
+            <img src="data:image/svg+xml;base64,PHN2Zz4=">
+        """
+    )
+    assert_html_equal(
+        html,
+        """
+            <a href="" class="link">foo</a>
+            <img src="data:image/png;base64,iVBORw0KGgo=" alt="a figure" decoding="async">
+            <img src="" decoding="async">
+        """,
+    )
+
+
+@pytest.mark.django_db
+def test_html_processing_strips_nuls():
+    html = process_html('<a href="java\0script:alert(1)">x</a><p>after</p>')
+    assert html == '<a href="">x</a><p>after</p>'
+
+
+def test_renderer_closes_elements_that_are_not_ended():
+    sink = StringIO()
+    renderer = HTMLRenderer(sink, buffer_size=10)
+    renderer.start("html", {})
+    renderer.start("body", {})
+    renderer.start("div", {})
+    renderer.start("a", {"href": "/"})
+    renderer.data("x")
+    # an end without a start is ignored
+    renderer.end("p")
+    # the end of the body ends the <a> and <div> inside it
+    renderer.end("body")
+    renderer.start("body", {})
+    renderer.start("p", {})
+    renderer.data("y")
+    # anything still open is ended when we're closed
+    renderer.close()
+
+    assert sink.getvalue() == '<div><a href="/">x</a></div><p>y</p>'
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 4096])
+def test_stream_html_matches_process_html(chunk_size):
+    html = """
+        <!DOCTYPE html>
+        <html>
+            <head><style>body {margin: 0;}</style></head>
+            <body>
+                <p onclick="alert('BOOM!')">caf\u00e9 &amp; bar</p>
+                <script>Some Javascript nonsense</script>
+                <table><tr><td>something</td></tr></table>
+                <pre>  some code  </pre>
+            </body>
+        </html>
+    """
+    chunks = re.findall(f".{{1,{chunk_size}}}", html, flags=re.DOTALL)
+
+    writes = []
+
+    class Sink:
+        def write(self, html):
+            writes.append(html)
+
+    stream_html(chunks, Sink(), buffer_size=10)
+
+    assert "".join(writes) == process_html(html)
+    # output is written out as it is produced, not all at the end
+    assert len(writes) > 1
+
+
+def test_stream_html_empty():
+    sink = StringIO()
+    stream_html([], sink)
+    assert sink.getvalue() == ""
+
+
+@pytest.mark.django_db
+def test_stream_html_extracts_embedded_images(tmp_path):
+    png = b"\x89PNG\r\n\x1a\nnot really a png"
+    encoded = b64encode(png).decode()
+    html = f"""
+        <img src="data:image/png;base64,{encoded}" alt="figure 1">
+        <img src="data:image/PNG;base64,{encoded}">
+        <img src="https://example.com/figure.png">
+    """
+    images = ImageStore(tmp_path)
+    sink = StringIO()
+
+    stream_html([html], sink, images=images)
+
+    name = f"{sha256(png).hexdigest()}.png"
+    assert_html_equal(
+        sink.getvalue(),
+        f"""
+            <img src="/report-images/{name}" alt="figure 1" decoding="async">
+            <img src="/report-images/{name}" decoding="async">
+            <img src="https://example.com/figure.png" decoding="async" loading="lazy">
+        """,
+    )
+    # the same image is only stored once
+    assert [path.name for path in tmp_path.iterdir()] == [name]
+    assert images.path(name).read_bytes() == png
+
+
+def test_html_processing_sizes_embedded_images():
+    gif = b"GIF89a\x40\x01\xf0\x00" + b"\x00" * 10
+    encoded = b64encode(gif).decode()
+    html = process_html(
+        f"""
+            <img src="data:image/gif;base64,{encoded}">
+            <img src="data:image/gif;base64,{encoded}" width="100">
+            <img src="data:image/gif;base64,bm90IGFuIGltYWdl">
+        """
+    )
+    assert_html_equal(
+        html,
+        f"""
+            <img src="data:image/gif;base64,{encoded}" width="320" height="240" decoding="async">
+            <img src="data:image/gif;base64,{encoded}" width="100" decoding="async">
+            <img src="data:image/gif;base64,bm90IGFuIGltYWdl" decoding="async" loading="lazy">
+        """,
+    )
+
+
+def test_html_processing_defers_cells_below_the_fold():
+    cells = "".join(
+        f'<div class="jp-Cell jp-CodeCell"><div class="output">{i}</div></div>'
+        for i in range(10)
+    )
+    html = process_html(cells)
+
+    assert html.count('class="jp-Cell jp-CodeCell"') == 8
+    assert html.count('class="jp-Cell jp-CodeCell deferred-cell"') == 2
+    assert 'class="output"' in html
+
+
+def dataframe(rows, row_attrs=""):
+    body = "".join(
+        f"<tr><th{row_attrs}>{i}</th><td>{i * 2}</td><td>a &amp; b</td></tr>"
+        for i in range(rows)
+    )
+    return (
+        '<table border="1" class="dataframe">'
+        "<thead><tr><th></th><th>x</th><th>y</th></tr></thead>"
+        f"<tbody>{body}</tbody></table>"
+    )
+
+
+@pytest.mark.django_db
+def test_stream_html_virtualises_large_tables(settings, tmp_path):
+    settings.VIRTUAL_TABLE_MIN_ROWS = 25
+    sink = StringIO()
+
+    stream_html(
+        [f"<p>before</p>{dataframe(30)}<p>after</p>"], sink, tables=TableStore(tmp_path)
+    )
+
+    (path,) = tmp_path.glob("*.json")
+    url = f"/report-tables/{path.name}"
+    preview_rows = "".join(
+        f"<tr><th>{i}</th><td>{i * 2}</td><td>a &amp; b</td></tr>" for i in range(20)
+    )
+    assert_html_equal(
+        sink.getvalue(),
+        f"""
+            <p>before</p>
+            <virtual-table data-src="{url}" data-rows="30">
+                <div class="overflow-wrapper">
+                    <table border="1" class="dataframe">
+                        <thead><tr><th></th><th>x</th><th>y</th></tr></thead>
+                        <tbody>{preview_rows}</tbody>
+                    </table>
+                </div>
+                <p class="virtual-table__summary">
+                    Showing the first 20 of 30 rows.
+                    <a href="{url}" download>Download all rows (JSON)</a>
+                </p>
+            </virtual-table>
+            <p>after</p>
+        """,
+    )
+    data = json.loads(path.read_text())
+    assert data["header"] == [["", "x", "y"]]
+    assert data["rows"] == [[str(i), str(i * 2), "a & b"] for i in range(30)]
+    assert path.name == f"{sha256(path.read_bytes()).hexdigest()}.json"
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "html",
+    [
+        dataframe(25),
+        dataframe(30, row_attrs=' rowspan="2"'),
+        dataframe(30).replace(
+            "<td>0</td>", "<td><table><tr><td>inner</td></tr></table></td>"
+        ),
+    ],
+    ids=["Small table", "Merged cells", "Nested tables"],
+)
+def test_stream_html_does_not_virtualise(settings, tmp_path, html):
+    settings.VIRTUAL_TABLE_MIN_ROWS = 25
+    sink = StringIO()
+
+    stream_html([html], sink, tables=TableStore(tmp_path))
+
+    assert sink.getvalue() == process_html(html)
+    assert "<virtual-table" not in sink.getvalue()
+    assert not tmp_path.exists() or list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.django_db
+def test_stream_html_virtual_table_with_nested_table(settings, tmp_path):
+    settings.VIRTUAL_TABLE_MIN_ROWS = 25
+    html = dataframe(30).replace(
+        "</tbody>", "<tr><td><table><tr><td>inner</td></tr></table></td></tr></tbody>"
+    )
+    sink = StringIO()
+
+    stream_html([html + "<p>after</p>"], sink, tables=TableStore(tmp_path))
+
+    assert 'data-rows="31"' in sink.getvalue()
+    assert sink.getvalue().endswith("</virtual-table><p>after</p>")
+    (path,) = tmp_path.glob("*.json")
+    assert json.loads(path.read_text())["rows"][-1] == ["inner"]
+
+
+def notebook(cells):
+    """A notebook export, with a cell for each of `cells`"""
+    body = "\n".join(
+        f'<div class="jp-Cell jp-CodeCell"><div class="output">{cell}</div></div>'
+        for cell in cells
+    )
+    return (
+        "<html><head><style>body {margin: 0;}</style></head>"
+        f"<body><main>\n{body}\n</main></body></html>"
+    )
+
+
+def render_cells(html, cells, chunk_size=None):
+    chunks = re.findall(f".{{1,{chunk_size or len(html)}}}", html, flags=re.DOTALL)
+    sink = StringIO()
+    stream_html(chunks, sink, cells=cells)
+    return sink.getvalue()
+
+
+def cell_log(log_output):
+    entries = [e for e in log_output.entries if e["event"] == "Rendered report cells"]
+    log_output.entries.clear()
+    return entries[-1]["reused"], entries[-1]["rendered"]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("chunk_size", [None, 7])
+def test_stream_html_reuses_rendered_cells(mocker, tmp_path, log_output, chunk_size):
+    mocker.patch("reports.rendering.MIN_CACHED_CELL_SIZE", 0)
+    store = CellStore(tmp_path, max_size=10**6)
+    png = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x04\x00\x00\x00\x03"
+    image = f'<img src="data:image/png;base64,{b64encode(png).decode()}">'
+    cells = [f"<p>cell {i}</p>{image}" for i in range(10)]
+
+    html = notebook(cells)
+    first = render_cells(html, store, chunk_size)
+    assert first == process_html(html)
+    assert cell_log(log_output) == (0, 10)
+    # every cell but the last, which runs on to the end of the document
+    assert render_cells(html, store, chunk_size) == first
+    assert cell_log(log_output) == (9, 1)
+
+    # only the changed cell is rendered again
+    cells[5] = "<p>changed <b>cell</b></p>"
+    changed_html = notebook(cells)
+    changed = render_cells(changed_html, store, chunk_size)
+    assert cell_log(log_output) == (8, 2)
+
+    # and the output is the same as rendering from scratch, including whether images
+    # are lazy-loaded and cells deferred, which depend on what came before them
+    assert changed == process_html(changed_html)
+    assert "<p>changed <b>cell</b></p>" in changed
+    assert changed.count('loading="lazy"') == 7
+    assert changed.count("deferred-cell") == 2
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "html,reused",
+    [
+        # something in between cells, which isn't part of either
+        ('<div class="cell"><p>a</p></div><p>between</p>\n<div class="cell"></div>', 1),
+        # text before a cell, which the parser holds on to until it sees the next tag
+        ('<p>a</p>before<div class="cell"><p>b</p></div>\n<div class="cell"></div>', 1),
+        # a cell inside another element, which ends before the next cell starts
+        ('<div><div class="cell"><p>a</p></div></div>\n<div class="cell"></div>', 1),
+        # what looks like a cell, inside something whose content we don't render
+        (
+            '<script>"<div class="cell"><p>a</p></div>"</script><div class="cell"></div>',
+            1,
+        ),
+    ],
+    ids=["Content between cells", "Text before cell", "Nested", "Script"],
+)
+def test_stream_html_only_reuses_whole_cells(
+    mocker, tmp_path, log_output, html, reused
+):
+    mocker.patch("reports.rendering.MIN_CACHED_CELL_SIZE", 0)
+    store = CellStore(tmp_path, max_size=10**6)
+
+    first = render_cells(html, store)
+    second = render_cells(html, store)
+
+    assert cell_log(log_output)[0] == reused
+    assert first == second == process_html(html)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("sniff_length", [0, 4096], ids=["Streamed", "One chunk"])
+def test_stream_html_does_not_store_large_cells(
+    mocker, tmp_path, log_output, sniff_length
+):
+    mocker.patch("reports.rendering.MIN_CACHED_CELL_SIZE", 0)
+    mocker.patch("reports.rendering.MAX_CACHED_CELL_SIZE", 100)
+    mocker.patch("reports.rendering.CELL_START_LOOKBEHIND", 30)
+    mocker.patch("reports.rendering.DOCUMENT_SNIFF_LENGTH", sniff_length)
+    store = CellStore(tmp_path, max_size=10**6)
+    html = notebook(["<p>small</p>", f"<p>{'large ' * 100}</p>", "<p>last</p>"])
+
+    render_cells(html, store, chunk_size=20)
+    output = render_cells(html, store, chunk_size=20)
+
+    assert cell_log(log_output) == (1, 1)
+    assert output == process_html(html)
@@ -0,0 +1,261 @@
+import os
+import time
+
+import pytest
+from django.core.cache import caches
+
+from reports.tiered_cache import TieredCache
+
+
+@pytest.fixture
+def make_cache(tmp_path):
+    made = []
+
+    def make(host="tiered-cache", **options):
+        cache = TieredCache(
+            tmp_path / host, {"OPTIONS": {"STATS_INTERVAL": 0, **options}}
+        )
+        made.append(cache)
+        return cache
+
+    yield make
+    for cache in made:
+        cache.forget()
+
+
+def _set_mtime(cache, key, mtime):
+    path = cache._path(cache.make_and_validate_key(key))
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.mark.django_db
+def test_get_and_set(make_cache):
+    cache = make_cache()
+    assert cache.get("key") is None
+    assert cache.get("key", "default") == "default"
+
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert "key" in cache
+
+    # from another process, which has nothing in memory
+    cache.memory.clear()
+    assert cache.get("key") == "value"
+
+    stats = cache.stats()
+    assert stats["memory_hits"] == 1
+    assert stats["disk_hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["count"] == 1
+
+
+@pytest.mark.django_db
+def test_get_set_by_another_process(make_cache):
+    cache = make_cache()
+    other_process = make_cache()
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+
+    other_process.memory = type(cache.memory)(cache.memory_max_size)
+    other_process.set("key", "new value")
+    # our copy in memory is out of date, so it's read from disk
+    assert cache.get("key") == "new value"
+
+    other_process.delete("key")
+    assert cache.get("key") is None
+
+
+@pytest.mark.django_db
+def test_get_set_by_another_host(make_cache):
+    cache = make_cache(SHARED="shared_fragments")
+    other_host = make_cache("other-host", SHARED="shared_fragments")
+    cache.set("key", "value")
+    # it has nothing on disk, so it's read from the shared cache, and kept
+    assert other_host.get("key") == "value"
+    assert other_host.get("key") == "value"
+
+    # refreshed by the other host's worker, so our copy on disk is out of date
+    other_host.set("key", "new value")
+    assert cache.get("key") == "new value"
+    assert cache.get("key") == "new value"
+
+    stats = cache.stats()
+    assert stats["shared_hits"] == 2
+    assert stats["memory_hits"] == 2
+
+    other_host.delete("key")
+    assert "key" not in cache
+    assert cache.get("key") is None
+
+
+@pytest.mark.django_db
+def test_get_reads_only_the_token_from_the_shared_cache(
+    make_cache, django_assert_num_queries
+):
+    cache = make_cache(SHARED="shared_fragments", STATS_INTERVAL=60)
+    cache.set("key", "value")
+    with django_assert_num_queries(1):
+        assert cache.get("key") == "value"
+    cache.memory.clear()
+    with django_assert_num_queries(1):
+        assert cache.get("key") == "value"
+
+
+@pytest.mark.django_db
+def test_add_touch_and_delete_shared(make_cache):
+    cache = make_cache(SHARED="shared_fragments")
+    other_host = make_cache("other-host", SHARED="shared_fragments")
+    assert cache.add("key", "value")
+    assert not other_host.add("key", "other value")
+
+    assert other_host.touch("key", timeout=None)
+    assert not other_host.touch("missing")
+    assert cache.get("key") == "value"
+
+    assert other_host.delete("key")
+    assert not other_host.delete("key")
+    assert cache.get("key") is None
+
+
+@pytest.mark.django_db
+def test_expiry(make_cache):
+    cache = make_cache()
+    cache.set("key", "value", timeout=0.1)
+    cache.set("forever", "value", timeout=None)
+    assert cache.get("key") == "value"
+
+    time.sleep(0.2)
+
+    assert cache.get("key") is None
+    assert "key" not in cache
+    assert cache.get("forever") == "value"
+
+    cache.set("key", "value", timeout=0)
+    assert "key" not in cache
+
+
+@pytest.mark.django_db
+def test_add_touch_and_delete(make_cache):
+    cache = make_cache()
+    assert cache.add("key", "value")
+    assert not cache.add("key", "other value")
+    assert cache.get("key") == "value"
+
+    assert cache.touch("key", timeout=None)
+    assert not cache.touch("missing")
+    assert cache.get("key") == "value"
+    assert cache.stats()["memory_hits"] == 2
+
+    assert cache.delete("key")
+    assert not cache.delete("key")
+    assert cache.get("key") is None
+
+
+@pytest.mark.django_db
+def test_memory_evicts_least_recently_used(make_cache):
+    cache = make_cache(MEMORY_MAX_SIZE=250)
+    cache.set("a", "a" * 100)
+    cache.set("b", "b" * 100)
+    cache.get("a")
+    cache.set("c", "c" * 100)
+
+    assert cache.memory.size <= 250
+    assert list(cache.memory.entries) == [
+        cache.make_and_validate_key("a"),
+        cache.make_and_validate_key("c"),
+    ]
+    # still on disk
+    assert cache.get("b") == "b" * 100
+    assert cache.stats()["memory_evictions"] == 2
+
+
+@pytest.mark.django_db
+def test_disk_evicts_least_recently_used(make_cache):
+    cache = make_cache(MAX_SIZE=350)
+    cache.set("a", "a" * 100)
+    cache.set("b", "b" * 100)
+    _set_mtime(cache, "a", time.time() - 20)
+    _set_mtime(cache, "b", time.time() - 10)
+    # using it marks it as recently used
+    cache.get("a")
+
+    cache.set("c", "c" * 100)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    stats = cache.stats()
+    assert stats["disk_evictions"] == 1
+    assert stats["size"] <= 350
+
+
+@pytest.mark.django_db
+def test_disk_only_looked_at_when_it_might_be_too_big(make_cache, mocker):
+    cache = make_cache(MAX_SIZE=350)
+    files = mocker.spy(cache, "_files")
+    # the first write looks, to find out what's there
+    cache.set("a", "a" * 100)
+    cache.set("b", "b" * 100)
+    assert files.call_count == 1
+
+    # over the limit
+    cache.set("c", "c" * 100)
+    assert files.call_count == 2
+    assert cache.stats()["size"] <= 350
+
+
+@pytest.mark.django_db
+def test_disk_looked_at_in_intervals(make_cache, mocker):
+    cache = make_cache(EVICT_INTERVAL=0)
+    files = mocker.spy(cache, "_files")
+    cache.set("a", "a")
+    cache.set("b", "b")
+    assert files.call_count == 2
+
+
+@pytest.mark.django_db
+def test_clear(make_cache):
+    cache = make_cache()
+    cache.set("key", "value")
+    cache.clear()
+    assert cache.get("key") is None
+    assert cache.stats()["count"] == 0
+
+
+@pytest.mark.django_db
+def test_clear_shared(make_cache):
+    cache = make_cache(SHARED="shared_fragments")
+    other_host = make_cache("other-host", SHARED="shared_fragments")
+    cache.set("key", "value")
+    other_host.clear()
+    assert cache.get("key") is None
+
+
+@pytest.mark.django_db
+def test_forget(make_cache):
+    cache = make_cache()
+    cache.set("key", "value")
+    cache.forget()
+
+    # as if in a new process
+    cache = make_cache()
+    assert not cache.memory.entries
+    assert cache.disk_usage.size is None
+    assert cache.get("key") == "value"
+    assert cache.stats()["disk_hits"] == 1
+
+
+@pytest.mark.django_db
+def test_stats_counted_in_intervals(make_cache):
+    cache = make_cache(STATS_INTERVAL=60)
+    cache.get("key")
+    assert caches["default"].get("tiered_cache:misses") is None
+
+    assert cache.stats()["misses"] == 1
+    assert caches["default"].get("tiered_cache:misses") == 1
+
+
+@pytest.mark.django_db
+def test_template_fragments_cache():
+    assert isinstance(caches["template_fragments"], TieredCache)
+    assert caches["template_fragments"].shared is caches["shared_fragments"]
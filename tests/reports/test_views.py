@@ -1,11 +1,24 @@
-from datetime import date, timedelta
+import gzip
+import re
+import shutil
+from datetime import date, datetime, timedelta, timezone
 
+import brotli
 import pytest
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.template.loader import render_to_string
 from django.urls import reverse
+from django.utils.http import http_date
 from model_bakery import baker
 
+from reports import locks, navigation
+from reports.circuits import CircuitBreaker
+from reports.fragments import get_image_store, get_table_store, store_fragment
 from reports.models import Category, Report
+from reports.refresh import get_fragment_cache, report_content_key
 from reports.rendering import process_html
+from reports.workers import RenderTimeout
 
 from .utils import assert_html_equal
 
@@ -26,7 +39,9 @@ def test_landing_view(client, mock_repo_url):
     baker.make_recipe("reports.dummy_report")
     baker.make_recipe("reports.dummy_report", title="test1")
     response = client.get(reverse("landing"))
-    assert list(response.context["categories"]) == list(Category.objects.all())
+    assert [category.id for category in response.context["categories"]] == list(
+        Category.objects.values_list("id", flat=True)
+    )
 
 
 @pytest.mark.django_db
@@ -51,16 +66,17 @@ def test_landing_view_ordering(client, mock_repo_url):
 
     response = client.get(reverse("landing"))
     # Categories are in alphabetical order by name
-    assert list(response.context["categories"].values_list("name", flat=True)) == [
+    assert [category.name for category in response.context["categories"]] == [
         "Reports",
         "Test",
     ]
     # Within each category, reports are in alphabetical order by menu_name
     reports_category_context, test_category_context = response.context["categories"]
-    assert list(
-        reports_category_context.reports.values_list("menu_name", flat=True)
-    ) == ["bcd", "jkl"]
-    assert list(test_category_context.reports.values_list("menu_name", flat=True)) == [
+    assert [report.menu_name for report in reports_category_context.reports] == [
+        "bcd",
+        "jkl",
+    ]
+    assert [report.menu_name for report in test_category_context.reports] == [
         "abc",
         "def",
         "xyz",
@@ -122,7 +138,7 @@ def test_landing_view_draft_reports_permissions(
     draft_category.reports.add(report4, report5)
 
     response = client.get(reverse("landing"))
-    assert response.context["categories"].count() == len(expected_category_names)
+    assert len(response.context["categories"]) == len(expected_category_names)
     categories = response.context["categories"]
     assert [category.name for category in categories] == expected_category_names
 
@@ -233,7 +249,7 @@ def test_landing_view_recent_activity_archived_reports(
     )
     # report is not archived, appears in recent activity
     response = client.get(reverse("landing"))
-    assert list(response.context["recent_activity"]) == [report]
+    assert [event.id for event in response.context["recent_activity"]] == [report.id]
 
     # archived report
     category = baker.make(Category, name="Archive")
@@ -366,11 +382,548 @@ def test_report_view_last_updated(client, log_output):
     report = baker.make_recipe("reports.real_report")
     assert report.last_updated is None
 
-    # fetch report
+    # fetch report; the report isn't cached, so it's streamed
     response = client.get(report.get_absolute_url())
     assert response.status_code == 200
+    content = b"".join(response.streaming_content).decode()
 
     report.refresh_from_db()
     assert report.last_updated is not None
 
-    assert report.last_updated.strftime("%d %b %Y") in response.rendered_content
+    assert report.last_updated.strftime("%d %b %Y") in content
+
+
+def mock_job_server_report(httpretty, url, **response_kwargs):
+    # Mock the job-server file_exists() request, and the report file itself
+    httpretty.register_uri(
+        httpretty.HEAD, url, responses=[httpretty.Response(status=200, body="")]
+    )
+    httpretty.register_uri(
+        httpretty.GET, url, responses=[httpretty.Response(**response_kwargs)]
+    )
+    return baker.make(Report, job_server_url=url)
+
+
+@pytest.mark.django_db
+def test_report_view_streams_uncached_report(client, httpretty):
+    last_modified = datetime(2021, 3, 1, tzinfo=timezone.utc)
+    report = mock_job_server_report(
+        httpretty,
+        "https://jobs.opensafely.org/org/project/workspace/published/streamed",
+        status=200,
+        body="<html><body><p>The streamed content</p></body></html>",
+        adding_headers={"Last-Modified": http_date(last_modified.timestamp())},
+    )
+
+    response = client.get(report.get_absolute_url())
+
+    assert response.status_code == 200
+    assert response.streaming
+    assert response["X-Accel-Buffering"] == "no"
+    assert response.context["report"] == report
+    # nothing is fetched until the page shell has been sent
+    assert report.last_updated is None
+
+    chunks = [chunk.decode() for chunk in response.streaming_content]
+    assert "</html>" in chunks[-1]
+    content = "".join(chunks)
+    assert "<p>The streamed content</p>" in content
+    assert "01 Mar 2021" in content
+    report.refresh_from_db()
+    assert report.last_updated == last_modified.date()
+
+    # the content is now cached, so the next request isn't streamed as it's rendered, and
+    # gets the same content
+    httpretty.reset()
+    response = client.get(report.get_absolute_url())
+    assert "X-Accel-Buffering" not in response
+    assert b"".join(response.streaming_content).decode().split() == content.split()
+    assert httpretty.latest_requests() == []
+
+
+@pytest.mark.django_db
+def test_report_view_streaming_error(client, httpretty, log_output):
+    report = mock_job_server_report(
+        httpretty,
+        "https://jobs.opensafely.org/org/project/workspace/published/broken",
+        status=500,
+        body="",
+    )
+
+    response = client.get(report.get_absolute_url())
+
+    assert response.status_code == 200
+    content = b"".join(response.streaming_content).decode()
+    assert "unable to load this report" in content
+    assert content.rstrip().endswith("</html>")
+    assert log_output.entries[-1]["event"] == "Error fetching report"
+
+    # we didn't cache the error
+    assert client.get(report.get_absolute_url()).streaming
+
+
+@pytest.mark.django_db
+def test_report_view_without_streaming(client, httpretty, settings):
+    settings.STREAM_REPORTS = False
+    report = mock_job_server_report(
+        httpretty,
+        "https://jobs.opensafely.org/org/project/workspace/published/not-streamed",
+        status=200,
+        body="<html><body><p>The test content</p></body></html>",
+        adding_headers={"Last-Modified": http_date(datetime.now().timestamp())},
+    )
+
+    response = client.get(report.get_absolute_url())
+
+    assert "X-Accel-Buffering" not in response
+    assert "<p>The test content</p>" in b"".join(response.streaming_content).decode()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("stream_reports", [True, False])
+def test_report_view_gzip(client, httpretty, settings, stream_reports):
+    settings.STREAM_REPORTS = stream_reports
+    report = mock_job_server_report(
+        httpretty,
+        f"https://jobs.opensafely.org/org/project/workspace/published/gzip-{stream_reports}",
+        status=200,
+        body="<html><body><p>The compressed content</p></body></html>",
+        adding_headers={"Last-Modified": http_date(datetime.now().timestamp())},
+    )
+
+    # uncompressed the first time, and compressed the second, from the same fragment
+    uncompressed = client.get(report.get_absolute_url())
+    content = b"".join(uncompressed.streaming_content).decode()
+    assert "Content-Encoding" not in uncompressed
+    response = client.get(report.get_absolute_url(), HTTP_ACCEPT_ENCODING="gzip, br")
+
+    assert response["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response["Vary"]
+    compressed = gzip.decompress(b"".join(response.streaming_content)).decode()
+    assert "<p>The compressed content</p>" in compressed
+    assert compressed.split() == content.split()
+
+
+@pytest.mark.django_db
+def test_report_view_fragment_evicted(client, httpretty, settings):
+    settings.STREAM_REPORTS = False
+    report = mock_job_server_report(
+        httpretty,
+        "https://jobs.opensafely.org/org/project/workspace/published/evicted",
+        status=200,
+        body="<html><body><p>The test content</p></body></html>",
+        adding_headers={"Last-Modified": http_date(datetime.now().timestamp())},
+    )
+    client.get(report.get_absolute_url())
+
+    # the page is still cached, but the report body it refers to has gone
+    shutil.rmtree(settings.FRAGMENT_STORE_DIR)
+    response = client.get(report.get_absolute_url(), HTTP_ACCEPT_ENCODING="gzip")
+
+    content = gzip.decompress(b"".join(response.streaming_content)).decode()
+    assert "<p>The test content</p>" in content
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("stream_reports", [True, False])
+def test_report_view_over_render_budget(
+    client, httpretty, mocker, settings, log_output, stream_reports
+):
+    settings.STREAM_REPORTS = stream_reports
+    mocker.patch(
+        "reports.fragments.run_render",
+        side_effect=RenderTimeout("Render took too long"),
+    )
+    report = mock_job_server_report(
+        httpretty,
+        f"https://jobs.opensafely.org/org/project/workspace/published/{stream_reports}",
+        status=200,
+        body="<html><body><p>The test content</p></body></html>",
+        adding_headers={"Last-Modified": http_date(datetime.now().timestamp())},
+    )
+
+    response = client.get(report.get_absolute_url())
+
+    if stream_reports:
+        content = b"".join(response.streaming_content).decode()
+        assert "Error streaming report" in [
+            entry["event"] for entry in log_output.entries
+        ]
+    else:
+        assert response.status_code == 500
+        content = response.content.decode()
+        assert "Error rendering report" in [
+            entry["event"] for entry in log_output.entries
+        ]
+    assert "too large or complex for us to display" in content
+    assert "<p>The test content</p>" not in content
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("stream_reports", [True, False])
+def test_report_view_being_rendered_elsewhere(
+    client, httpretty, settings, log_output, stream_reports
+):
+    settings.STREAM_REPORTS = stream_reports
+    settings.LOCK_WAIT = 0
+    report = mock_job_server_report(
+        httpretty,
+        f"https://jobs.opensafely.org/org/project/workspace/published/locked-{stream_reports}",
+        status=200,
+        body="<html><body><p>The test content</p></body></html>",
+        adding_headers={"Last-Modified": http_date(datetime.now().timestamp())},
+    )
+    # another worker is rendering the report
+    locks.acquire(f"render-report:{report.pk}")
+
+    response = client.get(report.get_absolute_url())
+
+    if stream_reports:
+        content = b"".join(response.streaming_content).decode()
+    else:
+        assert response.status_code == 503
+        assert response["Retry-After"] == "10"
+        content = response.content.decode()
+    assert "This report is being refreshed" in content
+    assert "<p>The test content</p>" not in content
+    assert "Report is still being rendered" in [
+        entry["event"] for entry in log_output.entries
+    ]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("stream_reports", [True, False])
+def test_report_view_waits_without_fetching(
+    client, httpretty, mocker, settings, stream_reports
+):
+    settings.STREAM_REPORTS = stream_reports
+    report = mock_job_server_report(
+        httpretty,
+        f"https://jobs.opensafely.org/org/project/workspace/published/waiting-{stream_reports}",
+        status=200,
+        body="<html><body><p>The other worker's content</p></body></html>",
+        adding_headers={"Last-Modified": "Mon, 01 Mar 2021 00:00:00 GMT"},
+    )
+    lock = f"render-report:{report.pk}"
+    token = locks.acquire(lock)
+
+    def render_elsewhere(name):
+        # the other worker fetches and renders the report while we wait
+        key = store_fragment(["<p>The other worker's content</p>"])
+        Report.objects.filter(pk=report.pk).update(last_updated=date(2021, 3, 1))
+        Report.objects.get(pk=report.pk).record_source(
+            fragment_key=key, source_checked_at=datetime.now(timezone.utc)
+        )
+        locks.release(name, token)
+
+    mocker.patch("reports.locks.wait", side_effect=render_elsewhere)
+    # creating the report checked that its file exists
+    fetched = len(httpretty.latest_requests())
+    response = client.get(report.get_absolute_url())
+
+    content = b"".join(response.streaming_content).decode()
+    assert "<p>The other worker's content</p>" in content
+    # the header shows when the report was last updated, as the other worker found out
+    assert "01 Mar 2021" in content
+    # neither the report nor when it was last updated were asked of job-server
+    assert len(httpretty.latest_requests()) == fetched
+
+
+def open_circuit(upstream):
+    for _ in range(settings.CIRCUIT_FAILURE_THRESHOLD):
+        breaker = CircuitBreaker(upstream)
+        breaker.allow()
+        breaker.record_failure()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("stream_reports", [True, False])
+def test_report_view_upstream_failing(client, httpretty, settings, stream_reports):
+    settings.STREAM_REPORTS = stream_reports
+    report = mock_job_server_report(
+        httpretty,
+        f"https://jobs.opensafely.org/org/project/workspace/published/failing-{stream_reports}",
+        status=200,
+        body="<html><body><p>The test content</p></body></html>",
+        adding_headers={"Last-Modified": "Mon, 01 Mar 2021 00:00:00 GMT"},
+    )
+    content = b"".join(client.get(report.get_absolute_url()).streaming_content)
+    assert b"may be out of date" not in content
+
+    # the report's content is no longer cached, and job-server is failing
+    get_fragment_cache().clear()
+    open_circuit("jobs.opensafely.org")
+    httpretty.reset()
+
+    response = client.get(report.get_absolute_url())
+
+    assert response.status_code == 200
+    assert "X-Accel-Buffering" not in response
+    content = b"".join(response.streaming_content).decode()
+    assert "<p>The test content</p>" in content
+    assert "may be out of date" in content
+    assert "01 Mar 2021" in content
+    assert httpretty.latest_requests() == []
+    # what we served wasn't cached
+    assert not get_fragment_cache().get(report_content_key(report))
+
+
+@pytest.mark.django_db
+def test_report_view_upstream_failing_never_rendered(
+    client, httpretty, settings, log_output
+):
+    settings.STREAM_REPORTS = False
+    report = mock_job_server_report(
+        httpretty,
+        "https://jobs.opensafely.org/org/project/workspace/published/never",
+        status=200,
+        body="<html><body><p>The test content</p></body></html>",
+    )
+    open_circuit("jobs.opensafely.org")
+
+    response = client.get(report.get_absolute_url())
+
+    assert response.status_code == 503
+    assert "unable to load this report" in response.content.decode()
+    assert "Error fetching report" in [entry["event"] for entry in log_output.entries]
+
+
+def mock_github_rate_limited(httpretty):
+    httpretty.register_uri(
+        httpretty.GET,
+        re.compile(r"https://api\.github\.com/.*"),
+        status=403,
+        body='{"message": "API rate limit exceeded"}',
+        adding_headers={"X-RateLimit-Remaining": "0"},
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("stream_reports", [True, False])
+def test_report_view_github_rate_limited(
+    client, httpretty, settings, log_output, stream_reports
+):
+    settings.STREAM_REPORTS = stream_reports
+    report = baker.make(
+        Report,
+        repo="test",
+        report_html_file_path="foo.html",
+        last_updated=date(2021, 3, 1),
+    )
+    # rendered before, but we don't know which version of the file it was
+    report.record_source(fragment_key=store_fragment(["<p>The test content</p>"]))
+    mock_github_rate_limited(httpretty)
+
+    response = client.get(report.get_absolute_url())
+
+    assert response.status_code == 200
+    content = b"".join(response.streaming_content).decode()
+    assert "<p>The test content</p>" in content
+    assert "may be out of date" in content
+    assert "01 Mar 2021" in content
+    assert "Error fetching report" in [entry["event"] for entry in log_output.entries]
+    # what we served wasn't cached
+    assert not get_fragment_cache().get(report_content_key(report))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("stream_reports", [True, False])
+def test_report_view_github_rate_limited_never_rendered(
+    client, httpretty, settings, stream_reports
+):
+    settings.STREAM_REPORTS = stream_reports
+    report = baker.make(Report, repo="test", report_html_file_path="foo.html")
+    mock_github_rate_limited(httpretty)
+
+    response = client.get(report.get_absolute_url())
+
+    if stream_reports:
+        content = b"".join(response.streaming_content).decode()
+    else:
+        assert response.status_code == 503
+        content = response.content.decode()
+    assert "unable to load this report" in content
+    # it counts towards GitHub's circuit
+    breaker = CircuitBreaker("api.github.com")
+    assert breaker.allow()
+    assert breaker.failures == 1
+
+
+@pytest.mark.django_db
+def test_report_image(client):
+    url = get_image_store().save(b"some image data", "png")
+
+    response = client.get(url)
+
+    assert response.status_code == 200
+    assert response["Content-Type"] == "image/png"
+    assert b"".join(response.streaming_content) == b"some image data"
+    assert "immutable" in response["Cache-Control"]
+    assert "max-age=31536000" in response["Cache-Control"]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "name",
+    [
+        f"{'0' * 64}.png",
+        f"{'0' * 64}.html",
+    ],
+    ids=["Missing image", "Unsupported image type"],
+)
+def test_report_image_not_found(client, name):
+    response = client.get(reverse("report_image", args=(name,)))
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_report_table(client):
+    with get_table_store().writer("json") as writer:
+        writer.write('{"header":[],"rows":[]}')
+
+    response = client.get(writer.url)
+
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/json"
+    assert "Content-Encoding" not in response
+    assert "Accept-Encoding" in response["Vary"]
+    assert b"".join(response.streaming_content) == b'{"header":[],"rows":[]}'
+    assert "immutable" in response["Cache-Control"]
+    assert (
+        client.get(reverse("report_table", args=(f"{'0' * 64}.json",))).status_code
+        == 404
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "accept_encoding,encoding,decompress",
+    [
+        ("gzip, deflate, br", "br", brotli.decompress),
+        ("gzip", "gzip", gzip.decompress),
+    ],
+)
+def test_report_table_compressed(client, accept_encoding, encoding, decompress):
+    with get_table_store().writer("json") as writer:
+        writer.write('{"header":[],"rows":[]}')
+
+    response = client.get(writer.url, HTTP_ACCEPT_ENCODING=accept_encoding)
+
+    assert response["Content-Type"] == "application/json"
+    assert response["Content-Encoding"] == encoding
+    content = decompress(b"".join(response.streaming_content))
+    assert content == b'{"header":[],"rows":[]}'
+
+
+@pytest.mark.django_db
+def test_report_table_without_compressed_copies(client):
+    store = get_table_store()
+    with store.writer("json") as writer:
+        writer.write('{"header":[],"rows":[]}')
+    for path in store.location.glob("*.json.*"):
+        path.unlink()
+
+    response = client.get(writer.url, HTTP_ACCEPT_ENCODING="gzip, br")
+
+    assert "Content-Encoding" not in response
+    assert b"".join(response.streaming_content) == b'{"header":[],"rows":[]}'
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("lazy_sidebar", [True, False])
+def test_lazy_sidebar(rf, mock_repo_url, lazy_sidebar):
+    mock_repo_url("https://github.com/opensafely/test-repo")
+    category = Category.objects.first()
+    report = baker.make_recipe("reports.dummy_report", category=category)
+    other_category = baker.make(Category, name="Test")
+    other_report = baker.make_recipe("reports.dummy_report", category=other_category)
+    request = rf.get(report.get_absolute_url())
+    request.user = AnonymousUser()
+
+    content = render_to_string(
+        "partials/sidebar.html",
+        {
+            "categories": navigation.categories_for_user(request.user),
+            "lazy_sidebar": lazy_sidebar,
+            "report": report,
+        },
+        request=request,
+    )
+
+    # the current report's category is always listed in full
+    assert report.get_absolute_url() in content
+    other_url = reverse("navigation_reports", args=(other_category.id,))
+    assert (other_url in content) == lazy_sidebar
+    assert (other_report.get_absolute_url() in content) != lazy_sidebar
+
+
+@pytest.mark.django_db
+def test_navigation_reports(client, mock_repo_url, user_with_permission):
+    mock_repo_url("https://github.com/opensafely/test-repo")
+    category = Category.objects.first()
+    report = baker.make_recipe(
+        "reports.dummy_report", category=category, menu_name="report-abc"
+    )
+    baker.make_recipe(
+        "reports.dummy_report", category=category, menu_name="report-def", is_draft=True
+    )
+    url = reverse("navigation_reports", args=(category.id,))
+
+    response = client.get(url)
+
+    assert response.status_code == 200
+    assert "private" in response["Cache-Control"]
+    assert response.json() == {
+        "reports": [
+            {
+                "id": report.id,
+                "menu_name": "report-abc",
+                "url": report.get_absolute_url(),
+                "is_draft": False,
+            }
+        ]
+    }
+
+    # unchanged
+    response = client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+    assert response.status_code == 304
+
+    # users who can see drafts see different reports
+    client.force_login(user_with_permission)
+    response = client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+    assert response.status_code == 200
+    assert [report["menu_name"] for report in response.json()["reports"]] == [
+        "report-abc",
+        "report-def",
+    ]
+
+
+@pytest.mark.django_db
+def test_navigation_reports_etag_changes_with_reports(
+    client, mock_repo_url, django_capture_on_commit_callbacks
+):
+    mock_repo_url("https://github.com/opensafely/test-repo")
+    category = Category.objects.first()
+    report = baker.make_recipe("reports.dummy_report", category=category)
+    url = reverse("navigation_reports", args=(category.id,))
+    etag = client.get(url)["ETag"]
+
+    with django_capture_on_commit_callbacks(execute=True):
+        report.menu_name = "A new name"
+        report.save()
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()["reports"][0]["menu_name"] == "A new name"
+
+
+@pytest.mark.django_db
+def test_navigation_reports_not_found(client, mock_repo_url):
+    mock_repo_url("https://github.com/opensafely/test-repo")
+    archive = baker.make(Category, name="Archive")
+    baker.make_recipe("reports.dummy_report", category=archive)
+
+    # categories without reports, or that the user can't see
+    for category in Category.objects.all():
+        url = reverse("navigation_reports", args=(category.id,))
+        assert client.get(url).status_code == 404
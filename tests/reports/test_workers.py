@@ -0,0 +1,61 @@
+import os
+import time
+
+import pytest
+
+from reports.workers import (
+    RenderError,
+    RenderMemoryExceeded,
+    RenderTimeout,
+    resident_memory,
+    run_render,
+)
+
+
+def test_run_render(tmp_path):
+    path = tmp_path / "output.html"
+
+    def render():
+        path.write_text("<p>foo</p>")
+
+    run_render(render, timeout=10)
+
+    assert path.read_text() == "<p>foo</p>"
+
+
+def test_run_render_error(log_output):
+    def render():
+        raise ValueError("Boom")
+
+    with pytest.raises(RenderError, match="exit code 1"):
+        run_render(render, timeout=10)
+    assert log_output.entries[-1]["event"] == "Render failed"
+
+
+def test_run_render_timeout(log_output):
+    start = time.monotonic()
+    with pytest.raises(RenderTimeout):
+        run_render(lambda: time.sleep(10), timeout=0.2)
+
+    assert time.monotonic() - start < 5
+    assert log_output.entries[-1]["event"] == "Render timed out"
+
+
+def test_run_render_memory_exceeded(log_output):
+    max_memory = resident_memory(os.getpid()) + 50 * 1024**2
+
+    def render():
+        data = b"x" * 200 * 1024**2  # noqa: F841
+        time.sleep(10)
+
+    with pytest.raises(RenderMemoryExceeded):
+        run_render(render, timeout=10, max_memory=max_memory)
+    assert log_output.entries[-1]["event"] == "Render exceeded its memory limit"
+
+
+def test_run_render_no_worker_available(mocker):
+    slots = mocker.patch("reports.workers._worker_slots").return_value
+    slots.acquire.return_value = False
+
+    with pytest.raises(RenderTimeout, match="No render worker"):
+        run_render(lambda: None, timeout=0.1)